@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+__author__ = 'masayuki'
+
+import io
+import zlib
+import struct
+import collections
+import threading
+import multiprocessing
+import multiprocessing.pool
+
+import numpy
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+chunked dataset container: the frames are split into fixed-size blocks which are compressed independently,
+so that they can be compressed in parallel and a reader only decompresses the blocks it needs.
+
+layout of the file:
+    MAGIC | block 0 | block 1 | ... | index (npz) | offset of the index (uint64)
+'''
+
+MAGIC = 'CHUNKED1'
+
+def codecs():
+    '''
+    :return: names of the available codecs
+    '''
+    available = ['zlib']
+    if lz4 is not None:
+        available.append('lz4')
+    if zstandard is not None:
+        available.append('zstd')
+    return available
+
+def compress(codec, level, data):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    elif codec == 'lz4':
+        return lz4.frame.compress(data, compression_level=level)
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise NotImplementedError("Unknown codec: "+codec)
+
+def decompress(codec, data):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    elif codec == 'lz4':
+        return lz4.frame.decompress(data)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise NotImplementedError("Unknown codec: "+codec)
+
+def _compress_block(args):
+    return compress(*args)
+
+def save_chunked(path, input_raw_data, chunksize=64, codec='zlib', level=6, processes=None, **arrays):
+    '''
+    save frames to a chunked container, compressing the blocks in a pool of processes
+    :param path: path to the output file
+    :param input_raw_data: ndarray (or memmap) of the frames, the first axis is split into blocks
+    :param chunksize: number of frames in a block
+    :param codec: 'zlib', 'lz4' or 'zstd' (see codecs())
+    :param level: compression level
+    :param processes: number of processes (default: number of cpus), 0 to compress in this process
+    :param arrays: other (small) arrays to save, such as clips, dims, zmins and zmaxs
+    :return:
+    '''
+    if codec not in codecs():
+        raise ValueError("codec {0} is not available, use one of {1}".format(codec, codecs()))
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        offsets, lengths, firsts = write_blocks(f, input_raw_data, chunksize, codec, level, processes)
+        write_index(f, offsets=offsets, lengths=lengths, firsts=firsts,
+                    shape=numpy.asarray(input_raw_data.shape, dtype=numpy.int64),
+                    dtype=numpy.asarray(str(input_raw_data.dtype)),
+                    chunksize=numpy.asarray(chunksize),
+                    codec=numpy.asarray(codec),
+                    **arrays)
+
+def append_chunked(path, input_raw_data, level=6, processes=None, **arrays):
+    '''
+    append frames to a chunked container. the old blocks are kept as they are, the new blocks are written over the old index
+    and a new index is written after them
+    :param path: path to the container
+    :param input_raw_data: ndarray (or memmap) of the frames to append
+    :param arrays: arrays to replace (such as clips), the others are kept
+    :return:
+    '''
+    index, index_offset = read_index(path)
+    shape = tuple(int(x) for x in index['shape'])
+    if tuple(input_raw_data.shape[1:]) != shape[1:] or str(input_raw_data.dtype) != str(index['dtype']):
+        raise ValueError('frames of {0} {1} can not be appended to {2} {3}'.format(
+            input_raw_data.dtype, input_raw_data.shape, index['dtype'], shape))
+
+    with open(path, 'r+b') as f:
+        f.seek(index_offset)
+        f.truncate()
+        offsets, lengths, firsts = write_blocks(f, input_raw_data, int(index['chunksize']), str(index['codec']), level, processes)
+
+        index.update(arrays)
+        index['firsts'] = numpy.concatenate([block_firsts(index), firsts + shape[0]])
+        index['offsets'] = numpy.concatenate([index['offsets'], offsets])
+        index['lengths'] = numpy.concatenate([index['lengths'], lengths])
+        index['shape'] = numpy.asarray((shape[0] + input_raw_data.shape[0],) + shape[1:], dtype=numpy.int64)
+        write_index(f, **index)
+
+def write_blocks(f, input_raw_data, chunksize, codec, level, processes):
+    '''
+    compress the blocks of input_raw_data in a pool of processes and write them to f
+    :return: offsets and lengths of the blocks in f, and the first frame of each block
+    '''
+    n_frames = input_raw_data.shape[0]
+
+    def blocks():
+        for i in xrange(0, n_frames, chunksize):
+            yield (codec, level, numpy.ascontiguousarray(input_raw_data[i:i+chunksize]).tostring())
+
+    pool = None if processes == 0 else multiprocessing.Pool(processes)
+    try:
+        offsets = []
+        lengths = []
+        for block in itertools_imap(pool, blocks()):
+            offsets.append(f.tell())
+            lengths.append(len(block))
+            f.write(block)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return (numpy.asarray(offsets, dtype=numpy.int64), numpy.asarray(lengths, dtype=numpy.int64),
+            numpy.arange(0, n_frames, chunksize, dtype=numpy.int64))
+
+def itertools_imap(pool, iterable):
+    if pool is None:
+        return (_compress_block(args) for args in iterable)
+    return pool.imap(_compress_block, iterable)
+
+def write_index(f, **index):
+    buf = io.BytesIO()
+    numpy.savez(buf, **index)
+    index_offset = f.tell()
+    f.write(buf.getvalue())
+    f.write(struct.pack('<Q', index_offset))
+
+def read_index(path):
+    '''
+    :return: a dict of the index of the container, and the offset of the index in the file
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a chunked container: "+path)
+        f.seek(-8, 2)
+        end = f.tell()
+        index_offset = struct.unpack('<Q', f.read(8))[0]
+        f.seek(index_offset)
+        index = numpy.load(io.BytesIO(f.read(end - index_offset)))
+        return dict((key, index[key]) for key in index.files), index_offset
+
+def block_firsts(index):
+    # the first frame of each block (the blocks are of chunksize frames unless frames were appended)
+    if 'firsts' in index:
+        return index['firsts']
+    return numpy.arange(len(index['offsets']), dtype=numpy.int64) * int(index['chunksize'])
+
+class ChunkedArray(object):
+    def __init__(self, path, index, cachesize=64):
+        '''
+        frames of a chunked container, decompressing only the blocks which are accessed.
+        supports len(), .shape, .dtype and indexing the first axis with an integer or a slice (and the others with anything)
+        :param path: path to the container
+        :param index: the index loaded from the container
+        :param cachesize: number of decompressed blocks to keep
+        :return:
+        '''
+        self.path = path
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.firsts = block_firsts(index)
+        self.shape = tuple(int(x) for x in index['shape'])
+        self.dtype = numpy.dtype(str(index['dtype']))
+        self.chunksize = int(index['chunksize'])
+        self.codec = str(index['codec'])
+        self.ndim = len(self.shape)
+
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_block(self, b):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[b])
+            data = f.read(self.lengths[b])
+        n = (self.firsts[b+1] if b + 1 < len(self.firsts) else self.shape[0]) - self.firsts[b]
+        return numpy.frombuffer(decompress(self.codec, data), dtype=self.dtype).reshape((n,) + self.shape[1:])
+
+    def block(self, b):
+        '''
+        :param b: index of the block
+        :return: ndarray of the frames in the block
+        '''
+        with self.lock:
+            item = self.cache.get(b)
+            if item is not None:
+                self.cache[b] = self.cache.pop(b)
+        if item is None:
+            item = self._read_block(b)
+            self._put(b, item)
+        elif isinstance(item, multiprocessing.pool.ApplyResult):
+            item = item.get()
+            self._put(b, item)
+        return item
+
+    def _put(self, b, item):
+        with self.lock:
+            self.cache[b] = item
+            while self.cachesize < len(self.cache):
+                self.cache.popitem(last=False)
+
+    def block_of(self, i):
+        '''
+        :return: index of the block of the frame i
+        '''
+        return int(numpy.searchsorted(self.firsts, i, side='right')) - 1
+
+    def prefetch(self, start, stop):
+        '''
+        decompress the blocks of the frames [start, stop) on a background thread
+        '''
+        if self.pool is None:
+            self.pool = multiprocessing.pool.ThreadPool(1)
+        for b in xrange(self.block_of(start), self.block_of(stop - 1) + 1):
+            with self.lock:
+                if b in self.cache:
+                    continue
+            self._put(b, self.pool.apply_async(self._read_block, (b,)))
+
+    def close(self):
+        '''
+        terminate the thread of prefetch() and drop the blocks it has not read yet
+        (prefetch() starts a new thread if it is called again)
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        with self.lock:
+            for b in [b for b, item in self.cache.items() if isinstance(item, multiprocessing.pool.ApplyResult)]:
+                del self.cache[b]
+
+    def __del__(self):
+        # __init__ may have failed before the pool was set
+        if hasattr(self, 'pool'):
+            self.close()
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            # index the first axis by blocks, then the other axes of the result
+            return self[key[0]][(slice(None),) + key[1:] if isinstance(key[0], slice) else key[1:]]
+
+        if isinstance(key, (int, long, numpy.integer)):
+            if key < 0:
+                key += self.shape[0]
+            if not 0 <= key < self.shape[0]:
+                raise IndexError('index {0} is out of bounds for size {1}'.format(key, self.shape[0]))
+            b = self.block_of(key)
+            return self.block(b)[key - self.firsts[b]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.shape[0])
+            if step < 0:
+                raise ValueError('ChunkedArray does not support a negative step of a slice')
+            if stop <= start:
+                return numpy.zeros((0,) + self.shape[1:], dtype=self.dtype)
+            b0 = self.block_of(start)
+            blocks = [self.block(b) for b in xrange(b0, self.block_of(stop - 1) + 1)]
+            first = self.firsts[b0]
+            data = blocks[0] if len(blocks) == 1 else numpy.concatenate(blocks, axis=0)
+            return data[start-first:stop-first:step]
+
+        raise TypeError('ChunkedArray only supports an integer or a slice as the index')
+
+    def __array__(self, dtype=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+class ChunkedFile(object):
+    def __init__(self, path, cachesize=64):
+        '''
+        open a chunked container. works like the NpzFile of numpy.load():
+        f['input_raw_data'] is a ChunkedArray and the other keys are ndarrays
+        :param path: path to the container
+        :param cachesize: number of decompressed blocks to keep
+        '''
+        self.index, _ = read_index(path)
+        self.input_raw_data = ChunkedArray(path, self.index, cachesize=cachesize)
+        self.reserved = ['offsets', 'lengths', 'firsts', 'shape', 'dtype', 'chunksize', 'codec']
+        self.files = ['input_raw_data'] + [key for key in self.index.keys() if key not in self.reserved]
+
+    def keys(self):
+        return self.files
+
+    def __getitem__(self, key):
+        if key == 'input_raw_data':
+            return self.input_raw_data
+        if key in self.reserved:
+            raise KeyError(key)
+        return self.index[key]
+
+    def close(self):
+        self.input_raw_data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def load(path, cachesize=64):
+    return ChunkedFile(path, cachesize=cachesize)
+
+def bench_chunked(n_frames=2000, d=2, h=60, w=60, chunksize=20, batch=16, seqlen=20):
+    '''
+    compare savez_compressed / numpy.load with the chunked container on sparse frames like the normalized radar
+    '''
+    import os
+    import tempfile
+    import timeit
+
+    rng = numpy.random.RandomState(1000)
+    frames = numpy.cumsum(rng.normal(0, 0.01, (n_frames, d, h, w)).astype(numpy.float32), axis=0)
+    frames = numpy.round(numpy.maximum(frames - 0.1, 0), 2)
+
+    dirname = tempfile.mkdtemp()
+    npz = os.path.join(dirname, 'dataset.npz')
+    chunked = os.path.join(dirname, 'dataset.chunked')
+    try:
+        t_savez = timeit.default_timer()
+        numpy.savez_compressed(npz, input_raw_data=frames)
+        t_savez = timeit.default_timer() - t_savez
+
+        t_save = timeit.default_timer()
+        save_chunked(chunked, frames, chunksize=chunksize)
+        t_save = timeit.default_timer() - t_save
+
+        starts = rng.randint(0, n_frames - seqlen, batch)
+
+        t_load_npz = timeit.default_timer()
+        data = numpy.load(npz)['input_raw_data']
+        batch_npz = [data[s:s+seqlen] for s in starts]
+        t_load_npz = timeit.default_timer() - t_load_npz
+
+        t_load = timeit.default_timer()
+        with load(chunked) as f:
+            data = f['input_raw_data']
+            batch_chunked = [data[s:s+seqlen] for s in starts]
+        t_load = timeit.default_timer() - t_load
+
+        assert all(numpy.array_equal(a, b) for a, b in zip(batch_npz, batch_chunked))
+        print('save: savez_compressed {0:.3f} sec, chunked {1:.3f} sec'.format(t_savez, t_save))
+        print('first minibatch: npz {0:.3f} sec, chunked {1:.3f} sec'.format(t_load_npz, t_load))
+        print('size: npz {0} bytes, chunked {1} bytes'.format(os.path.getsize(npz), os.path.getsize(chunked)))
+    finally:
+        for f in (npz, chunked):
+            if os.path.isfile(f):
+                os.remove(f)
+        os.rmdir(dirname)
+
+if __name__ == '__main__':
+    bench_chunked()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+import os
+import glob
+
+import numpy
+
+from generator import ts2sec, parse_radar, parse_himawari8, satellite_lut, parse_satellite_lut
+from generator import RadarGenerator, Himawari8Generator, SatelliteGenerator
+
+'''
+memory-mapped frame store of the weather sources
+'''
+
+def downsample(frames, factor):
+    '''
+    area-average frames by factor (the pixels beyond a multiple of factor are dropped)
+    :param frames: ndarray of shape (..., height, width)
+    :return: float32 ndarray of shape (..., height // factor, width // factor)
+    '''
+    if factor == 1:
+        return numpy.asarray(frames, dtype=numpy.float32)
+    h, w = frames.shape[-2] // factor, frames.shape[-1] // factor
+    blocks = frames[..., :h*factor, :w*factor].reshape(frames.shape[:-2] + (h, factor, w, factor))
+    return blocks.mean(axis=(-3, -1), dtype=numpy.float32)
+
+class FrameStore(object):
+    def __init__(self, dir, level=0):
+        '''
+        an append-only store of frames of one source.
+        the frames are kept in one contiguous float32 file (frames.dat) of shape (n_frames, d, height, width),
+        and the sorted timestamps (seconds since the epoch) of each row are kept in timestamps.dat (raw int64),
+        to which append() adds one timestamp without rewriting the others.
+        the store can also keep a pyramid of the frames area-averaged by 2**level (frames-2x.dat, frames-4x.dat, ...),
+        which is extended by append() as well (see build_pyramid)
+        :param dir: the directory of the store
+        :param level: the level of the pyramid to read (0 for the frames as ingested)
+        :return:
+        '''
+        self.dir = dir
+        self.level = level
+        self.dims = None
+        self.levels = [0]
+        # the timestamps are kept in a buffer grown by doubling, so that appending one is amortized O(1)
+        self._timestamps = numpy.zeros((0,), dtype=numpy.int64)
+        self._n = 0
+        self._frames = None
+
+        if os.path.isfile(self._path('dims.npy')):
+            self.dims = tuple(int(x) for x in numpy.load(self._path('dims.npy')))
+            if os.path.isfile(self._path('timestamps.npy')) and not os.path.isfile(self._path('timestamps.dat')):
+                # a store of the previous format
+                numpy.load(self._path('timestamps.npy')).astype(numpy.int64).tofile(self._path('timestamps.dat'))
+                os.remove(self._path('timestamps.npy'))
+            if os.path.isfile(self._path('timestamps.dat')):
+                # the whole timestamps only (an interrupted append may leave a part of one)
+                n = os.path.getsize(self._path('timestamps.dat')) // 8
+                self._timestamps = numpy.fromfile(self._path('timestamps.dat'), dtype=numpy.int64, count=n)
+                self._n = n
+            if os.path.isfile(self._path('levels.npy')):
+                self.levels = [int(x) for x in numpy.load(self._path('levels.npy'))]
+            if level not in self.levels:
+                raise ValueError('level {0} is not built in {1} (levels: {2})'.format(level, dir, self.levels))
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _frames_path(self, level):
+        return self._path('frames.dat' if level == 0 else 'frames-{0}x.dat'.format(2**level))
+
+    def _dims(self, level):
+        d, h, w = self.dims
+        return (d, h // 2**level, w // 2**level)
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def __contains__(self, timestamp):
+        return self.row(timestamp) is not None
+
+    @property
+    def frames(self):
+        '''
+        memory-mapped array of shape (n_frames, d, height, width) of the level
+        '''
+        if self._frames is None and 0 < len(self):
+            self._frames = numpy.memmap(self._frames_path(self.level), dtype=numpy.float32, mode='r',
+                                        shape=(len(self),) + self._dims(self.level))
+        return self._frames
+
+    def row(self, timestamp):
+        '''
+        look up the row of a timestamp
+        :param timestamp: a timestamp string or seconds since the epoch
+        :return: the row index, or None if the timestamp is not in the store
+        '''
+        t = ts2sec(timestamp) if isinstance(timestamp, basestring) else timestamp
+        i = numpy.searchsorted(self.timestamps, t)
+        if i < len(self.timestamps) and self.timestamps[i] == t:
+            return int(i)
+        return None
+
+    def append(self, timestamp, frame):
+        '''
+        append a frame (and its levels of the pyramid). timestamps must be appended in increasing order
+        :param timestamp: a timestamp string or seconds since the epoch
+        :param frame: ndarray of shape (d, height, width)
+        :return:
+        '''
+        if self.level != 0:
+            raise ValueError('frames are appended to the level 0 of the store')
+        t = ts2sec(timestamp) if isinstance(timestamp, basestring) else timestamp
+        if self.dims is None:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            self.dims = frame.shape
+            numpy.save(self._path('dims.npy'), numpy.asarray(self.dims, dtype=numpy.int64))
+        if frame.shape != self.dims:
+            raise ValueError('frame of shape {0} does not match the store of shape {1}'.format(frame.shape, self.dims))
+        if 0 < len(self) and t <= self.timestamps[-1]:
+            raise ValueError('timestamp {0} is not after the last timestamp of the store'.format(timestamp))
+
+        # write the frames first so that the index never points to a missing row
+        for level in self.levels:
+            with open(self._frames_path(level), 'ab') as f:
+                f.seek(len(self) * numpy.prod(self._dims(level)) * 4)
+                f.truncate()
+                downsample(frame, 2**level).tofile(f)
+        with open(self._path('timestamps.dat'), 'ab') as f:
+            # drop a timestamp partly written by an interrupted append
+            f.truncate(len(self) * 8)
+            numpy.asarray([t], dtype=numpy.int64).tofile(f)
+        if self._n == len(self._timestamps):
+            self._timestamps = numpy.concatenate([self._timestamps, numpy.zeros((max(self._n, 16),), dtype=numpy.int64)])
+        self._timestamps[self._n] = t
+        self._n += 1
+        self._frames = None
+
+    def build_pyramid(self, levels=3, blocksize=256):
+        '''
+        build the levels 1..levels of the pyramid (2x, 4x, 8x, ... area-averaged) from the frames in the store,
+        blocksize frames at a time. the levels already built are kept, and append() extends every level from then on
+        :param levels: the deepest level
+        :return:
+        '''
+        if self.level != 0:
+            raise ValueError('the pyramid is built from the level 0 of the store')
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        for level in xrange(1, levels + 1):
+            if level in self.levels:
+                continue
+            if self.dims is not None:
+                with open(self._frames_path(level), 'wb') as f:
+                    for i in xrange(0, len(self), blocksize):
+                        downsample(self.frames[i:i+blocksize], 2**level).tofile(f)
+            self.levels.append(level)
+        numpy.save(self._path('levels.npy'), numpy.asarray(self.levels, dtype=numpy.int64))
+
+    def crop(self, timestamp, w=0, h=0, offset=(0,0,0)):
+        '''
+        get a crop of the frame at timestamp as a view of the store (no copy).
+        the size and the offsets are in the pixels of the level
+        :param timestamp: a timestamp string or seconds since the epoch
+        :param w: width of the crop (0 for the whole frame)
+        :param h: height of the crop (0 for the whole frame)
+        :param offset: offsets of (x, y, ...)
+        :return: ndarray of shape (d, h, w)
+        '''
+        i = self.row(timestamp)
+        if i is None:
+            raise IOError("frame not found in {0}: {1}".format(self.dir, timestamp))
+
+        w = w if 0 < w else self._dims(self.level)[2]
+        h = h if 0 < h else self._dims(self.level)[1]
+        return self.frames[i, :, offset[1]:offset[1]+h, offset[0]:offset[0]+w]
+
+def ingest(src_dir, store_dir, parse, ext='.csv', pyramid=0, progress=1000):
+    '''
+    ingest a directory of timestamped frames into a frame store.
+    files whose timestamps are already in the store (or older than its last frame) are skipped,
+    so that it can be rerun to add new frames.
+    :param src_dir: the directory of files named <timestamp><ext>
+    :param store_dir: the directory of the frame store
+    :param parse: a function which parses a file into ndarray of shape (d, height, width)
+    :param ext: the file extension
+    :param pyramid: build this many levels of the pyramid (2x, 4x, 8x, ...) of the frames (see FrameStore.build_pyramid)
+    :param progress: print the progress every this many files
+    :return: the FrameStore
+    '''
+    store = FrameStore(store_dir)
+    if 0 < pyramid:
+        store.build_pyramid(pyramid)
+    last = store.timestamps[-1] if 0 < len(store) else -1
+
+    files = sorted(glob.glob(os.path.join(src_dir, '*'+ext)), key=lambda f: ts2sec(os.path.basename(f)[:-len(ext)]))
+    n_appended = 0
+    for i, filepath in enumerate(files):
+        if 0 < i and i % progress == 0:
+            print('ingest: [{0}/{1}] {2} frames appended'.format(i, len(files), n_appended))
+        timestamp = os.path.basename(filepath)[:-len(ext)]
+        t = ts2sec(timestamp)
+        if t <= last:
+            continue
+        try:
+            frame = parse(filepath)
+        except Exception as e:
+            print('ingest: skipped {0} with the error {1}'.format(filepath, e))
+            continue
+        store.append(t, frame)
+        n_appended += 1
+
+    print('ingest: {0} frames of {1} files appended to {2} ({3} frames)'.format(n_appended, len(files), store_dir, len(store)))
+    return store
+
+def ingest_radar(src_dir='../radar', store_dir='store/radar', pyramid=0):
+    return ingest(src_dir, store_dir, lambda f: parse_radar(f, w=0, h=0, offset=(0,0,0)), ext='.csv', pyramid=pyramid)
+
+def ingest_himawari8(src_dir='../himawari8', store_dir='store/himawari8', pyramid=0):
+    return ingest(src_dir, store_dir, lambda f: parse_himawari8(f, w=0, h=0, offset=(0,0,0)), ext='.csv', pyramid=pyramid)
+
+def ingest_satellite(src_dir='../eisei_PS01IR1', store_dir='store/eisei_PS01IR1', w=120, h=120, d=1,
+                     meshsize=(45,30), basepos=(491400,127800), lrit_settings=None, interpolation='nearest', pyramid=0):
+    '''
+    ingest satellite images projected onto the (w, h) grid at basepos
+    '''
+    if lrit_settings is None:
+        # setting for POLAR(N,135) satellite images
+        lrit_settings = {
+            'prj_dir': 'N',
+            'prj_lon': 135.,
+            'CFAC': 99560944,
+            'LFAC': 99440107,
+            'COFF': 540,
+            'LOFF': -420
+        }
+    lut = satellite_lut(w=w, h=h, offset=(0,0,0), meshsize=meshsize, basepos=basepos, lrit_settings=lrit_settings)
+    return ingest(src_dir, store_dir, lambda f: parse_satellite_lut(f, d=d, lut=lut, interpolation=interpolation), ext='.jpg',
+                  pyramid=pyramid)
+
+def ingest_generator(generator, pyramid=0):
+    '''
+    ingest the new files of the directory of a FileGenerator into its store,
+    with the directory as the generator resolves it (relative to this module)
+    :param generator: a RadarGenerator, Himawari8Generator or SatelliteGenerator with a store
+    :return: the FrameStore
+    '''
+    store = FrameStore(generator.store.dir)
+    if isinstance(generator, RadarGenerator):
+        parse = lambda f: parse_radar(f, w=0, h=0, offset=(0,0,0))
+    elif isinstance(generator, Himawari8Generator):
+        parse = lambda f: parse_himawari8(f, w=0, h=0, offset=(0,0,0))
+    elif isinstance(generator, SatelliteGenerator):
+        # the images are projected onto the grid of the store
+        if store.dims is None:
+            raise ValueError('the grid of {0} is unknown, ingest it with ingest_satellite() first'.format(store.dir))
+        lut = satellite_lut(w=store.dims[2], h=store.dims[1], offset=(0,0,0), meshsize=generator.meshsize,
+                            basepos=generator.basepos, lrit_settings=generator.lrit_settings)
+        parse = lambda f: parse_satellite_lut(f, d=generator.d, lut=lut, interpolation=generator.interpolation)
+    else:
+        raise NotImplementedError('Unknown generator: {0}'.format(type(generator).__name__))
+    return ingest(generator.dir, store.dir, parse, ext=generator.ext, pyramid=pyramid)
+
+if __name__ == '__main__':
+    ingest_radar()
+    ingest_himawari8()
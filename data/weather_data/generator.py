@@ -1,19 +1,98 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import glob
+import collections
 import time
 import calendar
+import hashlib
+import ConfigParser
 from datetime import datetime
 
 import math
 import numpy
-import theano
-import theano.tensor as T
 
 import csv
 from PIL import Image
 import lrit
 
+def default_floatX():
+    '''
+    the dtype of the generated frames, found without importing theano (which reads its configuration and takes
+    the lock of its compile directory, seconds at the start of every process):
+    $DATA_FLOATX, theano.config.floatX if theano is already imported, floatX of $THEANO_FLAGS or of the [global] section
+    of $THEANORC (~/.theanorc), or float64 (the default of theano)
+    '''
+    if 'DATA_FLOATX' in os.environ:
+        return os.environ['DATA_FLOATX']
+    if 'theano' in sys.modules:
+        return sys.modules['theano'].config.floatX
+    for flag in os.environ.get('THEANO_FLAGS', '').split(','):
+        key, _, value = flag.partition('=')
+        if key.strip() == 'floatX':
+            return value.strip()
+    config = ConfigParser.RawConfigParser()
+    config.read([os.path.expanduser(path) for path in os.environ.get('THEANORC', '~/.theanorc').split(os.pathsep)])
+    if config.has_option('global', 'floatX'):
+        return config.get('global', 'floatX')
+    return 'float64'
+
+# the dtype of the generated frames (see set_floatX)
+floatX = default_floatX()
+
+def set_floatX(dtype):
+    '''
+    set the dtype of the generated frames
+    :param dtype: 'float32' or 'float64'
+    '''
+    global floatX
+    floatX = dtype
+
+def ts2sec(timestamp):
+    '''
+    convert a timestamp to seconds since the epoch (UTC)
+    :param timestamp: フォーマット 'YYYYMMDD', 'YYYYMMDDhh', 'YYYYMMDDhhmm' or 'YYYYMMDDhhmmss' のタイムスタンプ
+    :return: seconds, or 0 for an unknown format
+    '''
+    fmt = {8: '%Y%m%d', 10: '%Y%m%d%H', 12: '%Y%m%d%H%M', 14: '%Y%m%d%H%M%S'}.get(len(timestamp))
+    if fmt is None:
+        return 0
+    return int(calendar.timegm(datetime.strptime(timestamp, fmt).timetuple()))
+
+def sec2ts(t, precision='sec'):
+    '''
+    convert seconds since the epoch (UTC) to a timestamp
+    :param t: seconds
+    :param precision: 'min' for 'YYYYMMDDhhmm' or 'sec' for 'YYYYMMDDhhmmss'
+    :return:
+    '''
+    stim = time.gmtime(t)
+    if precision == 'min':
+        return time.strftime("%Y%m%d%H%M", stim)
+    elif precision == 'sec':
+        return time.strftime("%Y%m%d%H%M%S", stim)
+    else:
+        raise NotImplementedError("Unknown precision: "+precision)
+
+def scan_timestamps(dir, ext):
+    '''
+    list the timestamps of the files named <timestamp><ext> in dir with a single directory scan
+    :param dir: directory
+    :param ext: the file extension
+    :return: sorted ndarray of the timestamps in seconds
+    '''
+    ts = []
+    for filename in os.listdir(dir) if os.path.isdir(dir) else []:
+        if not filename.endswith(ext):
+            continue
+        try:
+            t = ts2sec(filename[:-len(ext)])
+        except ValueError:
+            continue
+        if 0 < t:
+            ts.append(t)
+    return numpy.unique(numpy.asarray(ts, dtype=numpy.int64))
+
 def tsxrange(begin='20151001000000', end='20151031235730', step='0230', precision='sec'):
     '''
     timestamp range
@@ -25,14 +104,8 @@ def tsxrange(begin='20151001000000', end='20151031235730', step='0230', precisio
     '''
     assert precision in ['min','sec']
 
-    tbegin = int(calendar.timegm(datetime.strptime(begin, '%Y%m%d').timetuple()))       if (len(begin) == 8)  else \
-             int(calendar.timegm(datetime.strptime(begin, '%Y%m%d%H').timetuple()))     if (len(begin) == 10) else \
-             int(calendar.timegm(datetime.strptime(begin, '%Y%m%d%H%M').timetuple()))   if (len(begin) == 12) else \
-             int(calendar.timegm(datetime.strptime(begin, '%Y%m%d%H%M%S').timetuple())) if (len(begin) == 14) else 0
-    tend = int(calendar.timegm(datetime.strptime(end, '%Y%m%d').timetuple()))       if (len(end) == 8)  else \
-           int(calendar.timegm(datetime.strptime(end, '%Y%m%d%H').timetuple()))     if (len(end) == 10) else \
-           int(calendar.timegm(datetime.strptime(end, '%Y%m%d%H%M').timetuple()))   if (len(end) == 12) else \
-           int(calendar.timegm(datetime.strptime(end, '%Y%m%d%H%M%S').timetuple())) if (len(end) == 14) else 0
+    tbegin = ts2sec(begin)
+    tend = ts2sec(end)
 
     if precision == 'min':
         tstep = int(step)*60
@@ -45,68 +118,99 @@ def tsxrange(begin='20151001000000', end='20151031235730', step='0230', precisio
     assert 0 < tbegin and 0 < tend and 0 < tstep
 
     for t in xrange(tbegin, tend, tstep):
-        stim = time.gmtime(t)
-        if precision == 'min':
-            tim = time.strftime("%Y%m%d%H%M", stim)
-        elif precision == 'sec':
-            tim = time.strftime("%Y%m%d%H%M%S", stim)
-        else:
-            raise NotImplementedError("Unknown precision: "+precision)
-        yield tim
+        yield sec2ts(t, precision)
 
 def tsrange(begin='20151001000000', end='20151031235730', step='0230', precision='sec'):
     return [x for x in tsxrange(begin, end, step, precision)]
 
-def parse_radar(filepath, w, h, offset):
-    with open(filepath) as f:
-        reader = csv.reader(f)
-        datetime    = next(reader)  # ヘッダーの読み飛ばし
-        grid        = next(reader)  # ヘッダーの読み飛ばし
-        shape       = next(reader)  # ヘッダーの読み飛ばし
-        location    = next(reader)  # ヘッダーの読み飛ばし
-        range       = next(reader)  # ヘッダーの読み飛ばし
-
-        n_cols, n_rows = map(lambda x: int(x), grid)
-
-        w = w if 0 < w else n_cols
-        h = h if 0 < h else n_rows
-        w = w - offset[0] if n_cols < offset[0] + w else w
-        h = h - offset[1] if n_rows < offset[1] + h else h
+def _crop_size(n_cols, n_rows, w, h, offset):
+    '''
+    clip the crop size (w, h) at offset to the grid of (n_cols, n_rows)
+    '''
+    w = w if 0 < w else n_cols
+    h = h if 0 < h else n_rows
+    w = w - offset[0] if n_cols < offset[0] + w else w
+    h = h - offset[1] if n_rows < offset[1] + h else h
+    return w, h
 
-        data = numpy.zeros((1,h,w), dtype=theano.config.floatX)
+def parse_grid_csv(filepath, w, h, offset, n_headers, timeline=False):
+    '''
+    bulk parser of the grid csv files (radar, himawari8)
+    reads the header once, skips the rows above the crop without tokenizing them and decodes each row
+    of the crop with numpy's C tokenizer into a preallocated array. without timeline the rows below the crop are never read.
+    a file with timeline may hold several blocks of a timeline line and the grid, of which the last one is returned
+    (only the crop of the last block is decoded).
+    each row is decoded by one call which stops after the last column of the crop: one call over the joined rows
+    would tokenize the columns right of the crop as well, and is not faster since the conversion of the values dominates
+    :param filepath: path to the csv file
+    :param w: width of the crop (0 for the whole grid)
+    :param h: height of the crop (0 for the whole grid)
+    :param offset: offsets of (x, y, ...)
+    :param n_headers: number of header lines, the second one is the grid size 'n_cols,n_rows'
+    :param timeline: True if a timeline line precedes each grid block (radar)
+    :return: ndarray of shape (1,h,w)
+    '''
+    with open(filepath) as f:
+        header = [f.readline() for _ in xrange(n_headers)]
+        n_cols, n_rows = map(lambda x: int(x), header[1].split(',')[:2])
+        w, h = _crop_size(n_cols, n_rows, w, h, offset)
+
+        if timeline:
+            data = numpy.zeros((1,h,w), dtype=floatX)
+            lines = None
+            while f.readline():
+                for _ in xrange(offset[1]):
+                    f.readline()
+                lines = [f.readline() for _ in xrange(h)]
+                for _ in xrange(n_rows - offset[1] - h):
+                    f.readline()
+        else:
+            data = numpy.empty((1,h,w), dtype=floatX)
+            for _ in xrange(offset[1]):
+                f.readline()
+            lines = [f.readline() for _ in xrange(h)]
 
-        for timeline in reader:
-            for row in xrange(n_rows):
-                line = next(reader)
-                if offset[1] <= row and row < h:
-                    data[0,row,:] = map(lambda x: float(x), line[offset[0]:offset[0]+w])
+        if lines is not None:
+            for row, line in enumerate(lines):
+                data[0,row,:] = numpy.fromstring(line, dtype=data.dtype, sep=',', count=offset[0]+w)[offset[0]:]
 
     return data
 
-def parse_himawari8(filepath, w, h, offset):
+def parse_grid_csv_reference(filepath, w, h, offset, n_headers, timeline=False):
+    '''
+    csv.reader based parser of the grid csv files, kept as the reference of parse_grid_csv()
+    '''
     with open(filepath) as f:
         reader = csv.reader(f)
-        datetime    = next(reader)  # ヘッダーの読み飛ばし
-        grid        = next(reader)  # ヘッダーの読み飛ばし
-        shape       = next(reader)  # ヘッダーの読み飛ばし
-        location    = next(reader)  # ヘッダーの読み飛ばし
-
-        n_cols, n_rows = map(lambda x: int(x), grid)
+        header = [next(reader) for _ in xrange(n_headers)]
+        n_cols, n_rows = map(lambda x: int(x), header[1][:2])
+        w, h = _crop_size(n_cols, n_rows, w, h, offset)
 
-        w = w if 0 < w else n_cols
-        h = h if 0 < h else n_rows
-        w = w - offset[0] if n_cols < offset[0] + w else w
-        h = h - offset[1] if n_rows < offset[1] + h else h
+        data = numpy.zeros((1,h,w), dtype=floatX)
 
-        data = numpy.zeros((1,h,w), dtype=theano.config.floatX)
+        def read_block():
+            for row in xrange(n_rows):
+                line = next(reader)
+                if offset[1] <= row and row < offset[1] + h:
+                    data[0,row-offset[1],:] = map(lambda x: float(x), line[offset[0]:offset[0]+w])
 
-        for row in xrange(n_rows):
-            line = next(reader)
-            if offset[1] <= row and row < h:
-                data[0,row,:] = map(lambda x: float(x), line[offset[0]:offset[0]+w])
+        if timeline:
+            # every block overwrites the data, so that the last one is kept
+            for _ in reader:
+                read_block()
+        else:
+            read_block()
 
     return data
 
+def parse_radar(filepath, w, h, offset):
+    # header: datetime, grid, shape, location, range, followed by a timeline and the grid
+    return parse_grid_csv(filepath, w, h, offset, n_headers=5, timeline=True)
+
+def parse_himawari8(filepath, w, h, offset):
+    # header: datetime, grid, shape, location, followed by the grid
+    return parse_grid_csv(filepath, w, h, offset, n_headers=4)
+
 def parse_satellite(filepath, w, h, d, offset, meshsize, basepos, lrit_settings):
     img = Image.open(filepath)
 
@@ -136,15 +240,15 @@ def parse_satellite(filepath, w, h, d, offset, meshsize, basepos, lrit_settings)
 
         if d == 1:
             intensity = (r/255.+g/255.+g/255.)/3.
-            return numpy.asarray([intensity], dtype=theano.config.floatX)
+            return numpy.asarray([intensity], dtype=floatX)
         elif d == 3:
-            return numpy.asarray([r, g, b], dtype=theano.config.floatX)
+            return numpy.asarray([r, g, b], dtype=floatX)
         else:
             raise NotImplementedError
 
     o = -1 if lrit_settings['prj_dir'] == 'N' else 1
 
-    data = numpy.zeros((d, h, w), dtype=theano.config.floatX)
+    data = numpy.zeros((d, h, w), dtype=floatX)
     for j in xrange(h):
         for i in xrange(w):
             data[:,j,i] = getval(
@@ -154,6 +258,99 @@ def parse_satellite(filepath, w, h, d, offset, meshsize, basepos, lrit_settings)
 
     return data
 
+def satellite_lut(w, h, offset, meshsize, basepos, lrit_settings, cachedir=None):
+    '''
+    compute the map from the (h, w) grid to the image coordinates (c, l) of the satellite images.
+    it does not depend on the frame, so it is computed once for the settings and cached in cachedir
+    :param w: width of the grid
+    :param h: height of the grid
+    :param offset: offsets of (x, y, ...)
+    :param meshsize: the size of each cell in the grid (unit: sec)
+    :param basepos: the lat long position of the northwest to extract (unit: sec)
+    :param lrit_settings: the LRIT settings of the images
+    :param cachedir: the directory to cache the map in, or None not to cache
+    :return: a dict of 'cl': ndarray of shape (2, h, w) of (c, l) before rounding,
+                       'nearest': ndarray of shape (2, h, w) of (c, l) rounded as lrit.xy2cl()
+    '''
+    key = repr((w, h, tuple(offset[:2]), tuple(meshsize), tuple(basepos), sorted(lrit_settings.items())))
+    cachefile = None
+    if cachedir is not None:
+        cachefile = os.path.join(cachedir, 'lut-{0}.npz'.format(hashlib.md5(key).hexdigest()))
+        if os.path.isfile(cachefile):
+            f = numpy.load(cachefile)
+            return {'cl': f['cl'], 'nearest': f['nearest']}
+
+    o = -1 if lrit_settings['prj_dir'] == 'N' else 1
+
+    # positions of the cells in secs
+    lon = basepos[0] +   (offset[0]+numpy.arange(w, dtype=numpy.int64))*meshsize[0]
+    lat = basepos[1] + o*(offset[1]+numpy.arange(h, dtype=numpy.int64))*meshsize[1]
+
+    x,y = lrit.lonlat2xy_array(
+        prj_dir=lrit_settings['prj_dir'],
+        prj_lon=lrit_settings['prj_lon'],
+        lon=(lon/3600.)[None,:],
+        lat=(lat/3600.)[:,None],
+    )
+    x,y = numpy.broadcast_arrays(x,y)
+    kwargs = {
+        'cfac': lrit_settings['CFAC'],
+        'lfac': lrit_settings['LFAC'],
+        'coff': lrit_settings['COFF'],
+        'loff': lrit_settings['LOFF'],
+        'x': x,
+        'y': y
+    }
+    nearest = numpy.asarray(lrit.xy2cl_array(nint=True, **kwargs))
+    cl = numpy.asarray(lrit.xy2cl_array(nint=False, **kwargs))
+
+    if cachefile is not None:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        numpy.savez(cachefile, cl=cl, nearest=nearest, key=key)
+
+    return {'cl': cl, 'nearest': nearest}
+
+def parse_satellite_lut(filepath, d, lut, interpolation='nearest'):
+    '''
+    parse a satellite image with the map made by satellite_lut(), gathering all the pixels at once
+    :param filepath: path to the image
+    :param d: 1 for grayscale or 3 for rgb
+    :param lut: the map returned by satellite_lut()
+    :param interpolation: 'nearest' (same as parse_satellite()) or 'bilinear'
+    :return: ndarray of shape (d, h, w)
+    '''
+    assert interpolation in ['nearest', 'bilinear']
+
+    img = numpy.asarray(Image.open(filepath).convert('RGB'))
+    n_lines, n_cols = img.shape[0], img.shape[1]
+
+    if interpolation == 'nearest':
+        c, l = lut['nearest']
+        if c.min() < 0 or n_cols <= c.max() or l.min() < 0 or n_lines <= l.max():
+            raise IndexError('image index out of range')
+        rgb = img[l, c].astype(numpy.float64)
+    else:
+        cf, lf = lut['cl']
+        if cf.min() < 0 or n_cols-1 < cf.max() or lf.min() < 0 or n_lines-1 < lf.max():
+            raise IndexError('image index out of range')
+        c0 = numpy.minimum(numpy.floor(cf).astype(numpy.int64), n_cols-2)
+        l0 = numpy.minimum(numpy.floor(lf).astype(numpy.int64), n_lines-2)
+        ac = (cf - c0)[:,:,None]
+        al = (lf - l0)[:,:,None]
+        rgb = (1-al) * ((1-ac) * img[l0, c0]   + ac * img[l0, c0+1]) \
+            +    al  * ((1-ac) * img[l0+1, c0] + ac * img[l0+1, c0+1])
+
+    if d == 1:
+        r, g = rgb[:,:,0], rgb[:,:,1]
+        data = ((r/255.+g/255.+g/255.)/3.)[None,:,:]
+    elif d == 3:
+        data = rgb.transpose(2,0,1)
+    else:
+        raise NotImplementedError
+
+    return numpy.asarray(data, dtype=floatX)
+
 class Generator(object):
     def __init__(self, w=10, h=10, d=1):
         self.w = w
@@ -187,7 +384,7 @@ class ConstantGenerator(Generator):
                 ] for k in xrange(self.d)
             ]
 
-        return numpy.asarray(data, dtype=theano.config.floatX)
+        return numpy.asarray(data, dtype=floatX)
 
 class SinGenerator(Generator):
     def __init__(self, w=10, h=10, d=1):
@@ -206,49 +403,139 @@ class SinGenerator(Generator):
                 ] for k in xrange(self.d)
             ]
 
-        return numpy.asarray(data, dtype=theano.config.floatX)
+        return numpy.asarray(data, dtype=floatX)
 
-class RadarGenerator(Generator):
-    def __init__(self, dir, w=0, h=0, offset=(0,0,0), begin='201408010000', end='201408312355', step='5'):
+def read_file(parse, filepath, *args):
+    '''
+    parse a file with parse(filepath, *args), raising IOError if the file does not exist
+    '''
+    if not os.path.isfile(filepath):
+        raise IOError("file not found: {0}".format(filepath))
+
+    return parse(filepath, *args)
+
+class FileGenerator(Generator):
+    '''
+    base of the generators which read a frame of each timestamp in self.timestamps,
+    either from a FrameStore (self.store) or from the file given by task()
+    '''
+    def next_timestamp(self):
+        super(FileGenerator, self).next()
+
+        self.i = self.i + 1
+        if self.i >= len(self.timestamps):
+            print('{0}: no more files to read, last timestamp={1}'.format(type(self).__name__, self.timestamps[-1]))
+            raise StopIteration
+
+        return self.timestamps[self.i]
+
+    def available(self):
+        '''
+        :return: sorted ndarray of the timestamps (in seconds) which can be read
+        '''
+        if self.store is not None:
+            return self.store.timestamps
+        return scan_timestamps(self.dir, self.ext)
+
+    def task(self, timestamp):
+        '''
+        the function to read the file of timestamp, which can also be run in another process
+        :param timestamp:
+        :return: a tuple of (function, args)
+        '''
+        raise NotImplementedError
+
+    def read(self, timestamp):
+        if self.store is not None:
+            return self.store.crop(timestamp, w=self.w, h=self.h, offset=self.offset)
+
+        func, args = self.task(timestamp)
+        return func(*args)
+
+    def next(self):
+        return self.read(self.next_timestamp())
+
+class PrefetchGenerator(object):
+    def __init__(self, generator, pool, depth=8):
+        '''
+        read ahead the frames of a FileGenerator in a pool of workers.
+        the frames, the errors (IOError for missing files) and StopIteration come in the same order as generator.next()
+        :param generator: an instance of FileGenerator
+        :param pool: a multiprocessing.Pool or multiprocessing.pool.ThreadPool
+        :param depth: how many frames to read ahead
+        :return:
+        '''
+        assert 0 < depth
+        self.generator = generator
+        self.pool = pool
+        self.depth = depth
+        self.queue = collections.deque()
+        self.exhausted = False
+
+    def __getattr__(self, name):
+        return getattr(self.generator, name)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while len(self.queue) < self.depth and not self.exhausted:
+            try:
+                timestamp = self.generator.next_timestamp()
+            except StopIteration:
+                self.exhausted = True
+                break
+
+            if self.generator.store is not None:
+                # reading from the store is only slicing
+                self.queue.append(timestamp)
+            else:
+                func, args = self.generator.task(timestamp)
+                self.queue.append(self.pool.apply_async(func, args))
+
+        if len(self.queue) == 0:
+            raise StopIteration
+
+        item = self.queue.popleft()
+        if isinstance(item, basestring):
+            return self.generator.read(item)
+        return item.get()
+
+class RadarGenerator(FileGenerator):
+    ext = '.csv'
+    precision = 'min'
+
+    def __init__(self, dir, w=0, h=0, offset=(0,0,0), begin='201408010000', end='201408312355', step='5', store=None):
         '''
 
         :param dir:
         :param w:
         :param h:
         :param offset: offsets of (x, y, timestep)
+        :param store: a FrameStore to read the frames from instead of the files in dir
         :return:
         '''
         super(RadarGenerator, self).__init__(w=w, h=h, d=1)
         dir = os.path.join(os.path.dirname(__file__), dir)
         self.dir = dir
         self.offset = offset
+        self.store = store
 
         self.i = -1
         self.i += offset[2]
 
-        self.timestamps = tsrange(begin, end, step, 'min')
+        self.timestamps = tsrange(begin, end, step, self.precision)
 
-    def next(self):
-        super(RadarGenerator, self).next()
-
-        self.i = self.i + 1
-        if self.i >= len(self.timestamps):
-            print('RadarGenerator: no more files to read, last timestamp={0}'.format(self.timestamps[-1]))
-            raise StopIteration
-
-        timestamp = self.timestamps[self.i]
-        filename = timestamp+'.csv'
-        filepath = os.path.join(self.dir, filename)
-
-        if not os.path.isfile(filepath):
-            raise IOError("file not found: {0}".format(filepath))
-
-        data = parse_radar(filepath, w=self.w, h=self.h, offset=self.offset)
+    def task(self, timestamp):
+        filepath = os.path.join(self.dir, timestamp+self.ext)
+        return (read_file, (parse_radar, filepath, self.w, self.h, self.offset))
 
-        return data
+class SatelliteGenerator(FileGenerator):
+    ext = '.jpg'
+    precision = 'min'
 
-class SatelliteGenerator(Generator):
-    def __init__(self, dir, w=10, h=10, offset=(0,0,0), meshsize=(45,30), basepos=(491400,127800), begin='201408010000', end='201408312330', step='30', mode='grayscale'):
+    def __init__(self, dir, w=10, h=10, offset=(0,0,0), meshsize=(45,30), basepos=(491400,127800), begin='201408010000', end='201408312330', step='30', mode='grayscale', store=None,
+                 interpolation='nearest', lutdir='lut'):
         '''
 
         :param dir:
@@ -258,6 +545,9 @@ class SatelliteGenerator(Generator):
         :param meshsize: the size of each cell in the grid (unit: sec)
         :param basepos: the lat long position of the northwest to extract (unit: sec)
         :param mode: 'grayscale' or 'rgb'
+        :param store: a FrameStore of the images projected at basepos to read the frames from instead of the files in dir
+        :param interpolation: 'nearest' or 'bilinear' sampling of the images
+        :param lutdir: the directory (relative to dir) to cache the map from the grid to the images, None not to cache
         :return:
         '''
         # setting for POLAR(N,135) satellite images
@@ -282,71 +572,141 @@ class SatelliteGenerator(Generator):
         self.offset = offset
         self.meshsize = meshsize
         self.basepos = basepos
+        self.store = store
+        self.interpolation = interpolation
+        self.lutdir = None if lutdir is None else os.path.join(dir, lutdir)
+        self.lut = None
 
         self.i = -1
         self.i += offset[2]
 
-        self.timestamps = tsrange(begin, end, step, 'min')
+        self.timestamps = tsrange(begin, end, step, self.precision)
 
-    def next(self):
-        super(SatelliteGenerator, self).next()
-
-        self.i = self.i + 1
-        if self.i >= len(self.timestamps):
-            print('SatelliteGenerator: no more files to read, last timestamp={0}'.format(self.timestamps[-1]))
-            raise StopIteration
-
-        timestamp = self.timestamps[self.i]
-        filename = timestamp+".jpg"
-        filepath = os.path.join(self.dir, filename)
+    def task(self, timestamp):
+        filepath = os.path.join(self.dir, timestamp+self.ext)
 
-        if not os.path.isfile(filepath):
-            raise IOError("file not found: {0}".format(filepath))
+        if self.lut is None:
+            self.lut = satellite_lut(w=self.w, h=self.h, offset=self.offset, meshsize=self.meshsize,
+                                     basepos=self.basepos, lrit_settings=self.lrit_settings, cachedir=self.lutdir)
 
-        data = parse_satellite(filepath, w=self.w, h=self.h, d=self.d,
-                               offset=self.offset, meshsize=self.meshsize,
-                               basepos=self.basepos, lrit_settings=self.lrit_settings)
+        return (read_file, (parse_satellite_lut, filepath, self.d, self.lut, self.interpolation))
 
-        return data
+class Himawari8Generator(FileGenerator):
+    ext = '.csv'
+    precision = 'sec'
 
-class Himawari8Generator(Generator):
-    def __init__(self, dir, w=0, h=0, offset=(0,0,0), begin='20151001000000', end='20151031235730', step='0230'):
+    def __init__(self, dir, w=0, h=0, offset=(0,0,0), begin='20151001000000', end='20151031235730', step='0230', store=None):
         '''
 
         :param dir:
         :param w:
         :param h:
         :param offset: offsets of (x, y, timestep)
+        :param store: a FrameStore to read the frames from instead of the files in dir
         :return:
         '''
         super(Himawari8Generator, self).__init__(w=w, h=h, d=1)
         dir = os.path.join(os.path.dirname(__file__), dir)
         self.dir = dir
         self.offset = offset
+        self.store = store
 
         self.i = -1
         self.i += offset[2]
 
-        self.timestamps = tsrange(begin, end, step, 'sec')
+        self.timestamps = tsrange(begin, end, step, self.precision)
 
-    def next(self):
-        super(Himawari8Generator, self).next()
+    def task(self, timestamp):
+        filepath = os.path.join(self.dir, timestamp+self.ext)
+        return (read_file, (parse_himawari8, filepath, self.w, self.h, self.offset))
 
-        self.i = self.i + 1
-        if self.i >= len(self.timestamps):
-            print('Himawari8Generator: no more files to read, last timestamp={0}'.format(self.timestamps[-1]))
-            raise StopIteration
+def bench_parse_grid_csv(n_cols=1000, n_rows=1000, w=0, h=0, offset=(0,0,0), repeat=3):
+    '''
+    compare parse_grid_csv() with the csv.reader based parser on a synthetic radar csv
+    '''
+    import tempfile
+    import timeit
+
+    rng = numpy.random.RandomState(1000)
+    grid = rng.uniform(0, 100, (n_rows, n_cols)).round(2)
+
+    fd, filepath = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w') as f:
+        f.write('20140801000000\n')
+        f.write('{0},{1}\n'.format(n_cols, n_rows))
+        f.write('shape\n')
+        f.write('location\n')
+        f.write('range\n')
+        f.write('201408010000\n')
+        for row in grid:
+            f.write(','.join(map(str, row)) + '\n')
+
+    try:
+        bulk = parse_grid_csv(filepath, w, h, offset, n_headers=5, timeline=True)
+        ref = parse_grid_csv_reference(filepath, w, h, offset, n_headers=5, timeline=True)
+        assert numpy.array_equal(bulk, ref)
+
+        t_bulk = min(timeit.repeat(lambda: parse_grid_csv(filepath, w, h, offset, n_headers=5, timeline=True), number=1, repeat=repeat))
+        t_ref = min(timeit.repeat(lambda: parse_grid_csv_reference(filepath, w, h, offset, n_headers=5, timeline=True), number=1, repeat=repeat))
+    finally:
+        os.remove(filepath)
+
+    print('parse {0}x{1} csv, crop={2}: csv.reader {3:.4f} sec, bulk {4:.4f} sec ({5:.1f}x)'
+          .format(n_cols, n_rows, bulk.shape, t_ref, t_bulk, t_ref / t_bulk))
+    return t_ref, t_bulk
+
+def bench_parse_satellite(w=120, h=120, d=1, repeat=3):
+    '''
+    compare parse_satellite_lut() with parse_satellite() on a synthetic satellite image
+    '''
+    import tempfile
+    import timeit
+
+    lrit_settings = {'prj_dir': 'N', 'prj_lon': 135., 'CFAC': 99560944, 'LFAC': 99440107, 'COFF': 540, 'LOFF': -420}
+    args = {'w': w, 'h': h, 'offset': (0,0,0), 'meshsize': (45,30), 'basepos': (491400,127800)}
+
+    rng = numpy.random.RandomState(1000)
+    fd, filepath = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    Image.fromarray(rng.randint(0, 256, (1200, 1200, 3)).astype(numpy.uint8), 'RGB').save(filepath)
 
-        timestamp = self.timestamps[self.i]
-        filename = timestamp+'.csv'
-        filepath = os.path.join(self.dir, filename)
+    try:
+        t_lut = timeit.default_timer()
+        lut = satellite_lut(lrit_settings=lrit_settings, **args)
+        t_lut = timeit.default_timer() - t_lut
 
-        if not os.path.isfile(filepath):
-            raise IOError("file not found: {0}".format(filepath))
+        ref = parse_satellite(filepath, d=d, lrit_settings=lrit_settings, **args)
+        assert numpy.allclose(parse_satellite_lut(filepath, d=d, lut=lut), ref)
 
-        data = parse_himawari8(filepath, w=self.w, h=self.h, offset=self.offset)
+        t_ref = min(timeit.repeat(lambda: parse_satellite(filepath, d=d, lrit_settings=lrit_settings, **args), number=1, repeat=repeat))
+        t_nearest = min(timeit.repeat(lambda: parse_satellite_lut(filepath, d=d, lut=lut), number=1, repeat=repeat))
+        t_bilinear = min(timeit.repeat(lambda: parse_satellite_lut(filepath, d=d, lut=lut, interpolation='bilinear'), number=1, repeat=repeat))
+    finally:
+        os.remove(filepath)
 
-        return data
+    print('parse {0}x{1} satellite: per pixel {2:.4f} sec, lut (once) {3:.4f} sec, nearest {4:.4f} sec, bilinear {5:.4f} sec'
+          .format(w, h, t_ref, t_lut, t_nearest, t_bilinear))
+    return t_ref, t_nearest, t_bilinear
+
+def bench_startup(modules=('generator', 'framestore', 'weatherdata'), repeat=3):
+    '''
+    measure the time to start a python process which imports each module, like a worker of the ingest or the generation,
+    against a process which imports theano. the modules must not import theano
+    '''
+    import subprocess
+    import timeit
+
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def start(statement):
+        return min(timeit.repeat(lambda: subprocess.check_call([sys.executable, '-c', statement], cwd=cwd), number=1, repeat=repeat))
+
+    t_python = start('pass')
+    for module in modules:
+        t = start("import sys, {0}; assert 'theano' not in sys.modules".format(module))
+        print('import {0}: {1:.3f} sec ({2:.3f} sec over python)'.format(module, t, t - t_python))
+    t = start('import theano')
+    print('import theano: {0:.3f} sec ({1:.3f} sec over python)'.format(t, t - t_python))
 
 def test_satellite_generator():
     gen = SatelliteGenerator('../eisei_PS01IR1', w=120, h=120)
@@ -364,4 +724,10 @@ def test_satellite_generator():
         print('{0}: {1}'.format(i, sat))
 
 if __name__ == '__main__':
-    test_satellite_generator()
\ No newline at end of file
+    if 1 < len(sys.argv) and sys.argv[1] == 'bench':
+        # python generator.py bench: the benchmarks of the parsers and of the startup
+        bench_parse_grid_csv()
+        bench_parse_satellite()
+        bench_startup()
+    else:
+        test_satellite_generator()
\ No newline at end of file
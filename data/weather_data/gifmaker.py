@@ -46,6 +46,8 @@ from PIL import Image, ImageChops
 
 from PIL.GifImagePlugin import getheader, getdata
 
+import multiprocessing
+
 import numpy
 # --------------------------------------------------------------------
 # sequence iterator
@@ -133,15 +135,99 @@ def compress(infile, outfile):
     fp.close()
 
 
+def to_uint8(frames):
+    """Quantize frames in [0,1] to uint8 in one pass, the same as converting
+    them to PIL "F" images of frames * 255 and then to "L" (clipped and
+    truncated, NaN to 0)"""
+
+    x = numpy.multiply(frames, 255, dtype=numpy.float32)
+    numpy.fmax(x, 0, out=x)
+    numpy.fmin(x, 255, out=x)
+    return x.astype(numpy.uint8)
+
+
+def getbbox(delta):
+    """Bounding box (left, upper, right, lower) of the nonzero pixels of a
+    2d array, or None, like Image.getbbox"""
+
+    rows = delta.any(axis=1)
+    cols = delta.any(axis=0)
+    if not rows.any():
+        return None
+    return (int(cols.argmax()), int(rows.argmax()),
+            len(cols) - int(cols[::-1].argmax()), len(rows) - int(rows[::-1].argmax()))
+
+
+def makedelta_arrays(fp, frames):
+    """Convert uint8 array of shape (n_frames, height, width) to a GIF
+    animation file. Same output as makedelta, with the delta frames
+    computed on the arrays"""
+
+    previous = None
+
+    for frame in frames:
+
+        im = Image.fromarray(frame, "L")
+
+        if previous is None:
+
+            # global header
+            for s in getheader(im)[0] + getdata(im):
+                fp.write(s)
+
+        else:
+
+            # delta frame
+            bbox = getbbox(frame != previous)
+
+            if bbox:
+
+                # compress difference
+                for s in getdata(im.crop(bbox), offset=bbox[:2]):
+                    fp.write(s)
+
+        previous = frame
+
+    fp.write(";")
+
+    return len(frames)
+
+
 def save_gif(single_seq, fname):
-    img_seq = []
-    for img in single_seq:
-        img_seq.append(Image.fromarray(img * 255, 'F').convert("L"))
     fp = open(fname, "wb")
-    makedelta(fp, img_seq)
+    makedelta_arrays(fp, to_uint8(single_seq))
     fp.close()
 
 
+def _save_gif(args):
+    save_gif(*args)
+    return args[1]
+
+
+class GifRenderer:
+    """Render GIF previews in a pool of worker processes, so that the
+    caller does not wait for them. processes=0 renders them in the caller.
+    Call close() to wait until every preview is written"""
+
+    def __init__(self, processes=None):
+        self.pool = None if processes == 0 else multiprocessing.Pool(processes)
+        self.results = []
+
+    def submit(self, single_seq, fname):
+        if self.pool is None:
+            self.results.append(_save_gif((single_seq, fname)))
+        else:
+            self.results.append(self.pool.apply_async(_save_gif, ((numpy.asarray(single_seq), fname),)))
+
+    def close(self):
+        """Wait for the previews. Returns the file names written"""
+        if self.pool is None:
+            return self.results
+        self.pool.close()
+        self.pool.join()
+        return [result.get() for result in self.results]
+
+
 if __name__ == "__main__":
 
     import sys
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import collections
+
+import numpy
+
+from generator import ts2sec, sec2ts
+
+'''
+time-indexed join of the weather sources on a target clock
+'''
+
+def align(times, timestamps, method='linear', tolerance=0, max_gap=None):
+    '''
+    resample the sorted timestamps of a source to the times of the target clock.
+    the frame at times[k] is (1 - a[k]) * frames[i0[k]] + a[k] * frames[i1[k]] if valid[k]
+    :param times: sorted ndarray of the target times (in seconds)
+    :param timestamps: sorted ndarray of the timestamps of the source (in seconds)
+    :param method: 'nearest' for the nearest frame within tolerance,
+                   'linear' for the frame within tolerance or the linear interpolation of the frames around the time
+    :param tolerance: seconds within which a frame of the source is taken as the frame of the time
+    :param max_gap: the longest gap (in seconds) between two frames to interpolate over ('linear'), None for any gap
+    :return: i0, i1, a, valid (the gap mask)
+    '''
+    assert method in ['nearest', 'linear']
+    times = numpy.asarray(times, dtype=numpy.int64)
+    timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+    n = len(timestamps)
+    if n == 0:
+        zeros = numpy.zeros(times.shape, dtype=numpy.int64)
+        return zeros, zeros, numpy.zeros(times.shape), numpy.zeros(times.shape, dtype=bool)
+
+    # the frames before and after each time
+    i1 = numpy.searchsorted(timestamps, times, side='left')
+    i0 = i1 - 1
+    before = 0 <= i0
+    after = i1 < n
+    t0 = timestamps[numpy.clip(i0, 0, n-1)]
+    t1 = timestamps[numpy.clip(i1, 0, n-1)]
+
+    # the nearest frame within tolerance
+    d0 = numpy.where(before, times - t0, numpy.iinfo(numpy.int64).max)
+    d1 = numpy.where(after, t1 - times, numpy.iinfo(numpy.int64).max)
+    nearest = numpy.where(d1 <= d0, i1, i0)
+    matched = numpy.minimum(d0, d1) <= tolerance
+
+    i0 = numpy.clip(i0, 0, n-1)
+    i1 = numpy.clip(i1, 0, n-1)
+    a = numpy.zeros(times.shape)
+    if method == 'nearest':
+        return nearest, nearest, a, matched
+
+    between = before & after & ~matched
+    if max_gap is not None:
+        between &= t1 - t0 <= max_gap
+    a[between] = (times - t0)[between] / (t1 - t0)[between].astype(numpy.float64)
+    return numpy.where(matched, nearest, i0), numpy.where(matched, nearest, i1), a, matched | between
+
+class SourceIndex(object):
+    def __init__(self, generator, times, method='linear', tolerance=0, max_gap=None, cachesize=64):
+        '''
+        a source resampled to the target clock
+        :param generator: a FileGenerator, whose available() timestamps are read by read() (or from its store)
+        :param times: sorted ndarray of the target times (in seconds)
+        :param cachesize: number of frames read from the files to keep for the overlapping reads
+        :return:
+        '''
+        self.generator = generator
+        self.timestamps = generator.available()
+        self.i0, self.i1, self.a, self.valid = align(times, self.timestamps, method, tolerance, max_gap)
+        # the times whose frames are frames of the source as they are
+        self.exact = (self.a == 0) & (self.i0 == self.i1)
+        self.cachesize = cachesize
+        self.cache = collections.OrderedDict()
+
+    @property
+    def passthrough(self):
+        # every valid time of the target clock is a frame of the source
+        return numpy.all(self.exact[self.valid])
+
+    def _crop(self):
+        g = self.generator
+        d, height, width = g.store.frames.shape[1:]
+        w = g.w if 0 < g.w else width
+        h = g.h if 0 < g.h else height
+        return slice(g.offset[1], g.offset[1] + h), slice(g.offset[0], g.offset[0] + w)
+
+    def rows(self, rows):
+        '''
+        :param rows: sorted ndarray of the indices of the frames in self.timestamps
+        :return: ndarray of shape (len(rows), d, h, w) of the frames
+        '''
+        store = self.generator.store
+        if store is not None:
+            ys, xs = self._crop()
+            return store.frames[rows, :, ys, xs]
+
+        frames = []
+        for row in rows:
+            t = self.timestamps[row]
+            if t not in self.cache:
+                self.cache[t] = self.generator.read(sec2ts(t, self.generator.precision))
+                while self.cachesize < len(self.cache):
+                    self.cache.popitem(last=False)
+            frames.append(self.cache[t])
+        return numpy.asarray(frames)
+
+    def frames(self, start, stop):
+        '''
+        the frames of the target times [start, stop), interpolated at once.
+        a range of the target clock on the frames of a store is returned as a view of the store (no copy)
+        :return: ndarray of shape (stop - start, d, h, w). the frames of the invalid times are undefined
+        '''
+        i0, i1, a, valid = self.i0[start:stop], self.i1[start:stop], self.a[start:stop], self.valid[start:stop]
+        if self.generator.store is not None and numpy.all(self.exact[start:stop]) and \
+                numpy.array_equal(i0, numpy.arange(i0[0], i0[0] + len(i0)) if 0 < len(i0) else i0):
+            ys, xs = self._crop()
+            return self.generator.store.frames[i0[0]:i0[0]+len(i0), :, ys, xs]
+
+        rows = numpy.unique(numpy.concatenate([i0[valid], i1[valid & (0 < a)]]))
+        if len(rows) == 0:
+            return numpy.zeros((stop - start,) + tuple(self.generator.dim), dtype=numpy.float32)
+        data = self.rows(rows)
+        f0 = data[numpy.searchsorted(rows, numpy.where(valid, i0, rows[0]))]
+        interpolated = valid & (0 < a)
+        if numpy.any(interpolated):
+            k = numpy.flatnonzero(interpolated)
+            w = a[k].reshape((-1, 1, 1, 1)).astype(numpy.float32)
+            f0[k] = (1 - w) * f0[k] + w * data[numpy.searchsorted(rows, i1[k])]
+        return f0
+
+class Join(object):
+    def __init__(self, generators, begin, end, step, offset=0, method='linear', tolerance=0, max_gaps=None):
+        '''
+        join the sources on a target clock from their sorted timestamp indices.
+        each source is resampled to the clock by its own timestamps, so the sources need not share
+        the step or the start time of the clock
+        :param generators: a list of FileGenerator of the sources (the channels of the frames in this order)
+        :param begin: the first time of the clock (a timestamp string)
+        :param end: the end of the clock (excluded)
+        :param step: the step of the clock in minutes
+        :param offset: number of times to skip from begin
+        :param method: 'nearest' or 'linear' (see align)
+        :param tolerance: seconds within which a frame of a source is taken as the frame of a time
+        :param max_gaps: the longest gap (in seconds) to interpolate over for each source, or None for any gap
+        :return:
+        '''
+        tbegin = ts2sec(begin)
+        tend = ts2sec(end)
+        self.times = numpy.arange(tbegin, tend, int(step * 60), dtype=numpy.int64)[offset:]
+        max_gaps = [None] * len(generators) if max_gaps is None else max_gaps
+        self.sources = [SourceIndex(g, self.times, method, tolerance, max_gap) for g, max_gap in zip(generators, max_gaps)]
+        self.valid = numpy.ones(self.times.shape, dtype=bool)
+        for source in self.sources:
+            self.valid &= source.valid
+
+    def __len__(self):
+        return len(self.times)
+
+    def missing(self):
+        '''
+        :return: the timestamps (in seconds) of the target clock which can not be generated
+        '''
+        return self.times[~self.valid]
+
+    def windows(self, n_timesteps):
+        '''
+        every window of n_timesteps consecutive valid timestamps
+        :param n_timesteps: length of the windows
+        :return: ndarray of the indices (in self.times) of the first timestamps of the windows
+        '''
+        if len(self.times) < n_timesteps:
+            return numpy.zeros((0,), dtype=numpy.int64)
+        n_valid = numpy.concatenate(([0], numpy.cumsum(self.valid)))
+        return numpy.flatnonzero(n_valid[n_timesteps:] - n_valid[:-n_timesteps] == n_timesteps)
+
+    def frames(self, start, stop):
+        '''
+        :return: float32 ndarray of shape (stop - start, n_feature_maps, height, width) of the sources
+                 at the times [start, stop). the frames of the invalid times (~self.valid) are undefined.
+                 the frames of a single source are returned as they are (a view of its store if it is on the clock),
+                 and the frames of several sources are copied once into the channels of one block
+        '''
+        if len(self.sources) == 1:
+            return numpy.asarray(self.sources[0].frames(start, stop), dtype=numpy.float32)
+        # one copy of each source into the channels of the block (asarray does not copy float32 frames)
+        return numpy.concatenate([numpy.asarray(source.frames(start, stop), dtype=numpy.float32) for source in self.sources], axis=1)
+
+def bench_join(n_frames=2000, d=1, h=120, w=120, window=20):
+    '''
+    compare reading windows of the target clock frame by frame with the vectorized join,
+    for a source on the clock (passed through) and a source of twice the step (interpolated)
+    '''
+    import timeit
+
+    class Store(object):
+        def __init__(self, timestamps):
+            self.timestamps = timestamps
+            self.frames = numpy.random.RandomState(1000).rand(len(timestamps), d, h, w).astype(numpy.float32)
+
+    class Source(object):
+        precision = 'min'
+        def __init__(self, step):
+            self.store = Store(ts2sec('201408010000') + numpy.arange(n_frames, dtype=numpy.int64) * step * 60)
+            self.w, self.h, self.offset, self.dim = w, h, (0, 0, 0), (d, h, w)
+        def available(self):
+            return self.store.timestamps
+
+    sources = [Source(5), Source(10)]
+    join = Join(sources, '201408010000', sec2ts(ts2sec('201408010000') + n_frames * 5 * 60, 'min'), 5)
+    n = len(join) - window
+
+    def frame_by_frame():
+        for start in xrange(0, n, window):
+            frames = []
+            for k in xrange(start, start + window):
+                frames.append(numpy.concatenate([s.frames(k, k+1)[0] for s in join.sources], axis=0))
+            numpy.asarray(frames)
+
+    def vectorized():
+        for start in xrange(0, n, window):
+            join.frames(start, start + window)
+
+    print('frame by frame: {0:.3f} sec, join: {1:.3f} sec'.format(
+        timeit.timeit(frame_by_frame, number=1), timeit.timeit(vectorized, number=1)))
+    print('passthrough: {0}, shares memory: {1}'.format(
+        join.sources[0].passthrough, numpy.may_share_memory(join.sources[0].frames(0, window), sources[0].store.frames)))
+
+if __name__ == '__main__':
+    bench_join()
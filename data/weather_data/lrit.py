@@ -1,6 +1,7 @@
 __author__ = 'masayuki'
 
 import math
+import numpy
 
 '''
 Utilties for LRIT / HRIT Satellite images
@@ -72,4 +73,130 @@ def cl2xy(cfac, lfac, coff, loff, c, l):
     x = 2.0**16 * (c - coff) / cfac
     y = 2.0**16 * (l - loff) / lfac
 
-    return (x, y)
\ No newline at end of file
+    return (x, y)
+
+'''
+NumPy versions of the projections above, which take whole grids of coordinates (broadcasted) at once
+'''
+
+def lonlat2xy_array(prj_dir, prj_lon, lon, lat):
+    '''
+    project geographical coordinates (lon,lat) to intermediate coordinates (x,y)
+    :param prj_dir: the projection plane, 'N' or 'S'
+    :param prj_lon: the central longitude in degrees
+    :param lon: ndarray of longitudes in degrees
+    :param lat: ndarray of latitudes in degrees
+    :return: a tuple of ndarrays (x, y)
+    '''
+    assert prj_dir in ('N', 'S')
+
+    d = 1 if prj_dir == 'N' else -1
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    r = numpy.tan(numpy.radians(90 - d*lat)/2.0)
+    x = r * numpy.sin(numpy.radians(lon - prj_lon))
+    y = r * numpy.cos(numpy.radians(lon - prj_lon))
+
+    return (x, y)
+
+def xy2lonlat_array(prj_dir, prj_lon, x, y):
+    '''
+    project intermediate coordinates (x,y) to geographical coordinates (lon,lat)
+    :param prj_dir: the projection plane, 'N' or 'S'
+    :param prj_lon: the central longitude
+    :param x: ndarray of x
+    :param y: ndarray of y
+    :return: a tuple of ndarrays (lon, lat) in degrees
+    '''
+    assert prj_dir in ('N', 'S')
+
+    d = 1 if prj_dir == 'N' else -1
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+    sy = numpy.sign(y)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        lon = numpy.degrees(numpy.arctan(x/y)) + prj_lon + d*90*(1-sy)
+    lat = d*(90 - 2.0*numpy.degrees(numpy.arctan(numpy.sqrt(x**2+y**2))))
+
+    return (lon, lat)
+
+def xy2cl_array(cfac, lfac, coff, loff, x, y, nint=True):
+    '''
+    convert intermediate coordinates (x,y) to image coordinate (c,l)
+    :param cfac: CFAC
+    :param lfac: LFAC
+    :param coff: COFF
+    :param loff: LOFF
+    :param x: ndarray of x
+    :param y: ndarray of y
+    :param nint: round to the nearest integers as xy2cl() does, or keep the fractional coordinates if False
+    :return: a tuple of ndarrays (c, l)
+    '''
+    c = numpy.asarray(x, dtype=numpy.float64) * 2.0**(-16) * cfac
+    l = numpy.asarray(y, dtype=numpy.float64) * 2.0**(-16) * lfac
+    if nint:
+        # round half away from zero, same as int(round(r))
+        c = (numpy.sign(c) * numpy.floor(numpy.abs(c) + 0.5)).astype(numpy.int64)
+        l = (numpy.sign(l) * numpy.floor(numpy.abs(l) + 0.5)).astype(numpy.int64)
+
+    return (c + coff, l + loff)
+
+def cl2xy_array(cfac, lfac, coff, loff, c, l):
+    '''
+    convert image coordinate (c,l) to intermediate coordinates (x,y)
+    :param cfac: CFAC
+    :param lfac: LFAC
+    :param coff: COFF
+    :param loff: LOFF
+    :param c: ndarray of c
+    :param l: ndarray of l
+    :return: a tuple of ndarrays (x, y)
+    '''
+    x = 2.0**16 * (numpy.asarray(c, dtype=numpy.float64) - coff) / cfac
+    y = 2.0**16 * (numpy.asarray(l, dtype=numpy.float64) - loff) / lfac
+
+    return (x, y)
+
+def bench_projection(n=500, prj_dir='N', prj_lon=135., cfac=99560944, lfac=99440107, coff=540, loff=-420):
+    '''
+    round-trip accuracy and throughput of the projections on a n-by-n lon/lat grid around Japan
+    '''
+    import timeit
+
+    lon, lat = numpy.meshgrid(numpy.linspace(120., 150., n), numpy.linspace(20., 50., n))
+    if prj_dir == 'S':
+        lat = -lat
+
+    def scalar():
+        xs = [lonlat2xy(prj_dir, prj_lon, lo, la) for lo, la in zip(lon.flat, lat.flat)]
+        cls = [xy2cl(cfac, lfac, coff, loff, x, y) for x, y in xs]
+        return xs, cls
+
+    def array():
+        x, y = lonlat2xy_array(prj_dir, prj_lon, lon, lat)
+        return (x, y), xy2cl_array(cfac, lfac, coff, loff, x, y)
+
+    t_scalar = timeit.default_timer()
+    xs, cls = scalar()
+    t_scalar = timeit.default_timer() - t_scalar
+    t_array = timeit.default_timer()
+    (x, y), (c, l) = array()
+    t_array = timeit.default_timer() - t_array
+
+    # same results as the scalar versions
+    err_xy = numpy.max(numpy.abs(numpy.asarray(xs) - numpy.dstack((x, y)).reshape((-1, 2))))
+    n_diff_cl = numpy.sum(numpy.asarray(cls) != numpy.dstack((c, l)).reshape((-1, 2)))
+
+    # round trip lon/lat -> x/y -> c/l (fractional) -> x/y -> lon/lat
+    cf, lf = xy2cl_array(cfac, lfac, coff, loff, x, y, nint=False)
+    lon2, lat2 = xy2lonlat_array(prj_dir, prj_lon, *cl2xy_array(cfac, lfac, coff, loff, cf, lf))
+    err_lonlat = max(numpy.max(numpy.abs(lon2 - lon)), numpy.max(numpy.abs(lat2 - lat)))
+
+    print('projection of {0} points: scalar {1:.4f} sec, array {2:.4f} sec ({3:.1f}x)'
+          .format(lon.size, t_scalar, t_array, t_scalar / t_array))
+    print('  max |xy - scalar xy|={0}, cl differing from scalar cl={1}, round trip max |lonlat error|={2} deg'
+          .format(err_xy, n_diff_cl, err_lonlat))
+    return t_scalar, t_array, err_lonlat
+
+if __name__ == '__main__':
+    bench_projection()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import numpy
+
+'''
+single-pass per-channel statistics of the weather frames
+'''
+
+class ChannelStats(object):
+    def __init__(self, n_channels, sketch_size=65536, seed=1234):
+        '''
+        per-channel min, max, mean, variance and a quantile sketch updated in one pass over the frames.
+        the sketch is a bottom-k sample: every value gets a uniform random key and (at most) the sketch_size values
+        with the smallest keys are kept, which is a uniform sample of all the values seen so far.
+        only the values whose key can enter the sample are drawn, so an update costs O(sketch_size)
+        on top of the min/max/sum reductions. two stats are merged by merging their samples (see merge())
+        :param n_channels: number of channels (n_feature_maps)
+        :param sketch_size: number of values kept per channel for the quantiles
+        :param seed: seed of the sampling
+        :return:
+        '''
+        self.n_channels = n_channels
+        self.sketch_size = sketch_size
+        self.rng = numpy.random.RandomState(seed)
+
+        self.count = 0
+        self.mins = numpy.full((n_channels,), numpy.inf)
+        self.maxs = numpy.full((n_channels,), -numpy.inf)
+        self.means = numpy.zeros((n_channels,))
+        self.m2s = numpy.zeros((n_channels,))
+        self.taus = numpy.ones((n_channels,))
+        self.keys = [numpy.zeros((0,)) for c in xrange(n_channels)]
+        self.values = [numpy.zeros((0,), dtype=numpy.float32) for c in xrange(n_channels)]
+        self.pending = [[] for c in xrange(n_channels)]
+        self.sizes = [0 for c in xrange(n_channels)]
+
+    def update(self, frames):
+        '''
+        :param frames: ndarray of shape (..., n_feature_maps, height, width)
+        '''
+        assert frames.shape[-3] == self.n_channels
+        x = frames.reshape((-1,) + frames.shape[-3:])
+        n = x.shape[0] * x.shape[2] * x.shape[3]
+        if n == 0:
+            return
+
+        means = numpy.zeros((self.n_channels,))
+        m2s = numpy.zeros((self.n_channels,))
+        for c in xrange(self.n_channels):
+            channel = x[:,c,:,:]
+            self.mins[c] = min(self.mins[c], channel.min())
+            self.maxs[c] = max(self.maxs[c], channel.max())
+            means[c] = channel.sum() / float(n)
+            # sum of squared deviations of this update (merged into self.m2s by _combine)
+            deviations = (channel - channel.dtype.type(means[c])).reshape(-1)
+            m2s[c] = numpy.dot(deviations, deviations)
+            self._sample(c, channel, n)
+        self._combine(n, means, m2s)
+
+    def _combine(self, n, means, m2s):
+        # Chan et al.: combine the mean and the sum of squared deviations of two partitions
+        total = self.count + n
+        delta = means - self.means
+        self.m2s += m2s + delta * delta * self.count * n / total
+        self.means += delta * n / total
+        self.count = total
+
+    def _sample(self, c, channel, n):
+        # the sample holds every value seen so far whose key is below self.taus[c].
+        # draw the keys of this update only below a threshold for which about 2 * sketch_size values are expected
+        tau = min(self.taus[c], 2.0 * self.sketch_size / n)
+        # positions of the values whose key is below tau, by geometric skips
+        size = int(n * tau + 5 * numpy.sqrt(n * tau) + 10)
+        idx = numpy.cumsum(self.rng.geometric(tau, size)) - 1
+        while idx[-1] < n - 1:
+            idx = numpy.concatenate([idx, idx[-1] + numpy.cumsum(self.rng.geometric(tau, size))])
+        idx = idx[idx < n]
+        keys = self.rng.uniform(0, tau, len(idx))
+        values = channel.reshape(-1)[idx].astype(numpy.float32)
+        self._keep(c, tau, keys, values)
+
+    def _keep(self, c, tau, keys, values):
+        if tau < self.taus[c]:
+            self._flush(c)
+            below = self.keys[c] < tau
+            self.keys[c], self.values[c] = self.keys[c][below], self.values[c][below]
+            self.taus[c] = tau
+        self.pending[c].append((keys, values))
+        self.sizes[c] += len(keys)
+        # keep up to twice the sketch so that the sample is cut down only once in a while
+        if 2 * self.sketch_size < self.sizes[c]:
+            self._compact(c)
+
+    def _flush(self, c):
+        if self.pending[c]:
+            self.keys[c] = numpy.concatenate([self.keys[c]] + [k for k, v in self.pending[c]])
+            self.values[c] = numpy.concatenate([self.values[c]] + [v for k, v in self.pending[c]])
+            self.pending[c] = []
+
+    def _compact(self, c):
+        self._flush(c)
+        if self.sketch_size < len(self.keys[c]):
+            order = numpy.argpartition(self.keys[c], self.sketch_size)
+            self.taus[c] = self.keys[c][order[self.sketch_size]]
+            self.keys[c] = self.keys[c][order[:self.sketch_size]]
+            self.values[c] = self.values[c][order[:self.sketch_size]]
+        self.sizes[c] = len(self.keys[c])
+
+    def merge(self, other):
+        '''
+        merge the stats of another partition of the data into this
+        :param other: a ChannelStats of the same number of channels
+        :return: self
+        '''
+        assert other.n_channels == self.n_channels
+        if other.count == 0:
+            return self
+        self.mins = numpy.minimum(self.mins, other.mins)
+        self.maxs = numpy.maximum(self.maxs, other.maxs)
+        for c in xrange(self.n_channels):
+            other._flush(c)
+            self._keep(c, min(self.taus[c], other.taus[c]), other.keys[c], other.values[c])
+        self._combine(other.count, other.means, other.m2s)
+        return self
+
+    @property
+    def variances(self):
+        return self.m2s / max(self.count, 1)
+
+    def quantiles(self, q):
+        '''
+        :param q: percentile in [0, 100]
+        :return: the approximate q-th percentile of each channel
+        '''
+        for c in xrange(self.n_channels):
+            self._compact(c)
+        return numpy.asarray([numpy.percentile(self.values[c], q) if 0 < len(self.values[c]) else numpy.nan
+                              for c in xrange(self.n_channels)])
+
+    def bounds(self, scaling='minmax', percentiles=(0.1, 99.9)):
+        '''
+        :param scaling: 'minmax' for the min and max of each channel,
+                        'percentile' for the percentiles of each channel, which ignores the outliers
+        :param percentiles: (lower, upper) percentiles for 'percentile'
+        :return: zmins, zmaxs
+        '''
+        if scaling == 'minmax':
+            return list(self.mins), list(self.maxs)
+        elif scaling == 'percentile':
+            return list(self.quantiles(percentiles[0])), list(self.quantiles(percentiles[1]))
+        raise NotImplementedError("Unknown scaling: "+scaling)
+
+    def summary(self):
+        return {'count': self.count, 'mins': self.mins, 'maxs': self.maxs, 'means': self.means,
+                'variances': self.variances}
+
+def bench_stats(n_seqs=200, seqdim=(20, 2, 60, 60)):
+    '''
+    compare the per-channel min/max reductions with ChannelStats.update on random sequences
+    '''
+    import timeit
+
+    rng = numpy.random.RandomState(1000)
+    seqs = rng.exponential(size=(n_seqs,) + seqdim).astype(numpy.float32)
+
+    t_minmax = timeit.default_timer()
+    for seq in seqs:
+        for c in xrange(seqdim[1]):
+            seq[:,c].min()
+            seq[:,c].max()
+    t_minmax = timeit.default_timer() - t_minmax
+
+    stats = ChannelStats(seqdim[1])
+    t_stats = timeit.default_timer()
+    for seq in seqs:
+        stats.update(seq)
+    t_stats = timeit.default_timer() - t_stats
+
+    print('min/max: {0:.3f} sec, ChannelStats: {1:.3f} sec'.format(t_minmax, t_stats))
+    print('99.9 percentiles: sketch {0}, exact {1}'.format(
+        stats.quantiles(99.9), [numpy.percentile(seqs[:,:,c], 99.9) for c in xrange(seqdim[1])]))
+
+if __name__ == '__main__':
+    bench_stats()
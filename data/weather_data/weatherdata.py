@@ -3,67 +3,126 @@ import os
 import time
 import calendar
 from datetime import datetime
+import collections
+import multiprocessing
+import multiprocessing.pool
+import pickle
+import fractions
 
 import numpy
-from scipy.interpolate import RegularGridInterpolator
 
 import gifmaker
-from generator import SinGenerator, RadarGenerator, SatelliteGenerator, Himawari8Generator
+import chunked
+import framestore
+from generator import SinGenerator, RadarGenerator, SatelliteGenerator, Himawari8Generator, PrefetchGenerator
+from generator import ts2sec, sec2ts, scan_timestamps
+from framestore import FrameStore
+from stats import ChannelStats
+from join import Join
 
 '''
 weather dataset generator
 '''
 
+def estimate_shift(prev_frame, next_frame):
+    '''
+    estimate the global displacement from prev_frame to next_frame by phase correlation
+    :param prev_frame: ndarray of shape (d, h, w)
+    :param next_frame: ndarray of shape (d, h, w)
+    :return: a tuple of (dy, dx) in pixels
+    '''
+    f0 = numpy.fft.fft2(numpy.sum(prev_frame, axis=0))
+    f1 = numpy.fft.fft2(numpy.sum(next_frame, axis=0))
+    r = f1 * numpy.conj(f0)
+    r = numpy.fft.ifft2(r / (numpy.abs(r) + 1e-12)).real
+    dy, dx = numpy.unravel_index(numpy.argmax(r), r.shape)
+    h, w = r.shape
+    return (dy - h if h // 2 < dy else dy, dx - w if w // 2 < dx else dx)
+
+def interpolate_segment(prev_key, next_key, before_key=None, after_key=None, method='linear'):
+    '''
+    interpolate all the frames between two key frames at once
+    :param prev_key: a tuple of (t, frame) of the key frame at the beginning of the segment
+    :param next_key: a tuple of (t, frame) of the key frame at the end of the segment
+    :param before_key: a tuple of (t, frame) of the key frame before prev_key, or None (used by 'cubic')
+    :param after_key: a tuple of (t, frame) of the key frame after next_key, or None (used by 'cubic')
+    :param method: 'linear', 'nearest', 'cubic' or 'advection'
+    :return: ndarray of shape (k, d, h, w) of the frames at t0, t0+1, ..., t1-1
+    '''
+    assert method in ['linear', 'nearest', 'cubic', 'advection']
+
+    t0, f0 = prev_key
+    t1, f1 = next_key
+    k = t1 - t0
+    a = (numpy.arange(k, dtype=numpy.float64) / k).reshape((k, 1, 1, 1))
+
+    if method == 'linear':
+        block = (1-a) * f0[None] + a * f1[None]
+    elif method == 'nearest':
+        block = numpy.where(a <= 0.5, f0[None], f1[None])
+    elif method == 'cubic':
+        # cubic Hermite spline with the finite difference tangents of the neighbouring key frames (Catmull-Rom)
+        m0 = (f1 - before_key[1]) / float(t1 - before_key[0]) if before_key is not None else (f1 - f0) / float(k)
+        m1 = (after_key[1] - f0) / float(after_key[0] - t0) if after_key is not None else (f1 - f0) / float(k)
+        a2 = a * a
+        a3 = a2 * a
+        block = (2*a3 - 3*a2 + 1) * f0[None] + (a3 - 2*a2 + a) * k * m0[None] \
+              + (-2*a3 + 3*a2) * f1[None] + (a3 - a2) * k * m1[None]
+    else:
+        # move both key frames along the global displacement between them and blend
+        # (scipy is imported here, only the advection needs it)
+        import scipy.ndimage
+        dy, dx = estimate_shift(f0, f1)
+        block = numpy.empty((k,) + f0.shape, dtype=numpy.float64)
+        for i in xrange(k):
+            ai = a[i, 0, 0, 0]
+            for c in xrange(f0.shape[0]):
+                block[i, c] = (1-ai) * scipy.ndimage.shift(f0[c], (ai*dy, ai*dx), order=1, mode='nearest') \
+                            + ai * scipy.ndimage.shift(f1[c], (-(1-ai)*dy, -(1-ai)*dx), order=1, mode='nearest')
+
+    return numpy.asarray(block, dtype=f0.dtype)
+
 def interpolate(generator, supply_num, method='linear'):
     '''
     Interpolate a generator
     :param generator: an instance of Generator
     :param supply_num: number of frames to supply between each generation
-    :param method: 'linear' or 'nearest'
+    :param method: 'linear', 'nearest', 'cubic' or 'advection'
     :return:
     '''
     assert generator is not None
     assert supply_num >= 0
+    assert method in ['linear', 'nearest', 'cubic', 'advection']
 
-    xs = numpy.asarray(range(0,generator.w))
-    ys = numpy.asarray(range(0,generator.h))
-    n_channels = generator.d
-    assert method in ['linear', 'nearest']
-
-    prev_instance = None
-    next_instance = generator.next()
-    supply_queue = []
-    supply_f = [None for _ in xrange(n_channels)]
-
-    try:
+    def keys():
+        # available frames with their time in the interpolated sequence.
+        # a missing frame (IOError) is bridged by the interpolation between its neighbours
+        t = 0
+        yield (t, generator.next())
         while True:
-            if len(supply_queue) == 0:
-                # retrieve next available frame
-                prev_instance = next_instance
-                next_instance = None
-                while next_instance is None:
-                    try:
-                        next_instance = generator.next()
-                    except IOError:
-                        next_instance = None
-                    ref = 0 if len(supply_queue) == 0 else supply_queue[-1]+1
-                    supply_queue += range(ref, ref+supply_num+1)
-
-                # build interpolator
-                ts = numpy.asarray([supply_queue[0], supply_queue[-1]+1])
-                for channel in xrange(n_channels):
-                    seq = numpy.asarray([prev_instance[channel], next_instance[channel]])
-                    supply_f[channel] = RegularGridInterpolator((ts,ys,xs), seq, method=method)
-
-            t = supply_queue.pop(0)
-            pts = numpy.array([[[(t,y,x) for x in xs] for y in ys]])
-            frame = []
-            for channel in xrange(n_channels):
-                frame.append(supply_f[channel](pts)[0])
-
-            yield numpy.asarray(frame)
-    except StopIteration:
-        yield prev_instance
+            t += supply_num + 1
+            try:
+                frame = generator.next()
+            except IOError:
+                continue
+            yield (t, frame)
+
+    # the segment between window[-3] and window[-2] is generated once window[-1] is known
+    window = []
+    for key in keys():
+        window.append(key)
+        if 3 <= len(window):
+            before_key = window[-4] if 4 <= len(window) else None
+            for frame in interpolate_segment(window[-3], window[-2], before_key, window[-1], method=method):
+                yield frame
+            window = window[-3:]
+
+    if 2 <= len(window):
+        before_key = window[-3] if 3 <= len(window) else None
+        for frame in interpolate_segment(window[-2], window[-1], before_key, None, method=method):
+            yield frame
+    if 1 <= len(window):
+        yield window[-1][1]
 
 def skip(generator, skip_num):
     '''
@@ -85,47 +144,101 @@ def skip(generator, skip_num):
         pass
 
 class WeatherDataGenerator(object):
+    # the step (in minutes) of the frames of the sources, which are read on this step from begin
+    key_step = 5
+
     def __init__(self, seqnum=15000, seqdim=(10, 3, 16, 16), offset=(0,0,0), radar_dir='../radar', sat1_dir="../eisei_PS01IR1", sat2_dir="../eisei_PS01VIS", himawari8_dir='../himawari8',
-                 begin='201408010000', end='201408312330', step=5, method='linear', mode='grayscale'):
+                 begin='201408010000', end='201408312330', step=5, method='linear', mode='grayscale', store_dir=None,
+                 prefetch=0, prefetch_workers=None, prefetch_mode='process', level=0, align='step', tolerance=0):
+        '''
+
+        :param store_dir: the directory of the frame stores made by framestore.ingest_*() (radar/, himawari8/, ...).
+                          the frames are read from the stores instead of the files if given
+        :param level: read the frames area-averaged by 2**level from the pyramid of the stores
+                      (ingested with pyramid=...). seqdim and offset are then in the pixels of the level
+        :param prefetch: how many frames of each source to read ahead in a pool of workers (0 to read serially)
+        :param prefetch_workers: number of workers of the pool (default: number of cpus)
+        :param prefetch_mode: 'process' or 'thread' pool
+        :param align: 'step' to interpolate or skip the frames of each source by the ratio of its step to step,
+                      'join' to resample each source to the target clock by its timestamps (see join.Join),
+                      which does not assume the sources start at begin or have a step dividing step.
+                      method is then 'linear' or 'nearest', and a time without the frames of every source raises ValueError
+        :param tolerance: seconds within which a frame of a source is taken as the frame of a time ('join' and Manifest)
+        '''
+        assert prefetch_mode in ['process', 'thread']
+        assert align in ['step', 'join']
+        if 0 < level and store_dir is None:
+            raise ValueError('level {0} is read from the pyramid of the frame stores, store_dir must be given'.format(level))
+        def store(name):
+            return None if store_dir is None else FrameStore(os.path.join(store_dir, name), level=level)
+
         self.generators = []
         self.generators += [{
             'generator': RadarGenerator(radar_dir, w=seqdim[-1], h=seqdim[-2], offset=(offset[2], offset[1], offset[0]),
-                                        begin=begin, end=end, step='5'),
+                                        begin=begin, end=end, step='5', store=store('radar')),
             'step': 5
         }]
         # self.generators += [{
         #     'generator': SatelliteGenerator(sat1_dir, w=seqdim[-1], h=seqdim[-2], offset=(offset[2], offset[1], offset[0]),
-        #                                     begin=begin, end=end, step='30', mode=mode),
+        #                                     begin=begin, end=end, step='30', mode=mode, store=store('eisei_PS01IR1')),
         #     'step': 30
         # }]
         # self.generators += [{
         #     'generator': SatelliteGenerator(sat2_dir, w=seqdim[-1], h=seqdim[-2], offset=(offset[2], offset[1], offset[0]),
-        #                                     begin=begin, end=end, step='30', mode=mode),
+        #                                     begin=begin, end=end, step='30', mode=mode, store=store('eisei_PS01VIS')),
         #     'step': 30
         # }]
         self.generators += [{
             'generator': Himawari8Generator(himawari8_dir, w=seqdim[-1], h=seqdim[-2], offset=(offset[2], offset[1], offset[0]),
-                                            begin=begin, end=end, step='0500'),
+                                            begin=begin, end=end, step='0500', store=store('himawari8')),
             'step': 5
         }]
 
         self.seqnum = seqnum
         self.seqdim = seqdim
+        self.offset = offset
+        self.begin = begin
+        self.end = end
         self.step = step
         self.method = method
+        self.align = align
+        self.tolerance = tolerance
+        self.blocksize = 32
+
+        self.prefetch = prefetch
+        self.pool = None
+        if 0 < prefetch:
+            if prefetch_mode == 'process':
+                self.pool = multiprocessing.Pool(prefetch_workers)
+            else:
+                self.pool = multiprocessing.pool.ThreadPool(prefetch_workers)
 
         self.setup()
 
     def setup(self):
+        if self.align == 'join':
+            # the sources are read through the join, blocksize times at a time
+            self.join = Join([entry['generator'] for entry in self.generators], self.begin, self.end, self.step,
+                             offset=self.offset[0], method=self.method, tolerance=self.tolerance,
+                             max_gaps=[entry['step'] * 60 for entry in self.generators])
+            self.block = None
+            self.block_start = -1
+            self.t = -1
+            return
+
         # interpolate generators
         self._generators = []
         for entry in self.generators:
+            source = entry['generator']
+            if self.pool is not None:
+                source = PrefetchGenerator(source, self.pool, depth=self.prefetch)
+
             if entry['step'] > self.step:
-                generator = interpolate(entry['generator'], int(entry['step']/self.step-1), method=self.method)
+                generator = interpolate(source, int(entry['step']/self.step-1), method=self.method)
             elif entry['step'] == self.step:
-                generator = entry['generator']
+                generator = source
             else:
-                generator = skip(entry['generator'], int(self.step/entry['step']-1))
+                generator = skip(source, int(self.step/entry['step']-1))
             self._generators.append(generator)
 
         # initialize first frames with with zeros
@@ -137,6 +250,9 @@ class WeatherDataGenerator(object):
         return self
 
     def next(self):
+        if self.align == 'join':
+            return self.next_joined()
+
         self.t = self.t + 1
         hasError = False
 
@@ -159,7 +275,107 @@ class WeatherDataGenerator(object):
 
         return frame
 
-def save_to_numpy_format(seq, input_seq_len, output_seq_len, zmaxs, zmins, path):
+    def next_joined(self):
+        self.t = self.t + 1
+        if len(self.join) <= self.t:
+            raise StopIteration
+        if not self.join.valid[self.t]:
+            raise ValueError('the sources have no frames at {0}'.format(sec2ts(self.join.times[self.t])))
+
+        start = self.t - self.t % self.blocksize
+        if self.block_start != start:
+            self.block = self.join.frames(start, min(start + self.blocksize, len(self.join)))
+            self.block_start = start
+        return self.block[self.t - start]
+
+    def stopped_early(self):
+        '''
+        after next() raised StopIteration, tell whether the frames stopped before the end of the time range
+        (e.g. interpolate() stops at a missing first frame of a source). the frames after the last key frame
+        before end are not interpolated, so the frames may stop within the step of a source before end
+        :return: True if fewer frames than those of the time range were generated
+        '''
+        if self.align == 'join':
+            return self.t < len(self.join)
+        tstep = int(self.step * 60)
+        sstep = max(entry['step'] for entry in self.generators) * 60
+        n_frames = -(-(ts2sec(self.end) - ts2sec(self.begin) - self.offset[0] * sstep) // tstep)
+        return self.t + max(sstep // tstep, 1) < n_frames
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+def quantization(dtype, zmins, zmaxs, normalized=True):
+    '''
+    per-channel scale and offset to store the frames as dtype: a frame is stored as round((frame - qoffsets) / qscales)
+    :param dtype: 'uint8' or 'float16'
+    :param normalized: True if the frames are normalized to [0,1], False if they are in [zmins, zmaxs]
+    :return: (dtype, qscales, qoffsets) for save_arrays
+    '''
+    n_channels = len(zmins)
+    if dtype == 'float16':
+        return (numpy.float16, numpy.ones((n_channels,), dtype=numpy.float32), numpy.zeros((n_channels,), dtype=numpy.float32))
+    elif dtype == 'uint8':
+        if normalized:
+            return (numpy.uint8, numpy.full((n_channels,), 1. / 255, dtype=numpy.float32), numpy.zeros((n_channels,), dtype=numpy.float32))
+        zmins = numpy.asarray(zmins, dtype=numpy.float32)
+        zmaxs = numpy.asarray(zmaxs, dtype=numpy.float32)
+        return (numpy.uint8, (zmaxs - zmins) / 255, zmins)
+    raise NotImplementedError("Unknown dtype: "+dtype)
+
+def quantize(frames, dtype, qscales, qoffsets, out, chunksize=256):
+    '''
+    quantize frames into out, chunksize frames at a time
+    :param frames: ndarray of shape (n_frames, n_feature_maps, height, width)
+    :param out: ndarray of dtype of the shape of frames
+    :return: out
+    '''
+    qscales = numpy.asarray(qscales, dtype=numpy.float32).reshape((-1, 1, 1))
+    qoffsets = numpy.asarray(qoffsets, dtype=numpy.float32).reshape((-1, 1, 1))
+    for i in xrange(0, frames.shape[0], chunksize):
+        chunk = numpy.array(frames[i:i+chunksize], dtype=numpy.float32)
+        chunk -= qoffsets
+        chunk /= qscales
+        if numpy.dtype(dtype).kind == 'u':
+            numpy.rint(chunk, out=chunk)
+            numpy.clip(chunk, 0, numpy.iinfo(dtype).max, out=chunk)
+        out[i:i+chunksize] = chunk
+    return out
+
+def save_arrays(path, container='npz', quantization=None, **arrays):
+    '''
+    :param container: 'npz' for numpy.savez_compressed, or 'chunked' for the chunked container
+                      whose blocks of frames are compressed in parallel and can be read randomly (see chunked.py)
+    :param quantization: (dtype, qscales, qoffsets) to store input_raw_data as dtype (see quantization()).
+                         qscales and qoffsets are saved with it so that the loader dequantizes the minibatches
+    '''
+    tmppath = None
+    if quantization is not None:
+        dtype, qscales, qoffsets = quantization
+        frames = arrays['input_raw_data']
+        if isinstance(frames, numpy.memmap):
+            tmppath = path + '.tmp'
+            out = numpy.memmap(tmppath, dtype=dtype, mode='w+', shape=frames.shape) if 0 < frames.shape[0] else numpy.zeros(frames.shape, dtype=dtype)
+        else:
+            out = numpy.zeros(frames.shape, dtype=dtype)
+        arrays['input_raw_data'] = quantize(frames, dtype, qscales, qoffsets, out)
+        arrays['qscales'] = qscales
+        arrays['qoffsets'] = qoffsets
+
+    if container == 'npz':
+        numpy.savez_compressed(path, **arrays)
+    elif container == 'chunked':
+        chunked.save_chunked(path, **arrays)
+    else:
+        raise NotImplementedError("Unknown container: "+container)
+
+    if tmppath is not None:
+        del arrays['input_raw_data']
+        os.remove(tmppath)
+
+def save_to_numpy_format(seq, input_seq_len, output_seq_len, zmaxs, zmins, path, container='npz', **arrays):
     # seq is of shape (n_samples, n_timesteps, n_feature_maps, height, width)
     assert 5 == seq.ndim
     assert input_seq_len + output_seq_len == seq.shape[1]
@@ -170,42 +386,161 @@ def save_to_numpy_format(seq, input_seq_len, output_seq_len, zmaxs, zmins, path)
     clips[0, :, 1] = input_seq_len
     clips[1, :, 0] = range(input_seq_len, input_raw_data.shape[0] + input_seq_len, seq.shape[1])
     clips[1, :, 1] = output_seq_len
-    numpy.savez_compressed(path, dims=dims, input_raw_data=input_raw_data, clips=clips, zmaxs=zmaxs, zmins=zmins)
+    save_arrays(path, container, dims=dims, input_raw_data=input_raw_data, clips=clips, zmaxs=zmaxs, zmins=zmins, **arrays)
 
     print('output file is available at: {0}'.format(path))
 
-def normalize(seqs):
+def save_frames_to_numpy_format(frames, starts, input_seq_len, output_seq_len, zmaxs, zmins, path, container='npz', **arrays):
+    '''
+    save sequences which share their frames: each frame is stored once in input_raw_data
+    and the clips of the i-th sequence point to frames[starts[i]:starts[i]+input_seq_len+output_seq_len]
+    :param frames: ndarray of shape (n_frames, n_feature_maps, height, width)
+    :param starts: the index of the first frame of each sequence (increasing)
+    '''
+    assert 4 == frames.ndim
+    starts = numpy.asarray(starts, dtype="int32")
+    seqlen = input_seq_len + output_seq_len
+
+    # keep only the frames used by the sequences
+    first = starts[0] if 0 < len(starts) else 0
+    last = starts[-1] + seqlen if 0 < len(starts) else 0
+    input_raw_data = frames[first:last]
+    starts = starts - first
+
+    dims = numpy.asarray([[frames.shape[1], frames.shape[2], frames.shape[3]]], dtype="int32")
+    clips = numpy.zeros((2, len(starts), 2), dtype="int32")
+    clips[0, :, 0] = starts
+    clips[0, :, 1] = input_seq_len
+    clips[1, :, 0] = starts + input_seq_len
+    clips[1, :, 1] = output_seq_len
+    save_arrays(path, container, dims=dims, input_raw_data=input_raw_data, clips=clips, zmaxs=zmaxs, zmins=zmins, **arrays)
+
+    print('output file is available at: {0}'.format(path))
+
+def scale(x, zmins, zmaxs, clip=False):
+    '''
+    scale x per channel to [0,1] in place, in one pass without temporaries
+    :param x: ndarray of shape (..., n_feature_maps, height, width)
+    :param clip: clip the values out of [zmin, zmax] (for the bounds given by percentiles)
+    :return: x
+    '''
+    zmins = numpy.asarray(zmins, dtype=x.dtype).reshape((-1, 1, 1))
+    zmaxs = numpy.asarray(zmaxs, dtype=x.dtype).reshape((-1, 1, 1))
+    numpy.subtract(x, zmins, out=x)
+    numpy.multiply(x, 1 / (zmaxs - zmins), out=x)
+    if clip:
+        numpy.clip(x, 0, 1, out=x)
+    return x
+
+def normalize(seqs, zmins=None, zmaxs=None, chunksize=256, stats=None, scaling='minmax', percentiles=(0.1, 99.9), defer=False):
+    '''
+    normalize seqs per channel to [0,1] in place, chunksize sequences at a time so that it also works on a memmap
+    :param seqs: ndarray of shape (n_samples, n_timesteps, n_feature_maps, height, width)
+    :param zmins: the minimum of each channel, computed from stats if None
+    :param zmaxs: the maximum of each channel, computed from stats if None
+    :param chunksize: number of sequences to process at a time
+    :param stats: ChannelStats of seqs (e.g. accumulated by SequenceWriter), computed in one pass over seqs if None
+    :param scaling: 'minmax' to scale the min and max of each channel to [0,1],
+                    'percentile' to scale the percentiles of each channel and clip the outliers (see ChannelStats.bounds)
+    :param percentiles: (lower, upper) percentiles for 'percentile'
+    :param defer: only compute zmins and zmaxs and leave seqs as they are, to normalize them at load time
+    :return: zmins, zmaxs
+    '''
     # seq is of shape (n_samples, n_timesteps, n_feature_maps, height, width)
     assert seqs.ndim == 5
 
-    zmaxs = [None for channel in xrange(seqs.shape[2])]
-    zmins = [None for channel in xrange(seqs.shape[2])]
+    if zmins is None or zmaxs is None:
+        if stats is None:
+            stats = ChannelStats(seqs.shape[2])
+            for i in xrange(0, seqs.shape[0], chunksize):
+                stats.update(seqs[i:i+chunksize])
+        zmins, zmaxs = stats.bounds(scaling, percentiles)
+
     for channel in xrange(seqs.shape[2]):
-        zmax = numpy.max(seqs[:,:,channel,:,:])
-        zmin = numpy.min(seqs[:,:,channel,:,:])
-        seqs[:,:,channel,:,:] = (seqs[:,:,channel,:,:] - zmin) / (zmax - zmin)
-        zmaxs[channel] = zmax
-        zmins[channel] = zmin
         print('normlization (channel {0}):'.format(channel))
-        print('  zmin={0}, zmax={1}'.format(zmin, zmax))
-    return zmins, zmaxs
-
-def generator(seqnum, seqdim, offset, begin, end, step, input_seq_len, output_seq_len, mode):
+        print('  zmin={0}, zmax={1}'.format(zmins[channel], zmaxs[channel]))
+    if defer:
+        return list(zmins), list(zmaxs)
+
+    for i in xrange(0, seqs.shape[0], chunksize):
+        scale(seqs[i:i+chunksize], zmins, zmaxs, clip=(scaling == 'percentile'))
+    if isinstance(seqs, numpy.memmap):
+        seqs.flush()
+    return list(zmins), list(zmaxs)
+
+class SequenceWriter(object):
+    def __init__(self, path, seqdim, dedup=False, base=None):
+        '''
+        append sequences to a raw float32 file as they are generated, keeping the per-channel statistics (self.stats)
+        :param path: path to the output file
+        :param seqdim: (n_timesteps, n_feature_maps, height, width)
+        :param dedup: store the frames shared with the previous sequence only once.
+                      the file then holds the frames, and self.starts the first frame of each sequence
+        :param base: write into an existing file from this frame on, instead of creating the file
+                     (so that several writers fill their own regions of one file)
+        :return:
+        '''
+        self.path = path
+        self.seqdim = tuple(seqdim)
+        self.dedup = dedup
+        self.seqnum = 0
+        self.n_frames = 0
+        self.starts = []
+        self.last = None
+        self.stats = ChannelStats(seqdim[1])
+        self.base = base or 0
+        self.f = open(path, 'wb' if base is None else 'r+b')
+        self.f.seek(self.base * numpy.prod(self.seqdim[1:]) * 4)
+
+    @property
+    def zmins(self):
+        return self.stats.mins
+
+    @property
+    def zmaxs(self):
+        return self.stats.maxs
+
+    def append(self, seq):
+        '''
+        :param seq: ndarray of shape seqdim
+        '''
+        seq = numpy.ascontiguousarray(seq, dtype=numpy.float32)
+        assert seq.shape == self.seqdim
+
+        if self.dedup and self.last is not None and numpy.array_equal(seq[:-1], self.last[1:]):
+            # slid by one frame from the previous sequence
+            seq[-1:].tofile(self.f)
+            self.stats.update(seq[-1:])
+            self.n_frames += 1
+        else:
+            seq.tofile(self.f)
+            self.stats.update(seq)
+            self.n_frames += seq.shape[0]
+        self.starts.append(self.n_frames - seq.shape[0])
+        if self.dedup:
+            self.last = seq
+        self.seqnum += 1
+
+    def close(self):
+        '''
+        :return: memmap of shape (seqnum,) + seqdim of the written sequences,
+                 or of shape (n_frames,) + seqdim[1:] of the frames if dedup
+        '''
+        self.f.close()
+        shape = (self.n_frames,) + self.seqdim[1:] if self.dedup else (self.seqnum,) + self.seqdim
+        if shape[0] == 0:
+            return numpy.zeros(shape, dtype=numpy.float32)
+        return numpy.memmap(self.path, dtype=numpy.float32, mode='r+', shape=shape,
+                            offset=self.base * numpy.prod(self.seqdim[1:]) * 4)
+
+def windows(gen, seqdim):
     '''
-    generate sequences of weather data
-    :param seqnum: How many sequences to generate
-    :param seqdim: (n_timesteps, height, width)
-    :param offset: (n_timesteps, top, left)
-    :param steps: (step for radar, step for sat1, step for sat2)
-    :param radar_dir:
-    :param sat1_dir:
-    :param sat2_dir:
-    :param savedir:
-    :return:
+    sliding windows of seqdim[0] consecutive frames of gen.
+    a frame which fails to be generated discards the frames before it
+    :param gen: an instance of WeatherDataGenerator
+    :param seqdim: (n_timesteps, n_feature_maps, height, width)
+    :return: a generator of ndarray of shape seqdim
     '''
-    print('generator(): '+str(locals()))
-
-    gen = WeatherDataGenerator(seqnum=seqnum, seqdim=seqdim, offset=offset, begin=begin, end=end, step=step, mode=mode)
     frames = []
 
     def fill_frames():
@@ -222,137 +557,782 @@ def generator(seqnum, seqdim, offset, begin, end, step, input_seq_len, output_se
             else:
                 frames.append(frame)
 
-    print('... Generating sequences')
     fill_frames()
-    seqs = numpy.zeros((seqnum,) + seqdim, dtype=numpy.float32)
-    for i in range(seqnum):
-        print('sequence {0} ...'.format(i)),
-        seqs[i, :, :, :, :] = numpy.asarray(frames, dtype=numpy.float32)
-        print('created')
-
-        try:
-            frames.pop(0)
-            fill_frames()
-        except StopIteration:
-            seqs = seqs[:i]
-            seqnum = i
-            break
-
-    print('done. {0} sequences in total'.format(seqnum))
-    return seqs[:seqnum]
-
-def generate(seqnum=15000, seqdim=(20, 2, 120, 120), offset=(0,0,0), begin='201408010000', end='201408312330', step=30, input_seq_len=10, output_seq_len=10, mode='grayscale', savedir='out'):
-    # make output directory
-    if not os.path.isdir(savedir):
-        os.makedirs(savedir)
+    while True:
+        yield numpy.asarray(frames, dtype=numpy.float32)
+        frames.pop(0)
+        fill_frames()
+
+class Manifest(Join):
+    def __init__(self, gen):
+        '''
+        the timestamps of the target clock of a WeatherDataGenerator for which every source has its frames,
+        built from a single scan of each source directory (or frame store).
+        a time needs the frame of each source at the time, or the frames around it within the step of the source.
+        note that the clock skips offset[0] steps of the target clock from begin, while the sources of the step path
+        (WeatherDataGenerator.next()) skip offset[0] steps of each source: the two start at different times
+        when step differs from the step of the sources and offset[0] != 0
+        :param gen: an instance of WeatherDataGenerator
+        :return:
+        '''
+        super(Manifest, self).__init__([entry['generator'] for entry in gen.generators], gen.begin, gen.end, gen.step,
+                                       offset=gen.offset[0], method='linear', tolerance=gen.tolerance,
+                                       max_gaps=[entry['step'] * 60 for entry in gen.generators])
+
+class WindowSampler(object):
+    def __init__(self, gen, n_timesteps, shuffle=False, rng=None):
+        '''
+        generate exactly the windows found by Manifest, reading the frames of the sources directly
+        :param gen: an instance of WeatherDataGenerator
+        :param n_timesteps: length of the windows
+        :param shuffle: generate the windows in random order
+        :param rng: numpy.random.RandomState used to shuffle
+        :return:
+        '''
+        self.gen = gen
+        self.n_timesteps = n_timesteps
+        self.manifest = Manifest(gen)
+        self.starts = self.manifest.windows(n_timesteps)
+        if shuffle:
+            rng = numpy.random.RandomState(1000) if rng is None else rng
+            rng.shuffle(self.starts)
+
+        # recently read frames of each source, enough for the overlapping windows in sequential order
+        self.cachesize = 2 * n_timesteps + 4
+        self.caches = [collections.OrderedDict() for _ in gen.generators]
+        self.keys = [None for _ in gen.generators]
+
+        print('WindowSampler: {0} windows of {1} timestamps, {2} of {3} timestamps missing'
+              .format(len(self.starts), n_timesteps, len(self.manifest.missing()), len(self.manifest.times)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def key_frame(self, i, t):
+        cache = self.caches[i]
+        if t in cache:
+            return cache[t]
+
+        generator = self.gen.generators[i]['generator']
+        frame = generator.read(sec2ts(t, generator.precision))
+        cache[t] = frame
+        while self.cachesize < len(cache):
+            cache.popitem(last=False)
+        return frame
+
+    def key_times(self, i):
+        # the times of the frames of source i which interpolate() takes as key frames: on the step of the source
+        # from begin, after the offset[0] steps of the source skipped by its generator, and before end
+        if self.keys[i] is None:
+            sstep = self.gen.generators[i]['step'] * 60
+            tbegin = ts2sec(self.gen.begin)
+            timestamps = self.manifest.sources[i].timestamps
+            self.keys[i] = timestamps[(tbegin + self.gen.offset[0] * sstep <= timestamps) & (timestamps < ts2sec(self.gen.end)) &
+                                      ((timestamps - tbegin) % sstep == 0)]
+        return self.keys[i]
+
+    def neighbour_key(self, i, t, tstep, k):
+        # the (time in target steps from t0, frame) of the key frame k keys away from the key at t, or None
+        keys = self.key_times(i)
+        j = numpy.searchsorted(keys, t) + k
+        if j < 0 or len(keys) <= j:
+            return None
+        return ((keys[j] - t) // tstep, self.key_frame(i, keys[j]))
+
+    def source_frame(self, i, t):
+        sstep = self.gen.generators[i]['step'] * 60
+        tbegin = ts2sec(self.gen.begin)
+        t0 = tbegin + ((t - tbegin) // sstep) * sstep
+        f0 = self.key_frame(i, t0)
+        if t0 == t:
+            return f0
+
+        f1 = self.key_frame(i, t0 + sstep)
+        tstep = self.gen.step * 60
+        before_key, after_key = None, None
+        if self.gen.method == 'cubic':
+            # the tangents from the neighbouring available key frames, as interpolate() takes them
+            before_key = self.neighbour_key(i, t0, tstep, -1)
+            after_key = self.neighbour_key(i, t0, tstep, 2)
+        block = interpolate_segment((0, f0), (sstep // tstep, f1), before_key, after_key, method=self.gen.method)
+        return block[(t - t0) // tstep]
+
+    def frame(self, t):
+        return numpy.concatenate([self.source_frame(i, t) for i in xrange(len(self.gen.generators))], axis=0)
+
+    def __iter__(self):
+        for start in self.starts:
+            if self.gen.method == 'linear':
+                # interpolated at once by the join of the sources
+                yield self.manifest.frames(start, start+self.n_timesteps)
+            else:
+                yield numpy.asarray([self.frame(t) for t in self.manifest.times[start:start+self.n_timesteps]], dtype=numpy.float32)
+
+def tile_offsets(height, width, h, w, stride=None):
+    '''
+    offsets of the tiles of size (h, w) over a grid of size (height, width)
+    :param stride: (vertical, horizontal) stride of the tiles, (h, w) if None
+    :return: a list of (top, left) for generator(tiles=...)
+    '''
+    stride = (h, w) if stride is None else stride
+    return [(top, left) for top in xrange(0, height - h + 1, stride[0]) for left in xrange(0, width - w + 1, stride[1])]
 
-    seqs = generator(**locals())
-    seqnum = seqs.shape[0]
-    zmins, zmaxs = normalize(seqs)
-
-    if savedir is not '':
-        for i in xrange(100):
-            for d in xrange(seqdim[1]):
-                outfile = savedir + "/" + str(i) + "-" + str(d) + ".gif"
-                gifmaker.save_gif(seqs[i, :, d, :, :], outfile)
-                print('  --> saved to {0}'.format(outfile))
-
-    if savedir is not '':
-        cut1 = int(seqnum*0.8)
-        cut2 = int(seqnum*0.9)
-        save_to_numpy_format(seqs[:cut1], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-train.npz")
-        save_to_numpy_format(seqs[cut1:cut2], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-valid.npz")
-        save_to_numpy_format(seqs[cut2:], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-test.npz")
+def generator(seqnum, seqdim, offset, begin, end, step, input_seq_len, output_seq_len, mode, store_dir=None, prefetch=0, writer=None,
+              sampler=None, tiles=None, level=0, align='step', tolerance=0, strict=False):
+    '''
+    generate sequences of weather data
+    :param seqnum: How many sequences to generate (for each tile if tiles is given)
+    :param seqdim: (n_timesteps, height, width)
+    :param offset: (n_timesteps, top, left)
+    :param steps: (step for radar, step for sat1, step for sat2)
+    :param radar_dir:
+    :param sat1_dir:
+    :param sat2_dir:
+    :param savedir:
+    :param store_dir: the directory of the frame stores to read the frames from (see framestore.py)
+    :param prefetch: how many frames of each source to read ahead in parallel (see WeatherDataGenerator)
+    :param writer: a SequenceWriter to append the sequences to instead of keeping them in memory
+    :param sampler: None to read the frames in order and drop the windows broken by missing frames,
+                    'sequential' or 'random' to generate the valid windows found by a scan of the files (see WindowSampler)
+    :param tiles: a list of (top, left) of the crops to make of each window (see tile_offsets), instead of offset[1:].
+                  the frames are read once over the bounding box of the tiles, and the sequences of the tiles of
+                  each window are interleaved: the i-th sequence is of the tile i % len(tiles)
+    :param level: read the frames area-averaged by 2**level from the pyramid of the frame stores in store_dir
+                  (seqdim, offset and tiles are in the pixels of the level)
+    :param align: 'step' or 'join' to align the sources by their timestamps (see WeatherDataGenerator)
+    :param tolerance: seconds within which a frame of a source is taken as the frame of a time ('join' and sampler)
+    :param strict: raise RuntimeError if the frames stop before the end of the time range with fewer than seqnum sequences
+                   (see WeatherDataGenerator.stopped_early), instead of returning the sequences generated
+    :return: ndarray of the sequences, or the number of sequences appended to writer
+    '''
+    print('generator(): '+str(locals()))
+
+    if tiles is None:
+        crops = [(0, 0)]
+        gendim = tuple(seqdim)
+        genoffset = offset
     else:
-        return zmins, zmaxs, seqs
+        top0 = min(top for top, left in tiles)
+        left0 = min(left for top, left in tiles)
+        crops = [(top - top0, left - left0) for top, left in tiles]
+        gendim = (seqdim[0], seqdim[1], max(top for top, left in crops) + seqdim[2], max(left for top, left in crops) + seqdim[3])
+        genoffset = (offset[0], top0, left0)
+
+    assert sampler in [None, 'sequential', 'random']
+    gen = WeatherDataGenerator(seqnum=seqnum, seqdim=gendim, offset=genoffset, begin=begin, end=end, step=step, mode=mode, store_dir=store_dir,
+                               prefetch=prefetch, level=level, align=align, tolerance=tolerance)
+
+    # close the generator (and its prefetching pool) even if the generation fails
+    try:
+        if sampler is None:
+            seq_iter = windows(gen, gendim)
+        else:
+            seq_iter = WindowSampler(gen, seqdim[0], shuffle=(sampler == 'random'))
+
+        print('... Generating sequences')
+        seqs = numpy.zeros((seqnum * len(crops),) + tuple(seqdim), dtype=numpy.float32) if writer is None else None
+        n = 0
+        for i, window in enumerate(seq_iter):
+            if seqnum <= i:
+                break
+            print('sequence {0} ...'.format(i)),
+            for top, left in crops:
+                seq = window[:, :, top:top+seqdim[2], left:left+seqdim[3]]
+                if writer is None:
+                    seqs[n] = seq
+                else:
+                    writer.append(seq)
+                n += 1
+            print('created')
+        else:
+            if strict and sampler is None and gen.stopped_early():
+                raise RuntimeError('the frames of {0}-{1} stopped after {2} frames with {3} of {4} sequences'.format(
+                    begin, end, gen.t, n, seqnum * len(crops)))
+    finally:
+        gen.close()
+
+    print('done. {0} sequences in total'.format(n))
+    return seqs[:n] if writer is None else n
+
+def save_dataset(seqs, zmins, zmaxs, input_seq_len, output_seq_len, savedir, starts=None, container='npz', normalized=True, clip=False,
+                 quantize=None, previews=100, preview_sampling='first', preview_processes=None):
+    '''
+    save previews and train/valid/test datasets of the normalized sequences to savedir
+    :param seqs: ndarray of the sequences (n_samples, n_timesteps, n_feature_maps, height, width),
+                 or of the frames (n_frames, n_feature_maps, height, width) if starts is given
+    :param starts: the first frame of each sequence in seqs to save the frames only once (see save_frames_to_numpy_format)
+    :param container: 'npz' or 'chunked' (see save_arrays)
+    :param normalized: False if seqs are not normalized yet. the datasets are then saved with normalized=False
+                       and clip, so that the loader scales them with zmins and zmaxs
+    :param clip: clip the values out of [zmin, zmax] when they are normalized at load time
+    :param quantize: None, or 'uint8' or 'float16' to store the frames in (see quantization())
+    :param previews: number of sequences to save gif previews of (0 to skip them)
+    :param preview_sampling: 'first' for the first sequences, 'random' for sequences sampled over the whole dataset
+    :param preview_processes: number of processes to render the previews in while the datasets are saved
+                              (0 to render them before saving the datasets)
+    '''
+    seqlen = input_seq_len + output_seq_len
+    seqnum = seqs.shape[0] if starts is None else len(starts)
+    arrays = {} if normalized else {'normalized': False, 'clip': clip}
+    if quantize is not None:
+        arrays['quantization'] = quantization(quantize, zmins, zmaxs, normalized)
+
+    renderer = gifmaker.GifRenderer(preview_processes)
+    for i in preview_indices(seqnum, previews, preview_sampling):
+        seq = seqs[i] if starts is None else seqs[starts[i]:starts[i]+seqlen]
+        seq = numpy.array(seq) if normalized else scale(numpy.array(seq), zmins, zmaxs, clip=clip)
+        for d in xrange(seq.shape[1]):
+            renderer.submit(seq[:, d, :, :], savedir + "/" + str(i) + "-" + str(d) + ".gif")
+
+    cut1 = int(seqnum*0.8)
+    cut2 = int(seqnum*0.9)
+    ext = '.npz' if container == 'npz' else '.' + container
+    splits = [(0, cut1, "/dataset-train"), (cut1, cut2, "/dataset-valid"), (cut2, seqnum, "/dataset-test")]
+    for begin, end, name in splits:
+        if starts is None:
+            save_to_numpy_format(seqs[begin:end], input_seq_len, output_seq_len, zmaxs, zmins, savedir + name + ext, container,
+                                 **arrays)
+        else:
+            save_frames_to_numpy_format(seqs, starts[begin:end], input_seq_len, output_seq_len, zmaxs, zmins, savedir + name + ext, container,
+                                        **arrays)
+
+    for outfile in renderer.close():
+        print('  --> saved to {0}'.format(outfile))
+
+def preview_indices(seqnum, previews=100, sampling='first', seed=1000):
+    '''
+    :param seqnum: number of sequences
+    :param previews: number of sequences to preview
+    :param sampling: 'first' for the first sequences, 'random' for sorted random sequences
+    :return: the indices of the sequences to preview
+    '''
+    n = min(previews, seqnum)
+    if sampling == 'first':
+        return range(n)
+    elif sampling == 'random':
+        return sorted(numpy.random.RandomState(seed).choice(seqnum, n, replace=False))
+    raise NotImplementedError("Unknown sampling: "+sampling)
+
+def generate(seqnum=15000, seqdim=(20, 2, 120, 120), offset=(0,0,0), begin='201408010000', end='201408312330', step=30, input_seq_len=10, output_seq_len=10, mode='grayscale', savedir='out', store_dir=None, prefetch=0, streaming=False, dedup=False, container='npz', scaling='minmax', percentiles=(0.1, 99.9), defer_normalization=False, tiles=None, quantize=None, previews=100,
+             preview_sampling='first', level=0, align='step', tolerance=0):
+    '''
+    :param streaming: stream the sequences to savedir/sequences.dat and normalize them there,
+                      instead of keeping all the sequences in memory
+    :param dedup: store each frame once and let the clips of overlapping sequences share them (implies streaming)
+    :param container: 'npz' or 'chunked' (see save_arrays)
+    :param scaling: 'minmax' or 'percentile' to clip the outliers (see normalize)
+    :param percentiles: (lower, upper) percentiles for 'percentile'
+    :param defer_normalization: save the raw values with zmins and zmaxs, and normalize them at load time
+    :param tiles: a list of (top, left) of the crops to make of each frame read (see generator and tile_offsets)
+    :param quantize: None, or 'uint8' or 'float16' to store the frames in (see quantization())
+    :param previews: number of sequences to save gif previews of, rendered while the datasets are saved (0 to skip them)
+    :param preview_sampling: 'first' or 'random' (see preview_indices)
+    :param level: generate from the level of the pyramid of the frame stores in store_dir (see WeatherDataGenerator)
+    :param align: 'step' or 'join' to align the sources by their timestamps (see WeatherDataGenerator)
+    :param tolerance: seconds within which a frame of a source is taken as the frame of a time (see WeatherDataGenerator)
+    '''
+    args = {'seqnum': seqnum, 'seqdim': seqdim, 'offset': offset, 'begin': begin, 'end': end, 'step': step,
+            'input_seq_len': input_seq_len, 'output_seq_len': output_seq_len, 'mode': mode,
+            'store_dir': store_dir, 'prefetch': prefetch, 'tiles': tiles, 'level': level,
+            'align': align, 'tolerance': tolerance}
+    return concat_generate([args], input_seq_len=input_seq_len, output_seq_len=output_seq_len, savedir=savedir,
+                           streaming=streaming, dedup=dedup, container=container, scaling=scaling, percentiles=percentiles,
+                           defer_normalization=defer_normalization, quantize=quantize, previews=previews,
+                           preview_sampling=preview_sampling)
+
+def split_range(args, n):
+    '''
+    split the time range of the arguments of generator() into n consecutive sub-ranges.
+    each sub-range is extended by the length of a sequence so that the windows across the boundaries are not lost,
+    and generates the windows which start in its own part of the range (its seqnum is capped by their number).
+    the sub-ranges start from the first frame of the range (after the frames skipped by offset[0]),
+    and begin on a key frame of the sources (see WeatherDataGenerator.key_step), so that a step finer than the step
+    of the sources interpolates the frames of one generator() over the whole range. the end of such a sub-range is
+    then extended to the key frame after its last frame, and its windows are cut to its part by seqnum
+    :param args: arguments of generator()
+    :param n: number of sub-ranges
+    :return: a list of the arguments of generator() for each sub-range
+    '''
+    tbegin, tend = ts2sec(args['begin']), ts2sec(args['end'])
+    tstep = int(args['step'] * 60)
+    kstep = WeatherDataGenerator.key_step * 60
+    join = args.get('align', 'step') == 'join'
+    # the time of the first frame (offset[0] skips the frames of the sources, or the times of the join)
+    tfirst = tbegin + args['offset'][0] * (tstep if join else kstep)
+    # the parts are of a multiple of the steps from a key frame to the next one on the target clock
+    period = kstep // fractions.gcd(kstep, tstep)
+    n_starts = max(0, -(-(tend - tfirst) // tstep) - args['seqdim'][0] + 1)
+    per = -(-n_starts // n)
+    per = -(-per // period) * period
+    subargs = []
+    for i in xrange(0, n_starts, per):
+        sub = dict(args)
+        sub['offset'] = (0,) + tuple(args['offset'][1:])
+        sub['begin'] = sec2ts(tfirst + i*tstep, 'min')
+        # the generators stop before end, so end is one step after the last frame of the last window
+        # (after the key frame to interpolate it from, if it is between the key frames of the sources)
+        last = tfirst + (min(i+per, n_starts) - 1 + args['seqdim'][0] - 1) * tstep
+        if not join:
+            last = tbegin + -(-(last - tbegin) // kstep) * kstep
+        sub['end'] = sec2ts(min(last + tstep, tend), 'min')
+        sub['seqnum'] = min(args['seqnum'], min(i+per, n_starts) - i)
+        subargs.append(sub)
+    return subargs
+
+def n_sequences(args):
+    # the maximum number of sequences of generator(**args)
+    return args['seqnum'] * len(args.get('tiles') or [None])
+
+def _generate_shard(job):
+    # a worker of concat_generate(parallel=...): generate the sequences into the region of the shared file from base
+    args, path, base, dedup = job
+    writer = SequenceWriter(path, args['seqdim'], dedup=dedup, base=base)
+    # a shard which can not read its frames would silently shrink the dataset
+    seqnum = generator(writer=writer, strict=True, **args)
+    writer.f.close()
+    starts = writer.starts if dedup else [i*args['seqdim'][0] for i in xrange(seqnum)]
+    return seqnum, writer.n_frames if dedup else seqnum*args['seqdim'][0], starts, writer.stats
+
+def parallel_generate(genargs, savedir, processes, split=1, dedup=False, blocksize=256):
+    '''
+    generate the sequences of genargs in a pool of processes.
+    each genargs (or each of its split sub-ranges) is a shard written into its own region of savedir/sequences.dat,
+    and the shards are merged by reference: the first frames of the sequences are offset to the regions of the shards
+    in the order of genargs and sub-ranges, and the statistics of the shards are merged.
+    the regions are reserved for the maximum number of sequences of the shards, so the written frames are moved
+    down over the unwritten rest of the regions at the end, and the file is truncated to them
+    :param genargs: a list of the arguments of generator()
+    :param processes: number of processes
+    :param split: split the time range of each genargs into this many sub-ranges (see split_range).
+                  a sub-range is started only if the sub-ranges before it can not reach the seqnum of its genargs,
+                  and generates at most the sequences still missing when it starts.
+                  the sequences over the seqnum are dropped, and the statistics of their shard are computed again
+                  from the frames kept
+    :param dedup: store the frames shared by the sequences only once (see SequenceWriter)
+    :param blocksize: number of frames to move or to compute the statistics of at a time
+    :return: memmap of the frames, the first frame of each sequence, ChannelStats, and the regions (base, n_frames) of the shards
+    '''
+    path = os.path.join(savedir, 'sequences.dat')
+    seqdim = tuple(genargs[0]['seqdim'])
+    framesize = int(numpy.prod(seqdim[1:])) * 4
+
+    jobs = []
+    owners = []
+    base = 0
+    for i, args in enumerate(genargs):
+        assert tuple(args['seqdim']) == seqdim
+        for sub in (split_range(args, split) if 1 < split else [args]):
+            jobs.append((sub, path, base, dedup))
+            owners.append(i)
+            base += n_sequences(sub) * seqdim[0]
+
+    # a sparse file large enough for every shard
+    with open(path, 'wb') as f:
+        f.truncate(base * framesize)
+
+    def schedule(j):
+        # 'run' the job (with the seqnum still missing), 'skip' it, or 'wait' for the jobs of the same genargs before it
+        args = genargs[owners[j]]
+        tiles = len(args.get('tiles') or [None])
+        done = sum(results[k][0] for k in xrange(j) if owners[k] == owners[j] and results[k] is not None)
+        running = [k for k in xrange(j) if owners[k] == owners[j] and results[k] is None]
+        if n_sequences(args) <= done:
+            return 'skip', 0
+        if n_sequences(args) <= done + sum(n_sequences(jobs[k][0]) for k in running):
+            return 'wait', 0
+        return 'run', min(jobs[j][0]['seqnum'], -(-(n_sequences(args) - done) // tiles))
+
+    results = [None for job in jobs]
+    pending = range(len(jobs))
+    running = {}
+    pool = multiprocessing.Pool(processes)
+    try:
+        while pending or running:
+            while pending and len(running) < processes:
+                action, seqnum = schedule(pending[0])
+                if action == 'wait':
+                    break
+                j = pending.pop(0)
+                if action == 'skip':
+                    results[j] = (0, 0, [], ChannelStats(seqdim[1]))
+                else:
+                    sub = jobs[j][0]
+                    running[j] = pool.apply_async(_generate_shard, ((dict(sub, seqnum=seqnum),) + jobs[j][1:],))
+            if running:
+                j = min(running)
+                results[j] = running.pop(j).get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+    frames = numpy.memmap(path, dtype=numpy.float32, mode='r+', shape=(max(base, 1),) + seqdim[1:])
+    starts = []
+    regions = []
+    stats = ChannelStats(seqdim[1])
+    counts = [0 for args in genargs]
+    end = 0
+    for job, owner, (seqnum, n_frames, shard_starts, shard_stats) in zip(jobs, owners, results):
+        n = min(seqnum, n_sequences(genargs[owner]) - counts[owner])
+        counts[owner] += n
+        if n < seqnum:
+            # only the frames of the kept sequences
+            n_frames = shard_starts[n-1] + seqdim[0] if 0 < n else 0
+
+        # move the frames down next to the frames of the shards before
+        for i in xrange(0, n_frames, blocksize):
+            if job[2] != end:
+                frames[end+i:end+min(i+blocksize, n_frames)] = frames[job[2]+i:job[2]+min(i+blocksize, n_frames)]
+        if n < seqnum:
+            shard_stats = ChannelStats(seqdim[1])
+            for i in xrange(0, n_frames, blocksize):
+                shard_stats.update(frames[end+i:end+min(i+blocksize, n_frames)])
+
+        starts += [end + start for start in shard_starts[:n]]
+        regions.append((end, n_frames))
+        stats.merge(shard_stats)
+        end += n_frames
+
+    frames.flush()
+    del frames
+    with open(path, 'r+b') as f:
+        f.truncate(max(end, 1) * framesize)
+    frames = numpy.memmap(path, dtype=numpy.float32, mode='r+', shape=(max(end, 1),) + seqdim[1:])
+    return frames, starts, stats, regions
+
+def concat_generate(genargs=[{}], input_seq_len=10, output_seq_len=10, savedir='out', streaming=False, dedup=False, container='npz',
+                    scaling='minmax', percentiles=(0.1, 99.9), defer_normalization=False, parallel=0, split=1, quantize=None,
+                    previews=100, preview_sampling='first'):
+    '''
+    :param streaming: stream the sequences to savedir/sequences.dat and normalize them there,
+                      instead of keeping all the sequences in memory
+    :param dedup: store each frame once and let the clips of overlapping sequences share them (implies streaming)
+    :param container: 'npz' or 'chunked' (see save_arrays)
+    :param scaling: 'minmax' or 'percentile' to clip the outliers (see normalize)
+    :param percentiles: (lower, upper) percentiles for 'percentile'
+    :param defer_normalization: save the raw values with zmins and zmaxs, and normalize them at load time
+    :param parallel: number of processes to generate genargs in parallel (0 to generate them one after another).
+                     the datasets are then saved with shared frames (see parallel_generate)
+    :param split: split the time range of each genargs into this many sub-ranges to generate in parallel
+    :param quantize: None, or 'uint8' or 'float16' to store the frames in (see quantization())
+    :param previews: number of sequences to save gif previews of, rendered while the datasets are saved (0 to skip them)
+    :param preview_sampling: 'first' or 'random' (see preview_indices)
+    '''
+    if 0 < parallel:
+        return concat_generate_parallel(genargs, input_seq_len, output_seq_len, savedir, dedup, container, scaling, percentiles,
+                                        defer_normalization, parallel, split, quantize, previews, preview_sampling)
+
+    streaming = streaming or dedup
+    assert not streaming or savedir != ''
 
-def concat_generate(genargs=[{}], input_seq_len=10, output_seq_len=10, savedir='out'):
     # make output directory
-    if not os.path.isdir(savedir):
+    if savedir != '' and not os.path.isdir(savedir):
         os.makedirs(savedir)
 
+    writer = SequenceWriter(os.path.join(savedir, 'sequences.dat'), genargs[0]['seqdim'], dedup=dedup) if streaming else None
+
     seqs = [None for i in genargs]
     for i,args in enumerate(genargs):
         print('--------------------------')
         print('Generating for dataset {0}'.format(i))
         print('--------------------------')
 
-        seqs[i] = generator(**args)
-
-    seqs = numpy.concatenate(seqs, axis=0)
-    seqnum = seqs.shape[0]
-    zmins, zmaxs = normalize(seqs)
-
-    if savedir is not '':
-        for i in xrange(100):
-            for d in xrange(seqs.shape[2]):
-                outfile = savedir + "/" + str(i) + "-" + str(d) + ".gif"
-                gifmaker.save_gif(seqs[i, :, d, :, :], outfile)
-                print('  --> saved to {0}'.format(outfile))
-
-    if savedir is not '':
-        cut1 = int(seqnum*0.8)
-        cut2 = int(seqnum*0.9)
-        save_to_numpy_format(seqs[:cut1], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-train.npz")
-        save_to_numpy_format(seqs[cut1:cut2], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-valid.npz")
-        save_to_numpy_format(seqs[cut2:], input_seq_len, output_seq_len, zmaxs, zmins, savedir + "/dataset-test.npz")
+        seqs[i] = generator(writer=writer, **args)
+
+    if streaming:
+        seqs = writer.close()
+        zmins, zmaxs = normalize(seqs[:, None] if dedup else seqs, stats=writer.stats, scaling=scaling, percentiles=percentiles,
+                                 defer=defer_normalization)
+    else:
+        seqs = numpy.concatenate(seqs, axis=0)
+        # chunksize sequences at a time as normalize(), to keep the temporaries of update() small
+        stats = ChannelStats(seqs.shape[2])
+        for i in xrange(0, seqs.shape[0], 256):
+            stats.update(seqs[i:i+256])
+        zmins, zmaxs = normalize(seqs, stats=stats, scaling=scaling, percentiles=percentiles, defer=defer_normalization)
+
+    if savedir != '':
+        save_dataset(seqs, zmins, zmaxs, input_seq_len, output_seq_len, savedir, starts=writer.starts if dedup else None,
+                     container=container, normalized=not defer_normalization, clip=(scaling == 'percentile'), quantize=quantize,
+                     previews=previews, preview_sampling=preview_sampling)
+        save_meta(savedir, genargs=genargs, input_seq_len=input_seq_len, output_seq_len=output_seq_len, zmins=zmins, zmaxs=zmaxs,
+                  scaling=scaling, percentiles=percentiles, defer_normalization=defer_normalization, quantize=quantize,
+                  container=container, dedup=dedup, stats=writer.stats if streaming else stats)
+        if streaming:
+            del seqs
+            os.remove(writer.path)
     else:
         return zmins, zmaxs, seqs
 
-def convert_to_multi_view(filepath):
-    if not os.path.isfile(filepath):
-        raise ValueError("file not found: "+filepath)
-    filename, file_extension = os.path.splitext(filepath)
+def concat_generate_parallel(genargs, input_seq_len, output_seq_len, savedir, dedup, container, scaling, percentiles,
+                             defer_normalization, processes, split, quantize, previews, preview_sampling):
+    assert savedir != ''
+    if not os.path.isdir(savedir):
+        os.makedirs(savedir)
 
-    f = numpy.load(filepath)
-    input_raw_data = [f['input_raw_data'][:,[0],:,:], f['input_raw_data'][:,[1],:,:]]
-    dims = [f['dims'][:], f['dims'][:]]
-    dims[0][0][0] = 1
-    dims[1][0][0] = 1
-    clips = [f['clips'], f['clips']]
-    numpy.savez('{0}-view0{1}'.format(filename, file_extension), clips=clips[0], dims=dims[0], input_raw_data=input_raw_data[0], zmins=[f['zmins'][0]], zmaxs=[f['zmaxs'][0]])
-    numpy.savez('{0}-view1{1}'.format(filename, file_extension), clips=clips[1], dims=dims[1], input_raw_data=input_raw_data[1], zmins=[f['zmins'][1]], zmaxs=[f['zmaxs'][1]])
-
-def patchify(filepath, patchsize=2):
+    frames, starts, stats, regions = parallel_generate(genargs, savedir, processes, split=split, dedup=dedup)
+    print('done. {0} sequences in total'.format(len(starts)))
+
+    zmins, zmaxs = stats.bounds(scaling, percentiles)
+    for base, n_frames in regions:
+        # normalize only the frames written by the shards
+        if 0 < n_frames:
+            normalize(frames[base:base+n_frames][:, None], zmins, zmaxs, scaling=scaling, defer=defer_normalization)
+
+    save_dataset(frames, zmins, zmaxs, input_seq_len, output_seq_len, savedir, starts=starts,
+                 container=container, normalized=not defer_normalization, clip=(scaling == 'percentile'), quantize=quantize,
+                 previews=previews, preview_sampling=preview_sampling)
+    save_meta(savedir, genargs=genargs, input_seq_len=input_seq_len, output_seq_len=output_seq_len, zmins=zmins, zmaxs=zmaxs,
+              scaling=scaling, percentiles=percentiles, defer_normalization=defer_normalization, quantize=quantize,
+              container=container, dedup=dedup, stats=stats)
+    path = frames.filename
+    del frames
+    os.remove(path)
+
+def save_meta(savedir, **meta):
+    '''
+    save the arguments and the normalization constants of a dataset to savedir/meta.pkl so that it can be appended to
+    '''
+    with open(os.path.join(savedir, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, -1)
+
+def load_meta(savedir):
+    path = os.path.join(savedir, 'meta.pkl')
+    if not os.path.isfile(path):
+        raise ValueError("no meta.pkl in {0}, the dataset must be generated by concat_generate".format(savedir))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+def append(savedir, end, ingest=True):
+    '''
+    append the sequences of the timestamps after the end of a dataset generated by concat_generate (or generate).
+    only the windows which end after the old end are generated, from the last genargs of the dataset.
+    the zmins and zmaxs of the dataset are kept, so that the saved sequences stay valid (the new values out of them
+    are clipped with scaling='percentile'), and the statistics of the new frames are merged into savedir/meta.pkl.
+    the new sequences are the latest ones, so they are appended to dataset-test, and the train and valid datasets
+    are left as they are (the time-based split boundaries are preserved).
+    the frames are appended to a chunked container in place, and a npz dataset-test is rewritten.
+    note that a dataset whose genargs stopped at seqnum before their end is appended from their end
+    :param savedir: the directory of the dataset
+    :param end: the new end (the generators stop before end)
+    :param ingest: ingest the new files into every frame store of the generators first if the dataset is generated
+                   from store_dir (see framestore.ingest_generator)
+    :return: the number of sequences appended
+    '''
+    meta = load_meta(savedir)
+    args = dict(meta['genargs'][-1])
+    seqdim = tuple(args['seqdim'])
+    tstep = int(args['step'] * 60)
+
+    # the first window which ends after the old end
+    tbegin = ts2sec(args['end']) - (seqdim[0] - 1) * tstep
+    tend = ts2sec(end)
+    if tend <= ts2sec(args['end']):
+        print('append: nothing after {0}'.format(args['end']))
+        return 0
+
+    if ingest and args.get('store_dir'):
+        # every store read by the generators, from the source directories as the generators resolve them
+        gen = WeatherDataGenerator(seqdim=seqdim, begin=sec2ts(tbegin, 'min'), end=end, step=args['step'], mode=args['mode'],
+                                   store_dir=args['store_dir'])
+        for entry in gen.generators:
+            framestore.ingest_generator(entry['generator'])
+        gen.close()
+
+    args['begin'] = sec2ts(tbegin, 'min')
+    args['end'] = end
+    args['offset'] = (0,) + tuple(args['offset'][1:])
+    args['seqnum'] = (tend - tbegin) // tstep + 1
+
+    dedup = meta['dedup']
+    writer = SequenceWriter(os.path.join(savedir, 'append.dat'), seqdim, dedup=dedup)
+    seqnum = generator(writer=writer, **args)
+    seqs = writer.close()
+    if seqnum == 0:
+        del seqs
+        os.remove(writer.path)
+        print('append: no new sequences until {0}'.format(end))
+        return 0
+
+    # normalize with the frozen constants
+    zmins, zmaxs = meta['zmins'], meta['zmaxs']
+    normalize(seqs[:, None] if dedup else seqs, zmins, zmaxs, scaling=meta['scaling'], defer=meta['defer_normalization'])
+    if dedup:
+        frames = seqs
+        starts = numpy.asarray(writer.starts, dtype="int32")
+    else:
+        frames = seqs.reshape((-1,) + seqdim[1:])
+        starts = numpy.arange(seqnum, dtype="int32") * seqdim[0]
+    append_frames(os.path.join(savedir, 'dataset-test' + ('.npz' if meta['container'] == 'npz' else '.' + meta['container'])),
+                  frames, starts, meta['input_seq_len'], meta['output_seq_len'], meta['quantize'])
+    del frames, seqs
+    os.remove(writer.path)
+
+    meta['stats'].merge(writer.stats)
+    meta['genargs'][-1]['end'] = end
+    save_meta(savedir, **meta)
+    print('append: {0} sequences until {1}'.format(seqnum, end))
+    return seqnum
+
+def append_frames(filepath, frames, starts, input_seq_len, output_seq_len, quantize=None):
+    '''
+    append frames and the clips of the sequences which start at starts to a dataset
+    :param filepath: path to the dataset (.npz or .chunked)
+    :param frames: ndarray of the normalized (or raw if the dataset is saved with normalized=False) frames
+    :param starts: the first frame of each sequence in frames
+    :param quantize: None, or the dtype of the dataset (see quantization())
+    '''
+    arrays, shape, dtype, blocks = open_dataset(filepath)
+    if quantize is not None:
+        frames = quantize_frames(frames, quantize, arrays['qscales'], arrays['qoffsets'])
+
+    clips = numpy.zeros((2, len(starts), 2), dtype="int32")
+    clips[0, :, 0] = starts + shape[0]
+    clips[0, :, 1] = input_seq_len
+    clips[1, :, 0] = starts + shape[0] + input_seq_len
+    clips[1, :, 1] = output_seq_len
+    clips = numpy.concatenate([arrays['clips'], clips], axis=1)
+
+    if filepath.endswith('.chunked'):
+        chunked.append_chunked(filepath, numpy.asarray(frames, dtype=dtype), clips=clips)
+    else:
+        old = numpy.load(filepath)['input_raw_data']
+        arrays['input_raw_data'] = numpy.concatenate([old, numpy.asarray(frames, dtype=dtype)])
+        arrays['clips'] = clips
+        numpy.savez_compressed(filepath, **arrays)
+    print('appended {0} sequences to {1}'.format(len(starts), filepath))
+
+def quantize_frames(frames, dtype, qscales, qoffsets):
+    # quantize frames into a new array with the scales and offsets of a dataset
+    return quantize(frames, numpy.dtype(dtype), qscales, qoffsets, numpy.zeros(frames.shape, dtype=numpy.dtype(dtype)))
+
+def open_dataset(filepath):
+    '''
+    open a dataset without loading its frames
+    :param filepath: path to a dataset (.npz or .chunked)
+    :return: (a dict of the arrays other than input_raw_data, shape and dtype of input_raw_data, a function blocks(blocksize)
+              which yields input_raw_data blocksize frames at a time)
+    '''
     if not os.path.isfile(filepath):
         raise ValueError("file not found: "+filepath)
-    filename, file_extension = os.path.splitext(filepath)
-
-    f = numpy.load(filepath)
-    dims = (f['dims'][0,0], f['dims'][0,1], f['dims'][0,2])
-    input_seqlen = f['clips'][0,0,1]
-    output_seqlen = f['clips'][1,0,1]
-    seqlen = input_seqlen + output_seqlen
-    seqnum = f['clips'].shape[1]
 
-    input_raw_data = f['input_raw_data'] \
-        .reshape((seqnum, seqlen, dims[0], patchsize, dims[1]/patchsize, patchsize, dims[2]/patchsize), order='C') \
-        .swapaxes(4,5) \
-        .reshape((seqnum, seqlen, dims[0], patchsize*patchsize, dims[1]/patchsize, dims[2]/patchsize), order='C') \
-        .swapaxes(2,3) \
-        .reshape((seqnum, seqlen*patchsize*patchsize, dims[0], dims[1]/patchsize, dims[2]/patchsize), order='F') \
-        .reshape((seqnum*seqlen*patchsize*patchsize, dims[0], dims[1]/patchsize, dims[2]/patchsize), order='C')
+    if filepath.endswith('.chunked'):
+        f = chunked.load(filepath)
+        frames = f['input_raw_data']
+        def blocks(blocksize):
+            for i in xrange(0, frames.shape[0], blocksize):
+                yield frames[i:i+blocksize]
+        return dict((key, f[key]) for key in f.keys() if key != 'input_raw_data'), frames.shape, frames.dtype, blocks
 
-    dims = numpy.asarray([[dims[0], dims[1]/patchsize, dims[2]/patchsize]], dtype="int32")
+    f = numpy.load(filepath)
+    arrays = dict((key, f[key]) for key in f.files if key != 'input_raw_data')
 
-    clips = numpy.tile(f['clips'], (patchsize*patchsize,1,1,1))
-    for n in xrange(clips.shape[0]): clips[n] = clips[n] + n*seqnum*seqlen
-    clips = clips.swapaxes(0,1).reshape((2,patchsize*patchsize*seqnum,2))
+    # read the .npy member of the zip as a stream instead of decompressing it as a whole
+    fp = f.zip.open('input_raw_data.npy')
+    version = numpy.lib.format.read_magic(fp)
+    if version == (1, 0):
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fp)
+    else:
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(fp)
+    fp.close()
+    assert not fortran_order
+
+    def blocks(blocksize):
+        fp = f.zip.open('input_raw_data.npy')
+        numpy.lib.format.read_magic(fp)
+        if version == (1, 0):
+            numpy.lib.format.read_array_header_1_0(fp)
+        else:
+            numpy.lib.format.read_array_header_2_0(fp)
+        framesize = int(numpy.prod(shape[1:])) * dtype.itemsize
+        for i in xrange(0, shape[0], blocksize):
+            n = min(blocksize, shape[0] - i)
+            yield numpy.frombuffer(fp.read(n * framesize), dtype=dtype).reshape((n,) + shape[1:])
+        fp.close()
+    return arrays, shape, dtype, blocks
+
+def save_like(filepath, **arrays):
+    '''
+    save arrays in the container of filepath (numpy.savez for .npz, the chunked container for .chunked)
+    '''
+    if filepath.endswith('.chunked'):
+        chunked.save_chunked(filepath, **arrays)
+    else:
+        numpy.savez(filepath, **arrays)
 
-    numpy.savez('{0}-{1}x{2}{3}'.format(filename, dims[1], dims[2], file_extension), input_raw_data=input_raw_data, dims=dims, clips=clips, zmaxs=f['zmaxs'], zmins=f['zmins'])
+def convert_to_multi_view(filepath, blocksize=256):
+    '''
+    split a dataset into one dataset per channel (<filename>-view<channel><ext>), blocksize frames at a time.
+    the testbed loader can also read a view of the dataset directly without converting it (view=<channel>)
+    '''
+    filename, file_extension = os.path.splitext(filepath)
+    arrays, shape, dtype, blocks = open_dataset(filepath)
+
+    tmppaths = ['{0}-view{1}.dat'.format(filename, c) for c in xrange(shape[1])]
+    views = [numpy.memmap(tmppath, dtype=dtype, mode='w+', shape=(shape[0], 1) + tuple(shape[2:])) for tmppath in tmppaths]
+    i = 0
+    for block in blocks(blocksize):
+        for c, view in enumerate(views):
+            view[i:i+block.shape[0]] = block[:, c:c+1]
+        i += block.shape[0]
+
+    for c, view in enumerate(views):
+        view.flush()
+        dims = arrays['dims'].copy()
+        dims[0][0] = 1
+        # the arrays of each channel
+        channel = dict((key, arrays[key][c:c+1]) for key in ['zmins', 'zmaxs', 'qscales', 'qoffsets'] if key in arrays)
+        others = dict((key, value) for key, value in arrays.items() if key != 'dims' and key not in channel)
+        save_like('{0}-view{1}{2}'.format(filename, c, file_extension), input_raw_data=view, dims=dims, **dict(channel, **others))
+    del views
+    for tmppath in tmppaths:
+        os.remove(tmppath)
+
+def patchify(filepath, patchsize=2, blocksize=256):
+    '''
+    split each frame of a dataset into patchsize x patchsize tiles, and make a sequence of each tile of each sequence.
+    the frames are processed blocksize frames at a time, so the dataset does not have to fit in memory.
+    the tile k of the frame i is the frame k*n_frames+i of the output, and the clips of the tile k of the sequence j
+    are the (k*n_sequences+j)-th clips
+    '''
+    filename, file_extension = os.path.splitext(filepath)
+    arrays, shape, dtype, blocks = open_dataset(filepath)
+
+    d, h, w = shape[1], shape[2]/patchsize, shape[3]/patchsize
+    n_frames = shape[0]
+    n_tiles = patchsize*patchsize
+
+    tmppath = '{0}-{1}x{2}.dat'.format(filename, h, w)
+    input_raw_data = numpy.memmap(tmppath, dtype=dtype, mode='w+', shape=(n_tiles*n_frames, d, h, w))
+    i = 0
+    for block in blocks(blocksize):
+        n = block.shape[0]
+        # (n, d, patchsize, h, patchsize, w) -> (patchsize, patchsize, n, d, h, w)
+        tiles = block[:, :, :h*patchsize, :w*patchsize].reshape((n, d, patchsize, h, patchsize, w)).transpose((2, 4, 0, 1, 3, 5))
+        for k in xrange(n_tiles):
+            input_raw_data[k*n_frames+i:k*n_frames+i+n] = tiles[k // patchsize, k % patchsize]
+        i += n
+    input_raw_data.flush()
+
+    dims = numpy.asarray([[d, h, w]], dtype="int32")
+    clips = numpy.tile(arrays['clips'][:, None], (1, n_tiles, 1, 1))
+    clips[:, :, :, 0] += (numpy.arange(n_tiles) * n_frames)[None, :, None]
+    clips = clips.reshape((2, n_tiles*arrays['clips'].shape[1], 2))
+
+    others = dict((key, value) for key, value in arrays.items() if key not in ['dims', 'clips'])
+    save_like('{0}-{1}x{2}{3}'.format(filename, h, w, file_extension), input_raw_data=input_raw_data, dims=dims, clips=clips, **others)
+    del input_raw_data
+    os.remove(tmppath)
 
 def file_check(dir='../radar', begin="201408010000", end="201408312330", step=5):
-    tbegin = int(calendar.timegm(datetime.strptime(begin, '%Y%m%d%H%M').timetuple()))
-    tend = int(calendar.timegm(datetime.strptime(end, "%Y%m%d%H%M").timetuple()))
+    tbegin = ts2sec(begin)
+    tend = ts2sec(end)
     tstep = int(step*60)
 
-    for t in xrange(tbegin, tend, tstep):
-        stim = time.gmtime(t)
-        tim = time.strftime("%Y%m%d%H%M", stim)
-        filename = tim + ".csv"
-        filepath = dir + "/" + filename
-        if not os.path.isfile(filepath):
-            print('file '+filepath+' does not exist')
+    available = scan_timestamps(dir, '.csv')
+    expected = numpy.arange(tbegin, tend, tstep, dtype=numpy.int64)
+    for t in expected[~numpy.in1d(expected, available)]:
+        filepath = dir + "/" + sec2ts(t, 'min') + ".csv"
+        print('file '+filepath+' does not exist')
 
 def test_intrp(supply_num=0):
     g_target = RadarGenerator("../radar", w=5, h=5, begin="201408010000", end="201408312330", step="5")
@@ -372,6 +1352,33 @@ def test_intrp(supply_num=0):
             except IOError as e:
                 print(' Radar:{0}'.format(e))
 
+def test_parallel_generate(step=1, seqnum=120, processes=2, split=3, begin='201408010000', end='201408010255'):
+    '''
+    check that concat_generate(parallel=...) over split sub-ranges generates the sequences of the serial generation,
+    for a step finer than the step of the sources (see split_range)
+    '''
+    import shutil
+    import tempfile
+
+    genargs = [{'seqnum': seqnum, 'seqdim': (4, 2, 16, 16), 'offset': (0,0,0), 'begin': begin, 'end': end, 'step': step,
+                'input_seq_len': 2, 'output_seq_len': 2, 'mode': 'grayscale'}]
+    dirname = tempfile.mkdtemp()
+    try:
+        clips = []
+        for parallel in [0, processes]:
+            savedir = os.path.join(dirname, 'parallel{0}'.format(parallel))
+            concat_generate(genargs, input_seq_len=2, output_seq_len=2, savedir=savedir, parallel=parallel, split=split, previews=0)
+            clips.append([])
+            for name in ['train', 'valid', 'test']:
+                f = numpy.load(os.path.join(savedir, 'dataset-{0}.npz'.format(name)))
+                frames = f['input_raw_data']
+                clips[-1].append(numpy.asarray([frames[start:start+length] for start, length in numpy.concatenate(f['clips'])]))
+        print('sequences: serial {0}, parallel {1}'.format([len(x) // 2 for x in clips[0]], [len(x) // 2 for x in clips[1]]))
+        assert [len(x) for x in clips[0]] == [len(x) for x in clips[1]]
+        assert all(numpy.allclose(a, b) for a, b in zip(clips[0], clips[1]))
+    finally:
+        shutil.rmtree(dirname)
+
 def test_weather_data_generator():
     gen = WeatherDataGenerator(step=1)
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from abc import ABCMeta, abstractmethod
 import numpy
+from numpy.lib.stride_tricks import as_strided
 import theano
 import theano.tensor as T
 from theano.gof.utils import flatten
@@ -23,6 +24,62 @@ class Model(object):
         return
 
 
+class BatchAssembler(object):
+    def __init__(self, t_in, t_out, frame_shape, mask_shape, dtype=theano.config.floatX):
+        '''
+        assemble the minibatches of windows of a sequence of frames into preallocated buffers.
+        the buffers of each minibatch size are allocated once and reused by every call of that size
+        :param t_in: num of input timesteps
+        :param t_out: num of output timesteps
+        :param frame_shape: shape of a frame in the minibatch, (d, h, w) or (n_ins,)
+        :param mask_shape: shape of the mask of a frame, (d,) or ()
+        :param dtype:
+        :return:
+        '''
+        self.t_in = t_in
+        self.t_out = t_out
+        self.frame_shape = tuple(frame_shape)
+        self.mask_shape = tuple(mask_shape)
+        self.dtype = numpy.dtype(dtype)
+        self.buffers = {}
+
+    def _buffers(self, n_samples):
+        if n_samples not in self.buffers:
+            self.buffers[n_samples] = (
+                numpy.empty((self.t_in, n_samples) + self.frame_shape, dtype=self.dtype),
+                # every window is of t_in frames, so the mask is constant
+                numpy.ones((self.t_in, n_samples) + self.mask_shape, dtype=self.dtype),
+                numpy.empty((self.t_out, n_samples) + self.frame_shape, dtype=self.dtype))
+        return self.buffers[n_samples]
+
+    def assemble(self, frames, starts, targets=True):
+        '''
+        gather the windows of frames which start at starts into the buffers, by one fancy index of a strided view
+        of the windows of frames (which is not copied) for each buffer
+        :param frames: ndarray of shape (n_frames, d, h, w)
+        :param starts: the first frame of the input of each sample
+        :param targets: also gather the t_out frames after the input of each sample
+        :return: x, mask, y (None if not targets) of shape (n_timesteps, n_samples, ...), as prepare_data().
+                 they are overwritten by the next call with the same number of samples
+        '''
+        starts = numpy.asarray(starts, dtype=numpy.intp)
+        frames = numpy.asarray(frames, dtype=self.dtype)
+        n_timesteps = self.t_in + self.t_out if targets else self.t_in
+        if 0 < len(starts) and (starts.min() < 0 or frames.shape[0] - n_timesteps < starts.max()):
+            raise IndexError('windows of {0} frames from {1} are out of {2} frames'.format(n_timesteps, starts, frames.shape[0]))
+
+        x, mask, y = self._buffers(len(starts))
+        n = len(starts)
+        # windows[t, s] is the frame s + t: the timesteps come first as in the buffers,
+        # so that windows[:, starts] is gathered in the order of the buffer
+        windows = as_strided(frames, shape=(n_timesteps, max(frames.shape[0] - n_timesteps + 1, 0)) + frames.shape[1:],
+                             strides=(frames.strides[0],) + frames.strides)
+        x.reshape((self.t_in, n) + frames.shape[1:])[...] = windows[:self.t_in, starts]
+        if not targets:
+            return x, mask, None
+        y.reshape((self.t_out, n) + frames.shape[1:])[...] = windows[self.t_in:, starts]
+        return x, mask, y
+
 class BaseModel(Model):
     def __init__(self, numpy_rng, theano_rng, dnn, t_in=2, d=1, w=10, h=10, t_out=1):
         '''
@@ -81,15 +138,7 @@ class BaseModel(Model):
         '''
         learning_rate = T.scalar('lr', dtype=theano.config.floatX)
 
-        y = self.get_target() # y is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
-        z = self.get_output() # z is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
-
-        n_samples = y.shape[1]
-
-        mse = T.sum((y - z)**2) # Mean Square Error
-        cee = T.sum(-(y * T.log(z) + (1.0-y) * T.log(1.0-z))) # Cross Entropy Error
-        # cee2= T.sum(-(y * T.log(z) + (1.0-y) * T.log(1.0-z))+(y * T.log(y) + (1.0-y) * T.log(1.0-y)))
-        cost = cee
+        cost = self.get_cost()
         params = flatten(self.dnn.params)
         grads = T.grad(cost, params)
 
@@ -101,6 +150,25 @@ class BaseModel(Model):
     def build_prediction_function(self):
         return theano.function([self.dnn.x, self.dnn.mask], outputs=self.get_output())
 
+    def build_loss_function(self):
+        '''
+        build the function of the cost of a minibatch per sample, so that the error of a dataset is reduced
+        by the compiled function instead of computing it from the prediction on the host
+        :return: f(x, mask, y)
+        '''
+        y = self.get_target()
+        n_samples = T.cast(y.shape[1], theano.config.floatX)
+        return theano.function([self.dnn.x, self.dnn.mask, self.dnn.y], outputs=self.get_cost() / n_samples)
+
+    def get_cost(self):
+        y = self.get_target() # y is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
+        z = self.get_output() # z is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
+
+        mse = T.sum((y - z)**2) # Mean Square Error
+        cee = T.sum(-(y * T.log(z) + (1.0-y) * T.log(1.0-z))) # Cross Entropy Error
+        # cee2= T.sum(-(y * T.log(z) + (1.0-y) * T.log(1.0-z))+(y * T.log(y) + (1.0-y) * T.log(1.0-y)))
+        return cee
+
     def get_target(self):
         return self.dnn.y
 
@@ -110,6 +178,24 @@ class BaseModel(Model):
         else:
             return self.dnn.output
 
+    def batch_shapes(self):
+        # the shapes of a frame and of its mask in the minibatches of prepare_data
+        return (self.d, self.h, self.w), (self.d,)
+
+    def prepare_windows(self, frames, starts, targets=True):
+        '''
+        the minibatch of prepare_data(xs, ys) with xs the windows frames[start:start+t_in] and ys the t_out frames
+        after them, gathered from frames into reused buffers without copying each window (see BatchAssembler)
+        :param frames: ndarray of shape (n_frames, d, h, w)
+        :param starts: the first frame of each sample
+        :param targets: False to assemble only x and mask (y is None)
+        :return: x, mask, y
+        '''
+        if getattr(self, 'assembler', None) is None:
+            frame_shape, mask_shape = self.batch_shapes()
+            self.assembler = BatchAssembler(self.t_in, self.t_out, frame_shape, mask_shape)
+        return self.assembler.assemble(frames, starts, targets)
+
     def prepare_data(self, xs, ys):
         '''
         prepare data for inserting to RNN or LSTM
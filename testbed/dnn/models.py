@@ -115,6 +115,9 @@ class EncoderDecoderLSTM(BaseModel):
 
         super(EncoderDecoderLSTM, self).__init__(numpy_rng, theano_rng, dnn, t_in, d, w, h, t_out)
 
+    def batch_shapes(self):
+        return (self.n_ins,), ()
+
     @property
     def params(self):
         params = BaseModel.params.fget(self)
@@ -282,6 +285,9 @@ class StackedLSTM(BaseModel):
 
         super(StackedLSTM, self).__init__(numpy_rng, theano_rng, dnn, t_in, d, w, h, t_out)
 
+    def batch_shapes(self):
+        return (self.n_ins,), ()
+
     @property
     def params(self):
         params = BaseModel.params.fget(self)
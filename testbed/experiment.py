@@ -4,9 +4,18 @@ __author__ = 'masayuki'
 import os
 import sys
 sys.path.append('/usr/local/lib/python2.7/site-packages')
+# the chunked container of the datasets (chunked.py) is shared with the dataset generator
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'weather_data'))
 
 import datetime
 import timeit
+import collections
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import shutil
+import struct
+import zipfile
 
 import pickle
 
@@ -17,6 +26,7 @@ from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
 
 import dnn
 import dnn.optimizers as O
+import chunked
 from utils import ndarray
 
 def zzip(params):
@@ -82,43 +92,301 @@ def patchify(data, patch_size):
 
 def reshape_patch(data, patch_size):
     assert 4 == data.ndim
-    assert isinstance(patch_size, tuple) and len(tuple) == 2
-
-    # dataset.shape: (n_timesteps, n_samples, n_feature_maps, height, width)
-    ret = data.reshape((data.shape[0], data.shape[1], data.shape[2] / patch_size[0], patch_size[0],
-                        data.shape[3] / patch_size[1], patch_size[1])) \
-        .swapaxes(2, 3) \
-        .rollaxis(5, 3) \
-        .reshape((data.shape[0], data.shape[1] * patch_size[0] * patch_size[1], data.shape[2], data.shape[3]))
+    assert isinstance(patch_size, tuple) and len(patch_size) == 2
+
+    # data.shape: (n_timesteps, n_feature_maps, height, width)
+    # each patch_size block of pixels is moved to the feature maps
+    n_timesteps, d, h, w = data.shape
+    ret = data.reshape((n_timesteps, d, h / patch_size[0], patch_size[0], w / patch_size[1], patch_size[1])) \
+        .transpose((0, 1, 3, 5, 2, 4)) \
+        .reshape((n_timesteps, d * patch_size[0] * patch_size[1], h / patch_size[0], w / patch_size[1]))
     return ret
 
+def downsample(data, factor):
+    # data.shape: (n_timesteps, n_feature_maps, height, width)
+    # each factor x factor block of pixels is averaged
+    n_timesteps, d, h, w = data.shape
+    h, w = h / factor, w / factor
+    return data[:, :, :h*factor, :w*factor].reshape((n_timesteps, d, h, factor, w, factor)).mean(axis=(3, 5), dtype=numpy.float32)
+
 def reshape_patch_back(patches, patch_size):
     assert 4 == patches.ndim
-    assert isinstance(patch_size, tuple) and len(tuple) == 2
+    assert isinstance(patch_size, tuple) and len(patch_size) == 2
 
-    # patches.shape: (n_timesteps, n_samples, n_patch_feature_maps, patch_height, patch_width)
-    ret = patches.reshape(patches.shape[0], patches.shape[1] / patch_size[0] / patch_size[1],
-                          patch_size[0], patch_size[1], patches.shape[2], patches.shape[3]).rollaxis(3, 5).swapaxes(3, 2)\
-        .reshape((patches.shape[0], patches.shape[1] / patch_size[0] / patch_size[1],
-         patches.shape[2] * patch_size[0], patches.shape[3] * patch_size[1]))
+    # patches.shape: (n_timesteps, n_patch_feature_maps, patch_height, patch_width)
+    n_timesteps, c, ph, pw = patches.shape
+    d = c / patch_size[0] / patch_size[1]
+    ret = patches.reshape((n_timesteps, d, patch_size[0], patch_size[1], ph, pw)) \
+        .transpose((0, 1, 4, 2, 5, 3)) \
+        .reshape((n_timesteps, d, ph * patch_size[0], pw * patch_size[1]))
 
     return ret
 
-def moving_mnist_load_dataset(train_dataset, valid_dataset, test_dataset, patch_size):
+class Clips(object):
+    def __init__(self, frames, clips, patch_size=None, zmins=None, zmaxs=None, clip=False, view=None, qscales=None, qoffsets=None,
+                 level=0):
+        '''
+        clips of a dataset as views of its frames, so that sequences sharing frames are not copied.
+        the clips are returned as they are stored; dequantize() converts a minibatch assembled from them
+        :param frames: ndarray of shape (n_frames, n_feature_maps, height, width)
+        :param clips: ndarray of shape (n_clips, 2) of (start, length) of each clip
+        :param patch_size: reshape each clip with reshape_patch() if given
+        :param zmins: normalize with zmins and zmaxs per channel if given (for datasets saved with normalized=False)
+        :param zmaxs:
+        :param clip: clip the normalized values to [0,1]
+        :param view: select this channel of the frames as a view (instead of converting the dataset with convert_to_multi_view)
+        :param qscales: the scale of each channel of quantized frames (frames saved with quantize=...)
+        :param qoffsets: the offset of each channel of quantized frames
+        :param level: area-average each clip by 2**level (before reshape_patch), for quick runs on coarse frames.
+                      averaging commutes with dequantize(), which is affine per channel
+        '''
+        self.frames = frames
+        self.clips = clips
+        self.patch_size = patch_size
+        self.channels = slice(None) if view is None else slice(view, view+1)
+        self.clip = clip
+        self.factor = 2**level
+
+        # dequantization and normalization are one affine transform per channel: a * stored + b
+        n_channels = frames.shape[1]
+        a = numpy.ones((n_channels,)) if qscales is None else numpy.asarray(qscales, dtype=numpy.float64)
+        b = numpy.zeros((n_channels,)) if qoffsets is None else numpy.asarray(qoffsets, dtype=numpy.float64)
+        if zmins is not None:
+            zmins = numpy.asarray(zmins, dtype=numpy.float64)
+            zmaxs = numpy.asarray(zmaxs, dtype=numpy.float64)
+            a, b = a / (zmaxs - zmins), (b - zmins) / (zmaxs - zmins)
+        a, b = a[self.channels], b[self.channels]
+        if patch_size is not None:
+            # reshape_patch() moves the pixels of a channel to consecutive channels
+            a, b = numpy.repeat(a, patch_size[0] * patch_size[1]), numpy.repeat(b, patch_size[0] * patch_size[1])
+        self.identity = numpy.all(a == 1) and numpy.all(b == 0)
+        self.a = a.reshape((-1, 1, 1))
+        self.b = b.reshape((-1, 1, 1))
+
+    def __len__(self):
+        return len(self.clips)
+
+    @property
+    def shape(self):
+        # (n_clips, n_timesteps, n_feature_maps, height, width), assuming the clips are of the same length
+        d, h, w = self.frames.shape[1:]
+        d = len(range(d)[self.channels])
+        h, w = h // self.factor, w // self.factor
+        if self.patch_size is not None:
+            d, h, w = d * self.patch_size[0] * self.patch_size[1], h / self.patch_size[0], w / self.patch_size[1]
+        return (len(self.clips), self.clips[0, 1], d, h, w)
+
+    def __getitem__(self, i):
+        start, length = self.clips[i]
+        clip = self.frames[start:start+length, self.channels]
+        if self.factor != 1:
+            clip = downsample(clip, self.factor)
+        if self.patch_size is not None:
+            clip = reshape_patch(clip, self.patch_size)
+        return clip
+
+    def batch(self, indices):
+        '''
+        the clips of indices at once, read with one fancy index of the frames (of a memory-mapped dataset,
+        only their frames are read) and downsampled and reshaped by reshape_patch() as one array
+        :param indices: indices of the clips, which must be of the same length
+        :return: ndarray of shape (n_clips, n_timesteps, n_feature_maps, height, width)
+        '''
+        clips = self.clips[numpy.asarray(indices)]
+        length = clips[0, 1]
+        assert numpy.all(clips[:, 1] == length)
+        if isinstance(self.frames, numpy.ndarray):
+            rows = (clips[:, 0].reshape((-1, 1)) + numpy.arange(length)).ravel()
+            frames = self.frames[rows, self.channels]
+        else:
+            # the chunked container is read by slices
+            frames = numpy.concatenate([self.frames[start:start+length, self.channels] for start in clips[:, 0]])
+        if self.factor != 1:
+            frames = downsample(frames, self.factor)
+        if self.patch_size is not None:
+            frames = reshape_patch(frames, self.patch_size)
+        return frames.reshape((len(clips), length) + frames.shape[1:])
+
+    def dequantize(self, batch):
+        '''
+        dequantize and normalize a minibatch of the clips in place
+        :param batch: float ndarray of shape (..., n_feature_maps, height, width) assembled from the clips (e.g. by prepare_data)
+        :return: batch
+        '''
+        if not self.identity:
+            batch *= self.a.astype(batch.dtype)
+            batch += self.b.astype(batch.dtype)
+        if self.clip:
+            numpy.clip(batch, 0, 1, out=batch)
+        return batch
+
+    def prefetch(self, indices):
+        '''
+        start reading the frames of the clips in the background, if the frames support it (see chunked.ChunkedArray)
+        :param indices: indices of the clips which will be accessed next
+        '''
+        if not hasattr(self.frames, 'prefetch'):
+            return
+        for i in indices:
+            start, length = self.clips[i]
+            self.frames.prefetch(start, start+length)
+
+def mmap_member(file, member, extract=False):
+    '''
+    memory-map a .npy member of a .npz file.
+    a member stored without compression (numpy.savez) is mapped in place. a compressed member (numpy.savez_compressed)
+    can not be mapped in place: it is extracted once to <filename>-<member> next to the file and mapped from there
+    if extract, and raises ValueError otherwise
+    :param file: path to the .npz file
+    :param member: name of the member (e.g. 'input_raw_data.npy')
+    :param extract: extract a compressed member next to the file
+    :return: read-only numpy.memmap
+    '''
+    with zipfile.ZipFile(file) as z:
+        info = z.getinfo(member)
+        if info.compress_type != zipfile.ZIP_STORED:
+            path = '{0}-{1}'.format(os.path.splitext(file)[0], member)
+            if not extract:
+                raise ValueError('{0} of {1} is compressed and can not be memory-mapped in place '
+                                 '(extract=True extracts it to {2})'.format(member, file, path))
+            if not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(file):
+                tmppath = path + '.tmp'
+                with open(tmppath, 'wb') as out:
+                    shutil.copyfileobj(z.open(member), out, 1 << 20)
+                os.rename(tmppath, path)
+            return numpy.load(path, mmap_mode='r')
+
+    with open(file, 'rb') as fp:
+        # skip the local header of the member to the .npy in it: the 30 bytes of the header
+        # (the lengths of the file name and of the extra field at 26 and 28), the file name and the extra field
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        if header[:4] != b'PK\x03\x04':
+            raise ValueError('no local header of {0} in {1}'.format(member, file))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        fp.seek(name_length + extra_length, 1)
+        version = numpy.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(fp)
+        offset = fp.tell()
+    if 0 in shape:
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.memmap(file, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+def load_npz(file, mmap=True, extract=False):
+    '''
+    load the arrays of a .npz dataset, with input_raw_data memory-mapped (see mmap_member),
+    so that loading the dataset does not read its frames
+    :param file: path to the .npz file
+    :param mmap: False to load input_raw_data into memory
+    :param extract: extract input_raw_data of a compressed dataset next to the file to memory-map it.
+                    otherwise it is loaded into memory
+    :return: a dict of the arrays
+    '''
+    nda = numpy.load(file)
+    if mmap and 'input_raw_data' in nda.files and not extract and \
+            nda.zip.getinfo('input_raw_data.npy').compress_type != zipfile.ZIP_STORED:
+        print('Warning: input_raw_data of {0} is compressed, it is loaded into memory (extract=True to memory-map it)'.format(file))
+        mmap = False
+    arrays = dict((key, nda[key]) for key in nda.files if key != 'input_raw_data' or not mmap)
+    if mmap and 'input_raw_data' in nda.files:
+        arrays['input_raw_data'] = mmap_member(file, 'input_raw_data.npy', extract=extract)
+    nda.close()
+    return arrays
+
+class Prefetcher(object):
+    def __init__(self, depth=2, workers=1):
+        '''
+        assemble the next minibatches in a pool of threads while the current one is trained.
+        the time spent on assembling them and the time the training waited for them are accumulated,
+        so that hidden() tells how much of the assembly was overlapped with the training
+        :param depth: how many minibatches to assemble ahead (0 to assemble them serially)
+        :param workers: number of threads of the pool
+        '''
+        self.depth = depth
+        self.pool = multiprocessing.pool.ThreadPool(workers) if 0 < depth else None
+        self.work_time = 0.
+        self.wait_time = 0.
+
+    def _timed(self, func, item):
+        start_time = timeit.default_timer()
+        ret = func(item)
+        return ret, timeit.default_timer() - start_time
+
+    def imap(self, func, iterable):
+        '''
+        like pool.imap(func, iterable), but at most depth items are assembled ahead
+        :return: generator of func(item) in the order of iterable
+        '''
+        if self.pool is None:
+            for item in iterable:
+                ret, elapsed = self._timed(func, item)
+                self.work_time += elapsed
+                self.wait_time += elapsed
+                yield ret
+            return
+
+        iterator = iter(iterable)
+        queue = collections.deque()
+        while True:
+            for item in iterator:
+                queue.append(self.pool.apply_async(self._timed, (func, item)))
+                if self.depth < len(queue):
+                    break
+            if len(queue) == 0:
+                return
+            start_time = timeit.default_timer()
+            ret, elapsed = queue.popleft().get()
+            self.wait_time += timeit.default_timer() - start_time
+            self.work_time += elapsed
+            yield ret
+
+    def hidden(self):
+        '''
+        :return: the fraction of the assembly time which the training did not wait for
+        '''
+        if self.work_time == 0:
+            return 0.
+        return max(0., 1. - self.wait_time / self.work_time)
+
+    def reset(self):
+        self.work_time = 0.
+        self.wait_time = 0.
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+def moving_mnist_load_dataset(train_dataset, valid_dataset, test_dataset, patch_size, view=None, level=0, mmap=True, extract=False):
     '''
     load datasets
     :param train_dataset:
     :param valid_dataset:
     :param test_dataset:
+    :param view: load only this channel of the datasets (see Clips)
+    :param level: load the frames area-averaged by 2**level (see Clips)
+    :param mmap: memory-map the frames of .npz datasets instead of loading them (see load_npz)
+    :param extract: extract the frames of compressed .npz datasets next to them to memory-map them (see load_npz)
     :return:
     '''
     def load(file):
-        nda = numpy.load(file)
+        # chunked containers are decompressed block by block when the clips are accessed,
+        # the frames of .npz are read from the memory map when the clips are accessed
+        nda = chunked.load(file) if file.endswith('.chunked') else load_npz(file, mmap, extract)
         input_raw_data = nda['input_raw_data']
         clips = nda['clips']
-        xs = [reshape_patch(input_raw_data[clips[0,i,0]:clips[0,i,0]+clips[0,i,1]], patch_size) for i in xrange(clips.shape[1])]
-        ys = [reshape_patch(input_raw_data[clips[1,i,0]:clips[1,i,0]+clips[1,i,1]], patch_size) for i in xrange(clips.shape[1])]
-        return (ndarray(xs), ndarray(ys))
+        # the datasets saved with normalized=False or quantize=... are converted by Clips.dequantize()
+        scaling = {}
+        if 'normalized' in nda.keys() and not nda['normalized']:
+            scaling.update({'zmins': nda['zmins'], 'zmaxs': nda['zmaxs'], 'clip': bool(nda['clip'])})
+        if 'qscales' in nda.keys():
+            scaling.update({'qscales': nda['qscales'], 'qoffsets': nda['qoffsets']})
+        xs = Clips(input_raw_data, clips[0], patch_size, view=view, level=level, **scaling)
+        ys = Clips(input_raw_data, clips[1], patch_size, view=view, level=level, **scaling)
+        return (xs, ys)
 
     # load dataset
     train = load(train_dataset)
@@ -141,6 +409,15 @@ def exp_moving_mnist(
         batch_size=16,  # The batch size during training.
         valid_batch_size=16,  # The batch size used for validation/test set.
         learning_rate=1e-3,
+        level=0,  # Train on the frames area-averaged by 2**level (see Clips)
+        mmap=True,  # Memory-map the frames of the datasets instead of loading them (see load_npz)
+        extract=False,  # Extract the frames of compressed datasets next to them to memory-map them (see load_npz)
+        prefetch=2,  # Number of minibatches to assemble ahead while training (0 to assemble them serially)
+        prefetch_workers=1,  # Number of threads assembling the minibatches
+        train_eval='full',  # The train error at validation: of the 'full' train set, of a fixed random 'subsample' of it,
+                            # or the 'running' mean of the costs of the minibatches trained since the last validation
+        train_subsample=None,  # Number of train examples of the 'subsample' (default: as many as the valid examples, at most all of them)
+        test_on_improvement=False,  # Compute the test error only when the validation error improves
 ):
     '''
     make experiment on Moving MNIST dataset
@@ -158,7 +435,8 @@ def exp_moving_mnist(
 
     # load dataset
     print('loading dataset...'),
-    datasets = moving_mnist_load_dataset(train_dataset, valid_dataset, test_dataset, patch_size)
+    datasets = moving_mnist_load_dataset(train_dataset, valid_dataset, test_dataset, patch_size, level=level, mmap=mmap,
+                                         extract=extract)
     train_data, valid_data, test_data = datasets
     print('done')
 
@@ -175,7 +453,7 @@ def exp_moving_mnist(
     print('building model...')
     model = dnn.EncoderDecoderConvLSTM(numpy_rng, theano_rng, t_in=t_in, d=d, w=w, h=h, t_out=t_out, filter_shapes=filter_shapes)
     f_grad_shared, f_update = model.build_finetune_function(optimizer=O.rmsprop)
-    f_predict = model.build_prediction_function()
+    f_loss = model.build_loss_function()
     print('done')
 
     kf_train = get_minibatches_idx(len(train_data[0]), batch_size)
@@ -186,6 +464,13 @@ def exp_moving_mnist(
     print("{0} valid examples".format(len(valid_data[0])))
     print("{0} test examples".format(len(test_data[0])))
 
+    assert train_eval in ['full', 'subsample', 'running']
+    if train_eval == 'subsample':
+        # the same examples at every validation, in the order of the frames
+        n_subsample = min(len(valid_data[0]) if train_subsample is None else train_subsample, len(train_data[0]))
+        subsample = numpy.sort(numpy_rng.permutation(len(train_data[0]))[:n_subsample])
+        kf_subsample = [(i, subsample[index]) for i, index in get_minibatches_idx(n_subsample, valid_batch_size)]
+
     # bunch of configs
     dispFreq = 1
     if validFreq is None:
@@ -193,24 +478,30 @@ def exp_moving_mnist(
     if saveFreq is None:
         saveFreq = len(train_data[0]) / batch_size
 
+    # the evaluation has its own pool, so that it does not count in the metric of the training
+    prefetcher = Prefetcher(prefetch, prefetch_workers)
+    eval_prefetcher = Prefetcher(prefetch, prefetch_workers)
+
+    def prepare_minibatch(data, index):
+        # Select the examples for this minibatch
+        y = data[1].batch(index)
+        x = data[0].batch(index)
+
+        # Get the data in numpy.ndarray format
+        # This swap the axis!
+        # Return something of shape (minibatch maxlen, n samples)
+        x, mask, y = model.prepare_data(x, y)
+        return data[0].dequantize(x), mask, data[1].dequantize(y)
+
     def pred_error(data, iterator):
         """
         Just compute the error
         """
         valid_errs = []
-        for _, valid_index in iterator:
-            n_samples = len(valid_index)
-
-            # Select the random examples for this minibatch
-            y = [data[1][t] for t in valid_index]
-            x = [data[0][t] for t in valid_index]
-            x, mask, y = model.prepare_data(x, y)
+        for x, mask, y in eval_prefetcher.imap(lambda (_, index): prepare_minibatch(data, index), iterator):
             # x is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
             # y is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
-
-            z = f_predict(x, mask)
-            # z is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
-            err = numpy.sum(-(y * numpy.log(z) + (1.0-y) * numpy.log(1.0-z))) / n_samples
+            err = f_loss(x, mask, y)
             valid_errs.append(err)
 
         return numpy.mean(valid_errs)
@@ -224,6 +515,9 @@ def exp_moving_mnist(
         uidx = 0  # the number of update done
         estop = False  # early stop
         costs = []
+        running_cost = 0.  # the sum of the costs since the last validation
+        running_samples = 0
+        test_err = None
         for eidx in xrange(max_epochs):
             n_samples = 0
 
@@ -231,18 +525,18 @@ def exp_moving_mnist(
             kf = get_minibatches_idx(len(train_data[0]), batch_size, shuffle=True)
 
             avg_cost = 0
-            for bidx, train_index in kf:
+            prefetcher.reset()
+            epoch_start_time = timeit.default_timer()
+            minibatches = prefetcher.imap(lambda (_, index): prepare_minibatch(train_data, index), kf)
+            for (bidx, train_index), (x, mask, y) in itertools.izip(kf, minibatches):
                 uidx += 1
                 #use_noise.set_value(1.) # TODO: implement dropout?
 
-                # Select the random examples for this minibatch
-                y = [train_data[1][t] for t in train_index]
-                x = [train_data[0][t] for t in train_index]
+                # read the blocks of the next minibatch in the background while this one is assembled
+                if prefetch == 0 and bidx + 1 < len(kf):
+                    train_data[0].prefetch(kf[bidx+1][1])
+                    train_data[1].prefetch(kf[bidx+1][1])
 
-                # Get the data in numpy.ndarray format
-                # This swap the axis!
-                # Return something of shape (minibatch maxlen, n samples)
-                x, mask, y = model.prepare_data(x, y)
                 n_samples += x.shape[1]
 
                 batch_start_time = timeit.default_timer()
@@ -253,6 +547,8 @@ def exp_moving_mnist(
                 batch_end_time = timeit.default_timer()
 
                 avg_cost += cost / len(kf)
+                running_cost += cost
+                running_samples += x.shape[1]
 
                 if numpy.isnan(cost) or numpy.isinf(cost):
                     print('NaN detected, cost={0}'.format(cost))
@@ -276,14 +572,25 @@ def exp_moving_mnist(
 
                 if numpy.mod(uidx, validFreq) == 0:
                     #use_noise.set_value(0.) # TODO: implement dropout?
-                    train_err = pred_error(train_data, kf)
+                    if train_eval == 'running':
+                        # the cost of each minibatch is taken before its update
+                        train_err = running_cost / running_samples
+                    elif train_eval == 'subsample':
+                        train_err = pred_error(train_data, kf_subsample)
+                    else:
+                        train_err = pred_error(train_data, kf)
+                    running_cost = 0.
+                    running_samples = 0
                     valid_err = pred_error(valid_data, kf_valid)
-                    test_err = pred_error(test_data, kf_test)
+                    if (not test_on_improvement or len(history_errs) == 0 or
+                                valid_err <= numpy.array(history_errs)[:, 0].min()):
+                        test_err = pred_error(test_data, kf_test)
 
+                    # the test error is of the last improvement if test_on_improvement
                     history_errs.append([valid_err, test_err])
 
                     if (uidx == 0 or
-                                valid_err <= numpy.array(history_errs).min()):
+                                valid_err <= numpy.array(history_errs)[:, 0].min()):
                         best_p = zzip(model.params)
                         bad_counter = 0
 
@@ -291,7 +598,7 @@ def exp_moving_mnist(
                           .format(eidx+1, max_epochs, bidx+1, len(kf), train_err, valid_err, test_err))
 
                     if (len(history_errs) > patience and
-                                valid_err >= numpy.array(history_errs)[:-patience].min()):
+                                valid_err >= numpy.array(history_errs)[:-patience, 0].min()):
                         bad_counter += 1
                         if bad_counter > patience:
                             print('Early Stop!')
@@ -301,6 +608,9 @@ def exp_moving_mnist(
             costs.append(avg_cost)
 
             print("Epoch {0}/{1}: Seen {2} samples".format(eidx+1, max_epochs, n_samples))
+            print("Epoch {0}/{1}: took {2} secs, assembling minibatches took {3} secs, waited {4} secs ({5:.0%} hidden)"
+                  .format(eidx+1, max_epochs, timeit.default_timer() - epoch_start_time,
+                          prefetcher.work_time, prefetcher.wait_time, prefetcher.hidden()))
 
             if estop:
                 break
@@ -311,10 +621,57 @@ def exp_moving_mnist(
 
         return train_err, valid_err, test_err
 
-    train_err, valid_err, test_err = train(learning_rate, max_epochs)
+    try:
+        train_err, valid_err, test_err = train(learning_rate, max_epochs)
+    finally:
+        prefetcher.close()
+        eval_prefetcher.close()
     print("Train finished. Train: {0}, Valid: {1}, Test: {2}".format(train_err, valid_err, test_err))
 
 
+def _bench_load_worker(args):
+    import resource
+    file, clips_mode, patch_size, batch_size = args
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = timeit.default_timer()
+    if clips_mode == 'eager':
+        # load the frames and reshape every clip once, as the loader did before Clips
+        nda = numpy.load(file)
+        frames = nda['input_raw_data']
+        clips = [reshape_patch(frames[start:start+length], patch_size) for start, length in nda['clips'][0]]
+        load_time = timeit.default_timer() - start_time
+        batch = numpy.asarray([clips[i] for i in xrange(batch_size)])
+    else:
+        nda = load_npz(file)
+        clips = Clips(nda['input_raw_data'], nda['clips'][0], patch_size)
+        load_time = timeit.default_timer() - start_time
+        batch = clips.batch(numpy.arange(batch_size))
+    batch_time = timeit.default_timer() - start_time - load_time
+    return load_time, batch_time, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024., batch.sum()
+
+def bench_load(n_clips=400, t=20, h=64, w=64, patch_size=(4,4), batch_size=16, outdir='out'):
+    '''
+    compare the loading time and the peak memory of loading a dataset and reshaping every clip (eager)
+    with the memory-mapped dataset reshaped per minibatch (lazy), in a fresh process each
+    '''
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    file = os.path.join(outdir, 'bench-load.npz')
+    frames = numpy.random.RandomState(1000).rand(n_clips * t, 1, h, w).astype(numpy.float32)
+    clips = numpy.asarray([[(i * t, t) for i in xrange(n_clips)]] * 2, dtype=numpy.int32)
+    numpy.savez(file, input_raw_data=frames, clips=clips)
+    del frames
+
+    results = {}
+    for clips_mode in ['lazy', 'eager']:
+        pool = multiprocessing.Pool(1)
+        results[clips_mode] = pool.apply(_bench_load_worker, ((file, clips_mode, patch_size, batch_size),))
+        pool.close()
+        pool.join()
+        print('{0}: load {1:.3f} sec, first minibatch {2:.4f} sec, peak rss +{3:.0f} MB'.format(clips_mode, *results[clips_mode][:3]))
+    assert numpy.isclose(results['lazy'][3], results['eager'][3])
+    os.remove(file)
+
 if __name__ == '__main__':
     argv = sys.argv  # コマンドライン引数を格納したリストの取得
     argc = len(argv) # 引数の個数
@@ -1,16 +1,48 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import glob
+import ConfigParser
 
 import math
 import numpy
-import theano
-import theano.tensor as T
 
 import csv
 from PIL import Image
 import lrit
 
+def default_floatX():
+    '''
+    the dtype of the generated frames, found without importing theano (which reads its configuration and takes
+    the lock of its compile directory, seconds at the start of every process):
+    $DATA_FLOATX, theano.config.floatX if theano is already imported, floatX of $THEANO_FLAGS or of the [global] section
+    of $THEANORC (~/.theanorc), or float64 (the default of theano)
+    '''
+    if 'DATA_FLOATX' in os.environ:
+        return os.environ['DATA_FLOATX']
+    if 'theano' in sys.modules:
+        return sys.modules['theano'].config.floatX
+    for flag in os.environ.get('THEANO_FLAGS', '').split(','):
+        key, _, value = flag.partition('=')
+        if key.strip() == 'floatX':
+            return value.strip()
+    config = ConfigParser.RawConfigParser()
+    config.read([os.path.expanduser(path) for path in os.environ.get('THEANORC', '~/.theanorc').split(os.pathsep)])
+    if config.has_option('global', 'floatX'):
+        return config.get('global', 'floatX')
+    return 'float64'
+
+# the dtype of the generated frames (see set_floatX)
+floatX = default_floatX()
+
+def set_floatX(dtype):
+    '''
+    set the dtype of the generated frames
+    :param dtype: 'float32' or 'float64'
+    '''
+    global floatX
+    floatX = dtype
+
 class Generator(object):
     def __init__(self, w=10, h=10, d=1):
         self.w = w
@@ -43,7 +75,7 @@ class ConstantGenerator(Generator):
                 ] for k in xrange(self.d)
             ]
 
-        return numpy.asarray(data, dtype=theano.config.floatX)
+        return numpy.asarray(data, dtype=floatX)
 
 
 class SinGenerator(Generator):
@@ -63,7 +95,7 @@ class SinGenerator(Generator):
                 ] for k in xrange(self.d)
             ]
 
-        return numpy.asarray(data, dtype=theano.config.floatX)
+        return numpy.asarray(data, dtype=floatX)
 
 class RadarGenerator(Generator):
     def __init__(self, dir, w=0, h=0, offset=(0,0,0)):
@@ -115,7 +147,7 @@ class RadarGenerator(Generator):
             w = w - self.offset[0] if n_cols < self.offset[0] + w else w
             h = h - self.offset[1] if n_rows < self.offset[1] + h else h
 
-            data = numpy.zeros((1,h,w), dtype=theano.config.floatX)
+            data = numpy.zeros((1,h,w), dtype=floatX)
 
             for timeline in reader:
                 for row in xrange(n_rows):
@@ -202,7 +234,7 @@ class SatelliteGenerator(Generator):
 
         o = -1 if self.lrit_settings['prj_dir'] == 'N' else 1
 
-        data = numpy.zeros((self.d, self.h, self.w), dtype=theano.config.floatX)
+        data = numpy.zeros((self.d, self.h, self.w), dtype=floatX)
         for k in xrange(self.d):
             for j in xrange(self.h):
                 for i in xrange(self.w):
@@ -276,7 +308,7 @@ def gen_dataset(t_in=5, w=10, h=10, offset=(0,0,0), t_out=15):
     print('\nend generating dataset')
     print('{0} data in total'.format(len(data_x)))
 
-    return numpy.asarray(data_x, dtype=theano.config.floatX), numpy.asarray(data_y, dtype=theano.config.floatX)
+    return numpy.asarray(data_x, dtype=floatX), numpy.asarray(data_y, dtype=floatX)
 
 
 if __name__ == '__main__':
@@ -17,6 +17,42 @@ import dnn
 from generator import ConstantGenerator, SinGenerator, RadarGenerator
 import utils
 
+class RingWindow(object):
+    def __init__(self, window_size, shape, dtype):
+        '''
+        a sliding window of the last window_size frames in a preallocated buffer of twice the window.
+        each frame is written at its position in both halves of the buffer, so the frames of the window in order
+        are always the contiguous slice buffer[pos:pos+window_size] (see view()), and appending a frame costs O(frame)
+        :param window_size: number of frames in the window
+        :param shape: shape of a frame (d, h, w)
+        :param dtype:
+        :return:
+        '''
+        self.window_size = window_size
+        self.buffer = numpy.zeros((2 * window_size,) + tuple(shape), dtype=dtype)
+        self.pos = 0
+
+    def append(self, frame):
+        self.buffer[self.pos] = frame
+        self.buffer[self.pos + self.window_size] = frame
+        self.pos = (self.pos + 1) % self.window_size
+
+    def view(self):
+        '''
+        :return: the frames of the window from the oldest, as a view of the buffer (no copy).
+                 the view is overwritten by the following append()
+        '''
+        return self.buffer[self.pos:self.pos + self.window_size]
+
+    def __len__(self):
+        return self.window_size
+
+    def __getitem__(self, key):
+        return self.view()[key]
+
+    def __array__(self, dtype=None):
+        return self.view() if dtype is None else self.view().astype(dtype)
+
 class TestBed(object):
     def __init__(self, window_size=10, t_in=3, w=10, h=10, d=1, t_out=3, hidden_layers_sizes=[3]):
         '''
@@ -36,7 +72,7 @@ class TestBed(object):
         self.h = h
         self.d = d
         self.t_out = t_out
-        self.dataset = [ numpy.zeros((d,h,w), dtype=theano.config.floatX) for i in xrange(window_size) ]
+        self.dataset = RingWindow(window_size, (d,h,w), dtype=theano.config.floatX)
 
         numpy_rng = numpy.random.RandomState(1000)
         theano_rng = RandomStreams(seed=1000)
@@ -80,8 +116,6 @@ class TestBed(object):
 
     def supply(self, data):
         self.dataset.append(data)
-        while self.window_size < len(self.dataset):
-            self.dataset.pop(0)
 
     def get_minibatches_idx(self, idx, minibatch_size, shuffle=True):
         idx_list = numpy.asarray(idx, dtype="int32")
@@ -101,22 +135,6 @@ class TestBed(object):
 
         return zip(range(len(minibatches)), minibatches)
 
-    def _make_input(self, dataset, idx):
-        '''
-        (i,j) の SdA に対する入力ベクトルを ndata から作る
-        :param ndata: an array of ndarray of (d-by-h-by-w) dimention, whose size is n
-        :return:
-        '''
-        return dataset[[range(n,n+self.t_in) for n in idx], :, : ,:]
-
-    def _make_output(self, dataset, idx):
-        '''
-        (i,j) の SdA に対する出力ベクトルをつくる
-        :param data:
-        :return:
-        '''
-        return dataset[[range(n+self.t_in,n+self.t_in+self.t_out) for n in idx], :, :, :]
-
     def pretrain(self, epochs=15, learning_rate=0.1, batch_size=1):
         '''
         現在持っているデータセットで学習する
@@ -125,7 +143,7 @@ class TestBed(object):
         if self.f_pretrain is None:
             return numpy.inf
 
-        dataset = numpy.asarray(self.dataset, dtype=theano.config.floatX)
+        dataset = self.dataset.view()
         idx = range(self.window_size-self.t_in-self.t_out+1)
         numpy.random.shuffle(idx)
         cut = int(math.ceil(0.8*len(idx)))
@@ -159,13 +177,8 @@ class TestBed(object):
                 #use_noise.set_value(1.) # TODO: implement dropout?
 
                 # Select the random examples for this minibatch
-                y = self._make_output(dataset, train_index)
-                x = self._make_input(dataset, train_index)
-
-                # Get the data in numpy.ndarray format
-                # This swap the axis!
-                # Return something of shape (minibatch maxlen, n samples)
-                x, mask, y = self.model.prepare_data(x, y)
+                # and gather them in the shape of (minibatch maxlen, n samples)
+                x, mask, y = self.model.prepare_windows(dataset, train_index)
                 n_samples += x.shape[1]
 
                 cost = self.f_pretrain(x, mask, y, learning_rate)
@@ -220,7 +233,7 @@ class TestBed(object):
         :return:
         '''
         print('finetune: learning_rate={0}'.format(learning_rate))
-        dataset = numpy.asarray(self.dataset, dtype=theano.config.floatX)
+        dataset = self.dataset.view()
         idx = range(self.window_size-self.t_in-self.t_out+1)
         numpy.random.shuffle(idx)
         cut = int(math.ceil(0.8*len(idx)))
@@ -255,13 +268,8 @@ class TestBed(object):
                 #use_noise.set_value(1.) # TODO: implement dropout?
 
                 # Select the random examples for this minibatch
-                y = self._make_output(dataset, train_index)
-                x = self._make_input(dataset, train_index)
-
-                # Get the data in numpy.ndarray format
-                # This swap the axis!
-                # Return something of shape (minibatch maxlen, n samples)
-                x, mask, y = self.model.prepare_data(x, y)
+                # and gather them in the shape of (minibatch maxlen, n samples)
+                x, mask, y = self.model.prepare_windows(dataset, train_index)
                 n_samples += x.shape[1]
 
                 cost = self.f_grad_shared(x, mask, y)
@@ -320,9 +328,7 @@ class TestBed(object):
             n_samples = len(valid_index)
 
             # Select the random examples for this minibatch
-            y = self._make_output(dataset, valid_index)
-            x = self._make_input(dataset, valid_index)
-            x, mask, y = self.model.prepare_data(x, y)
+            x, mask, y = self.model.prepare_windows(dataset, valid_index)
             # x is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
             # y is of shape (n_timesteps, n_samples, n_feature_maps, height, width)
 
@@ -342,9 +348,8 @@ class TestBed(object):
         :return:
         '''
         idx = len(self.dataset)-self.t_in-1
-        dataset = numpy.asarray(self.dataset, dtype=theano.config.floatX)
-        x = self._make_input(dataset, [idx])
-        x, mask, _ = self.model.prepare_data(x, None)
+        dataset = self.dataset.view()
+        x, mask, _ = self.model.prepare_windows(dataset, [idx], targets=False)
         y = self.f_predict(x, mask) # f_predict returns output of (n_timesteps, 1, n_feature_maps, height, width)
         y = y.swapaxes(0,1)[0]      # so we need to swap axes and get (n_timesteps, n_feature_maps, height, width)
         print('y.shape={0}'.format(y.shape))
@@ -356,6 +361,43 @@ class TestBed(object):
         # TODO
 
 
+def bench_batches(window_size=120, t_in=10, t_out=10, d=1, h=30, w=30, batch_size=16, repeat=20):
+    '''
+    compare the minibatch assembly by fancy indexing and prepare_data with prepare_windows,
+    against the time of a training step of the model on the minibatch
+    '''
+    import timeit
+
+    numpy_rng = numpy.random.RandomState(1000)
+    model = dnn.EncoderDecoderConvLSTM(numpy_rng, RandomStreams(seed=1000), t_in=t_in, d=d, w=w, h=h, t_out=t_out,
+                                       filter_shapes=[(1,d,3,3)])
+    f_grad_shared, f_update = model.build_finetune_function()
+
+    dataset = numpy_rng.rand(window_size, d, h, w).astype(theano.config.floatX)
+    idx = numpy_rng.permutation(window_size-t_in-t_out+1)[:batch_size]
+
+    def fancy():
+        y = dataset[[range(n+t_in, n+t_in+t_out) for n in idx], :, :, :]
+        x = dataset[[range(n, n+t_in) for n in idx], :, :, :]
+        return model.prepare_data(x, y)
+
+    def windows():
+        return model.prepare_windows(dataset, idx)
+
+    for a, b in zip(fancy(), windows()):
+        assert numpy.array_equal(a, b)
+
+    x, mask, y = windows()
+    def step():
+        f_grad_shared(x, mask, y)
+        f_update(0.001)
+
+    t_fancy = min(timeit.repeat(fancy, number=1, repeat=repeat))
+    t_windows = min(timeit.repeat(windows, number=1, repeat=repeat))
+    t_step = min(timeit.repeat(step, number=1, repeat=3))
+    print('assembly: fancy indexing + prepare_data {0:.5f} sec, prepare_windows {1:.5f} sec; training step {2:.5f} sec'
+          .format(t_fancy, t_windows, t_step))
+
 if __name__ == '__main__':
     bed = TestBed()
     # gen = ConstantGenerator(w=bed.w, h=bed.h, d=bed.d)